@@ -0,0 +1,88 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request, session
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# Control de admisión para rutas públicas: cada cliente (IP) tiene un cupo de
+# peticiones que se recarga con el tiempo, y además hay un máximo de peticiones
+# públicas atendiéndose a la vez por worker, para que siempre queden hilos libres
+# para las páginas del personal.
+TASA_POR_SEGUNDO = 1.0
+RAFAGA = 10
+MAX_CONCURRENTES = 4
+# Proxies de confianza delante de la aplicación (0: ninguno, cliente = IP de la conexión)
+SALTOS_PROXY = 0
+MAX_CLIENTES = 10000
+
+
+class CupoClientes:
+    """Token bucket por cliente (LRU acotado a max_clientes)"""
+
+    def __init__(self, tasa, rafaga, max_clientes=MAX_CLIENTES):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self.max_clientes = max_clientes
+        self._cubetas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consumir(self, cliente):
+        """Devuelve 0 si se admite la petición, o los segundos que debe esperar el cliente"""
+        ahora = time.monotonic()
+        with self._lock:
+            fichas, ultima = self._cubetas.pop(cliente, (self.rafaga, ahora))
+            fichas = min(self.rafaga, fichas + (ahora - ultima) * self.tasa)
+            espera = 0
+            if fichas >= 1:
+                fichas -= 1
+            else:
+                espera = (1 - fichas) / self.tasa
+            self._cubetas[cliente] = (fichas, ahora)
+            while len(self._cubetas) > self.max_clientes:
+                self._cubetas.popitem(last=False)
+        return espera
+
+
+class Admision:
+    def __init__(self, app):
+        self.cupo = CupoClientes(app.config['PUBLIC_RATE'], app.config['PUBLIC_BURST'])
+        self.concurrentes = threading.BoundedSemaphore(app.config['PUBLIC_MAX_CONCURRENT'])
+
+
+def limitar_publico(vista):
+    """Decorador para rutas públicas: 429 si el cliente excede su cupo, 503 si el worker está lleno.
+
+    Los usuarios con sesión iniciada (personal) no pasan por el control.
+    """
+    @functools.wraps(vista)
+    def envoltura(*args, **kwargs):
+        if session.get('logged_in'):
+            return vista(*args, **kwargs)
+        admision = current_app.extensions['admision']
+        espera = admision.cupo.consumir(request.remote_addr)
+        if espera:
+            return ("Demasiadas consultas, intenta de nuevo en unos segundos", 429,
+                    {'Retry-After': str(int(espera) + 1)})
+        if not admision.concurrentes.acquire(blocking=False):
+            return "El servicio está ocupado, intenta de nuevo en unos segundos", 503, {'Retry-After': '2'}
+        try:
+            return vista(*args, **kwargs)
+        finally:
+            admision.concurrentes.release()
+    return envoltura
+
+
+def init_app(app):
+    app.config.setdefault('PUBLIC_RATE', TASA_POR_SEGUNDO)
+    app.config.setdefault('PUBLIC_BURST', RAFAGA)
+    app.config.setdefault('PUBLIC_MAX_CONCURRENT', MAX_CONCURRENTES)
+    app.config.setdefault('PROXY_HOPS', SALTOS_PROXY)
+    saltos = app.config['PROXY_HOPS']
+    if saltos:
+        # El cupo es por IP: detrás de un proxy remote_addr sería la del proxy para todos.
+        # ProxyFix toma la IP de X-Forwarded-For contando solo los `saltos` añadidos por
+        # proxies de confianza, así que un cliente no puede inventarse la suya
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=saltos, x_proto=saltos)
+    app.extensions['admision'] = Admision(app)
@@ -0,0 +1,120 @@
+import numpy as np
+
+import fechas
+import versiones
+from cache import CacheTTL
+from resumen import PERIODOS
+
+# Tiempo de respuesta de los laboratorios: días entre test_date y result_date.
+# Los triggers de tiempos_respuesta_diario (migración 11) mantienen el histograma
+# (día, prueba, laboratorio, días de respuesta) -> cantidad, que tiene pocas filas
+# aunque haya millones de pruebas; los percentiles se sacan de ese histograma con
+# NumPy, sin recorrer las pruebas una por una.
+PERCENTILES = (50, 90, 99)
+
+# Resultados por (filtros, versión de los datos): nunca quedan desactualizados
+_resultados = CacheTTL(maxsize=64, ttl=3600)
+
+
+def percentiles(dias, cantidades, percentiles=PERCENTILES):
+    """Percentiles (por rango más cercano) de un histograma de días.
+
+    `dias` y `cantidades` son arreglos del mismo largo; `dias` puede venir desordenado.
+    """
+    orden = np.argsort(dias, kind='stable')
+    dias = dias[orden]
+    acumulado = np.cumsum(cantidades[orden])
+    total = acumulado[-1]
+    rangos = np.ceil(np.asarray(percentiles) / 100 * total)
+    return dias[np.searchsorted(acumulado, rangos)]
+
+
+def _estadisticas(dias, cantidades):
+    total = int(cantidades.sum())
+    p50, p90, p99 = (int(valor) for valor in percentiles(dias, cantidades))
+    return {
+        'cantidad': total,
+        'promedio': round(float((dias * cantidades).sum() / total), 2),
+        'mediana': p50,
+        'p90': p90,
+        'p99': p99,
+    }
+
+
+def _por_grupo(conn, grupo, condiciones, params):
+    """Estadísticas por cada valor de la expresión `grupo`.
+
+    SQLite devuelve el histograma (grupo, días) -> cantidad ya ordenado, así que
+    cada grupo es un tramo contiguo de los arreglos.
+    """
+    filas = conn.execute(f'''
+        SELECT {grupo} AS grupo, r.dias, SUM(r.cantidad) AS cantidad
+        FROM tiempos_respuesta_diario r
+        JOIN pruebas t ON r.test_id = t.id
+        WHERE {' AND '.join(condiciones)} AND r.dias >= 0
+        GROUP BY grupo, r.dias
+        ORDER BY grupo, r.dias
+    ''', params).fetchall()
+    if not filas:
+        return []
+    grupos = [fila['grupo'] for fila in filas]
+    dias = np.array([fila['dias'] for fila in filas], dtype=np.int64)
+    cantidades = np.array([fila['cantidad'] for fila in filas], dtype=np.int64)
+    cortes = [indice for indice in range(1, len(grupos)) if grupos[indice] != grupos[indice - 1]]
+    return [
+        {'grupo': str(grupos[inicio]), **_estadisticas(dias_grupo, cantidades_grupo)}
+        for inicio, dias_grupo, cantidades_grupo in zip(
+            [0] + cortes, np.split(dias, cortes), np.split(cantidades, cortes)
+        )
+    ]
+
+
+def _fecha(valor):
+    iso = fechas.normalizar(valor)
+    if iso is None:
+        raise ValueError(f"Fecha inválida: '{valor}'")
+    return iso
+
+
+def _calcular(conn, desde, hasta, granularidad, laboratorio):
+    condiciones = ['1=1']
+    params = []
+    if desde:
+        condiciones.append('r.dia >= ?')
+        params.append(_fecha(desde))
+    if hasta:
+        condiciones.append('r.dia <= ?')
+        params.append(_fecha(hasta))
+    if laboratorio:
+        condiciones.append('r.laboratory = ?')
+        params.append(laboratorio)
+
+    descartadas = conn.execute(f'''
+        SELECT COALESCE(SUM(r.cantidad), 0)
+        FROM tiempos_respuesta_diario r
+        JOIN pruebas t ON r.test_id = t.id
+        WHERE {' AND '.join(condiciones)} AND r.dias < 0
+    ''', params).fetchone()[0]
+    total = _por_grupo(conn, "'total'", condiciones, params)
+    return {
+        'granularidad': granularidad,
+        'percentiles': list(PERCENTILES),
+        'descartadas': descartadas,
+        'total': {clave: valor for clave, valor in total[0].items() if clave != 'grupo'} if total else None,
+        'por_laboratorio': _por_grupo(conn, 'r.laboratory', condiciones, params),
+        'por_prueba': _por_grupo(conn, 't.name', condiciones, params),
+        'por_periodo': _por_grupo(conn, PERIODOS[granularidad], condiciones, params),
+    }
+
+
+def tiempos_respuesta(conn, desde=None, hasta=None, granularidad='mes', laboratorio=None):
+    """Tiempo de respuesta (días) total, por laboratorio, por tipo de prueba y por periodo.
+
+    Cada grupo trae cantidad, promedio, mediana, p90 y p99. Las pruebas sin fecha
+    válida o con resultado anterior a la prueba se cuentan en 'descartadas'.
+    El cálculo se guarda hasta que cambian los datos.
+    """
+    if granularidad not in PERIODOS:
+        raise ValueError(f'Granularidad inválida: {granularidad}')
+    clave = (desde, hasta, granularidad, laboratorio, versiones.version(conn, 'pruebas_paciente', 'pruebas'))
+    return _resultados.get_or_set(clave, lambda: _calcular(conn, desde, hasta, granularidad, laboratorio))
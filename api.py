@@ -0,0 +1,180 @@
+import json
+
+from flask import Blueprint, Response, jsonify, request, session, url_for
+
+import fechas
+import versiones
+from db import get_db_connection
+from pagination import paginar
+from search import filtro_pacientes
+
+# API de solo lectura para integraciones. Cada recurso define sus campos
+# (nombre en el JSON -> expresión SQL), las tablas de las que depende su ETag
+# y los filtros que acepta por querystring.
+VERSION_API = 'v1'
+
+bp = Blueprint('api', __name__, url_prefix=f'/api/{VERSION_API}')
+
+
+class ErrorAPI(Exception):
+    def __init__(self, mensaje, status=400):
+        super().__init__(mensaje)
+        self.mensaje = mensaje
+        self.status = status
+
+
+CAMPOS_PACIENTES = {
+    'id': 'p.id',
+    'name': 'p.name',
+    'identification_number': 'p.identification_number',
+    'date_of_birth': 'p.date_of_birth',
+    'gender': 'p.gender',
+    'address': 'p.address',
+    'phone': 'p.phone',
+}
+
+CAMPOS_PRUEBAS = {
+    'id': 't.id',
+    'name': 't.name',
+    'code': 't.code',
+    'description': 't.description',
+    'category': 't.category',
+    'method': 't.method',
+    'duration': 't.duration',
+    'status': 't.status',
+}
+
+CAMPOS_RESULTADOS = {
+    'id': 'pp.id',
+    'patient_id': 'pp.patient_id',
+    'patient_name': 'p.name',
+    'identification_number': 'p.identification_number',
+    'test_id': 'pp.test_id',
+    'test_name': 't.name',
+    'test_code': 't.code',
+    'test_date': 'pp.test_date',
+    'result': 'pp.result',
+    'result_date': 'pp.result_date',
+    'laboratory': 'pp.laboratory',
+}
+
+
+def _campos_pedidos(disponibles):
+    """Campos de ?campos=a,b (todos si no se indica), en el orden pedido"""
+    pedidos = [campo.strip() for campo in request.args.get('campos', '').split(',') if campo.strip()]
+    if not pedidos:
+        return list(disponibles)
+    desconocidos = [campo for campo in pedidos if campo not in disponibles]
+    if desconocidos:
+        raise ErrorAPI(f"Campos desconocidos: {', '.join(desconocidos)}. Disponibles: {', '.join(disponibles)}")
+    return list(dict.fromkeys(pedidos))
+
+
+def _filtros_igualdad(columnas):
+    """Condiciones `columna = ?` para los parámetros presentes en la querystring"""
+    condiciones = []
+    params = []
+    for parametro, columna in columnas.items():
+        valor = request.args.get(parametro)
+        if valor:
+            condiciones.append(f'{columna} = ?')
+            params.append(valor)
+    return condiciones, params
+
+
+def _listar(tablas, desde, campos, clave, condiciones, params):
+    """Responde una página del recurso en JSON, o 304 si los datos no cambiaron.
+
+    El ETag depende solo de la versión de las tablas y de la URL, así que un
+    sondeo sin cambios se resuelve con una consulta de una fila, sin ejecutar
+    el SELECT ni serializar nada.
+    """
+    conn = get_db_connection()
+    etag = versiones.etag(VERSION_API, versiones.version(conn, *tablas), request.full_path)
+    if versiones.no_modificado(etag):
+        respuesta = Response(status=304)
+    else:
+        seleccion = _campos_pedidos(campos)
+        # SQLite arma el JSON de cada fila: de la fila del cursor va directo a la respuesta
+        objeto = ', '.join(f"'{campo}', {campos[campo]}" for campo in seleccion)
+        query = f'SELECT {clave} AS id, json_object({objeto}) AS json {desde} WHERE ' + (
+            ' AND '.join(condiciones) or '1=1'
+        )
+        pagina = paginar(conn, query, params, [(clave, 'id')], despues=request.args.get('despues'))
+        siguiente_url = None
+        if pagina.siguiente:
+            args = {k: v for k, v in request.args.items() if k != 'despues'}
+            siguiente_url = url_for(request.endpoint, despues=pagina.siguiente, **args)
+        cuerpo = '{"datos":[%s],"siguiente":%s,"siguiente_url":%s,"por_pagina":%d}' % (
+            ','.join(fila['json'] for fila in pagina),
+            json.dumps(pagina.siguiente),
+            json.dumps(siguiente_url),
+            pagina.tamano,
+        )
+        respuesta = Response(cuerpo, mimetype='application/json')
+    respuesta.set_etag(etag)
+    # El cliente puede guardar la respuesta pero debe revalidarla en cada uso
+    respuesta.headers['Cache-Control'] = 'private, no-cache'
+    return respuesta
+
+
+@bp.before_request
+def requiere_sesion():
+    if 'logged_in' not in session:
+        return jsonify(error='No autenticado'), 401
+
+
+@bp.errorhandler(ErrorAPI)
+def error_api(error):
+    return jsonify(error=error.mensaje), error.status
+
+
+@bp.route('/pacientes')
+def pacientes():
+    """Pacientes; filtros: q (nombre o carnet), nombre, carnet"""
+    condicion, params = filtro_pacientes(
+        texto=request.args.get('q', ''),
+        nombre=request.args.get('nombre', ''),
+        carnet=request.args.get('carnet', ''),
+    )
+    return _listar(('patients',), 'FROM patients p', CAMPOS_PACIENTES, 'p.id', [condicion], params)
+
+
+@bp.route('/pruebas')
+def pruebas():
+    """Catálogo de pruebas; filtros: nombre, codigo, categoria, estado"""
+    condiciones, params = _filtros_igualdad({
+        'nombre': 't.name',
+        'codigo': 't.code',
+        'categoria': 't.category',
+        'estado': 't.status',
+    })
+    return _listar(('pruebas',), 'FROM pruebas t', CAMPOS_PRUEBAS, 't.id', condiciones, params)
+
+
+@bp.route('/resultados')
+def resultados():
+    """Resultados (pruebas_paciente con nombres); filtros: patient_id, test_id, carnet,
+    laboratorio, resultado, fecha_desde, fecha_hasta (sobre test_date)"""
+    condiciones, params = _filtros_igualdad({
+        'patient_id': 'pp.patient_id',
+        'test_id': 'pp.test_id',
+        'carnet': 'p.identification_number',
+        'laboratorio': 'pp.laboratory',
+        'resultado': 'pp.result',
+    })
+    try:
+        condiciones_fechas, params_fechas = fechas.filtro_rango(
+            'pp.test_date_day', request.args.get('fecha_desde'), request.args.get('fecha_hasta')
+        )
+    except ValueError as e:
+        raise ErrorAPI(str(e))
+    condiciones.extend(condiciones_fechas)
+    params.extend(params_fechas)
+    desde = '''
+        FROM pruebas_paciente pp
+        JOIN patients p ON pp.patient_id = p.id
+        JOIN pruebas t ON pp.test_id = t.id
+    '''
+    return _listar(('pruebas_paciente', 'patients', 'pruebas'), desde, CAMPOS_RESULTADOS, 'pp.id',
+                   condiciones, params)
@@ -1,19 +1,70 @@
-from flask import Flask, render_template, request, redirect, url_for, session, make_response, Response, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, Response, send_file, stream_with_context, jsonify, abort
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
-import pandas as pd
-from io import BytesIO, StringIO
-import xlsxwriter
+from io import BytesIO
 from fpdf import FPDF
 from datetime import datetime
+from concurrent.futures import TimeoutError as FuturoVencido, wait, FIRST_COMPLETED
+import os
+import time
+import db
+import migrations
+import resumen
+from db import get_db_connection
+from search import filtro_pacientes, filtro_carnet_exacto, normalizar_carnet
+from cache import CacheTTL
+import exports
+import jobs
+from pdf_cache import CachePDF, clave_reporte
+import pagination
+from pagination import paginar
+import importacion
+import api
+from versiones import cache_por_version
+import versiones
+import admision
+import fechas
+import analitica
+import metricas
+import consultas_lentas
+import sesiones
+import diferido
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
+app.config.from_prefixed_env()
+db.init_app(app)
+pagination.init_app(app)
+versiones.init_app(app)
+app.register_blueprint(api.bp)
+admision.init_app(app)
+metricas.init_app(app)
+consultas_lentas.init_app(app)
+sesiones.init_app(app)
+migrations.migrate_database(app.config['DATABASE'])
 
-def get_db_connection():
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+# Reportes PDF por prueba ya generados (ver descargar_reporte)
+app.config.setdefault('PDF_CACHE_DIR', os.path.join(app.instance_path, 'cache_reportes'))
+app.config.setdefault('PDF_CACHE_MAX_BYTES', 200 * 1024 * 1024)
+cache_reportes = CachePDF(app.config['PDF_CACHE_DIR'], app.config['PDF_CACHE_MAX_BYTES'])
+
+# Reportes PDF completos que se generan en segundo plano (ver exportar_pacientes_pdf) y
+# trabajo pesado que una petición espera en el pool de procesos (XLSX, PDF de una prueba)
+cola_trabajos = jobs.init_app(app)
+app.config.setdefault('BULK_REPORTS_MAX', 500)
+
+# Filas que muestran como máximo las tablas de /informes y /informes/detalle; el resto
+# se obtiene con las exportaciones
+app.config.setdefault('REPORT_MAX_ROWS', 1000)
+
+@app.errorhandler(jobs.PoolOcupado)
+def pool_ocupado(e):
+    return "El servidor está generando otros reportes, intenta de nuevo en unos segundos", 503, {'Retry-After': '10'}
+
+@app.errorhandler(jobs.TiempoAgotado)
+def tiempo_agotado(e):
+    app.logger.warning('Trabajo cancelado por timeout: %s', e)
+    return "El reporte tardó demasiado en generarse; prueba con un rango de fechas más corto", 504
 
 def require_role(required_role=None):
     """Decorador para verificar roles. Si required_role es None, solo requiere estar logueado."""
@@ -44,25 +95,30 @@ def is_empleado():
     """Verifica si el usuario actual es empleado"""
     return session.get('rol') == 'empleado'
 
+# Resultados de la consulta pública. La clave incluye la versión de los datos, así que
+# nunca se sirve un resultado desactualizado; el TTL solo acota la memoria.
+consultas_publicas = CacheTTL(maxsize=2048, ttl=60)
+
+@app.context_processor
 def get_user_context():
-    """Obtiene el contexto del usuario para las plantillas"""
+    """Obtiene el contexto del usuario para todas las plantillas"""
     username = session.get('username', 'Usuario')
     rol = session.get('rol', 'Sin rol')
-    nombre_completo = username
-    
-    if 'user_id' in session:
-        conn = get_db_connection()
-        user = conn.execute('SELECT nombre_completo FROM usuarios WHERE id = ?', (session['user_id'],)).fetchone()
-        conn.close()
-        if user:
-            nombre_completo = user['nombre_completo']
-    
+    # sesiones.py mantiene el nombre al día si se edita el usuario
+    nombre_completo = session.get('nombre_completo') or username
+
     return {
         'username': nombre_completo,
         'rol': rol,
-        'current_user': session.get('username')
+        'current_user': session.get('username'),
+        'is_admin': is_admin()
     }
 
+def invalidar_reportes_paciente(conn, patient_id):
+    """Borra de la cache los reportes PDF de todas las pruebas de un paciente"""
+    ids = [row['id'] for row in conn.execute('SELECT id FROM pruebas_paciente WHERE patient_id = ?', (patient_id,))]
+    cache_reportes.invalidar(*ids)
+
 @app.route('/')
 def home():
     if 'logged_in' in session:
@@ -77,6 +133,8 @@ def login():
         
         # Primero verificar el admin hardcoded (para compatibilidad)
         if username == 'admin' and password == 'adminarthu':
+            # Id de sesión nuevo al iniciar sesión: una cookie fijada antes no sirve de nada
+            session.regenerar()
             session['logged_in'] = True
             session['username'] = 'admin'
             session['rol'] = 'admin'
@@ -93,10 +151,8 @@ def login():
         if user:
             # Verificar que el usuario esté activo
             if user['estado'] != 'Activo':
-                conn.close()
                 return render_template('login.html', error='Tu cuenta está inactiva. Contacta al administrador.')
             
-            conn.close()
             stored_password = user['contraseña']
             
             # Intentar verificar con check_password_hash (funciona con hashes y detecta texto plano)
@@ -104,10 +160,12 @@ def login():
             # Si está en texto plano, check_password_hash retornará False y verificamos manualmente
             if check_password_hash(stored_password, password):
                 # Contraseña hasheada y correcta
+                session.regenerar()
                 session['logged_in'] = True
                 session['username'] = username
                 session['user_id'] = user['id']
                 session['rol'] = user['rol']
+                session['nombre_completo'] = user['nombre_completo']
                 return redirect(url_for('admin'))
             elif stored_password == password:
                 # Contraseña en texto plano (para compatibilidad con usuarios antiguos)
@@ -117,12 +175,13 @@ def login():
                 conn.execute('UPDATE usuarios SET contraseña = ? WHERE id = ?', 
                            (hashed_password, user['id']))
                 conn.commit()
-                conn.close()
                 
+                session.regenerar()
                 session['logged_in'] = True
                 session['username'] = username
                 session['user_id'] = user['id']
                 session['rol'] = user['rol']
+                session['nombre_completo'] = user['nombre_completo']
             return redirect(url_for('admin'))
         
         return render_template('login.html', error='Credenciales inválidas')
@@ -131,49 +190,22 @@ def login():
 @app.route('/logout')
 def logout():
     session.clear()
+    session.regenerar()
     return redirect(url_for('login'))
 
 @app.route('/admin')
+@cache_por_version()
 def admin():
     if 'logged_in' in session:
-        username = session.get('username', 'Usuario')
-        rol = session.get('rol', 'Sin rol')
-
-        # Obtener nombre completo si es un usuario de la BD
-        nombre_completo = username
-        if 'user_id' in session:
-            conn = get_db_connection()
-            user = conn.execute(
-                'SELECT nombre_completo FROM usuarios WHERE id = ?',
-                (session['user_id'],)
-            ).fetchone()
-            conn.close()
-            if user:
-                nombre_completo = user['nombre_completo']
-
         # Obtener datos de pruebas por categoría para la gráfica
         conn = get_db_connection()
 
-        # Total real de pruebas (todas las realizadas)
-        total_pruebas_real = conn.execute(
-            'SELECT COUNT(*) FROM pruebas_paciente'
-        ).fetchone()[0]
-
-        # Conteo de pruebas por categoría (tipo de prueba)
-        # Evita duplicados si hay nombres repetidos en la tabla "pruebas"
-        pruebas_por_categoria = conn.execute('''
-            SELECT 
-                t.name AS categoria,
-                COUNT(DISTINCT pp.id) AS cantidad
-            FROM pruebas_paciente pp
-            JOIN (
-                SELECT DISTINCT id, name FROM pruebas
-            ) t ON pp.test_id = t.id
-            GROUP BY t.name
-            ORDER BY cantidad DESC
-        ''').fetchall()
-
-        conn.close()
+        # Total real de pruebas, conteo por categoría (tipo de prueba) y laboratorios, desde los
+        # contadores de resumen; compartidos por todos los usuarios hasta que cambien los datos
+        total_pruebas_real, pruebas_por_categoria, laboratorios = versiones.resultados.obtener(
+            conn, ('pruebas_paciente', 'pruebas'), 'panel',
+            lambda: (resumen.total(conn, 'pruebas_paciente'), resumen.pruebas_por_tipo(conn),
+                     resumen.laboratorios(conn)))
 
         # Convertir los resultados a formato JSON para la plantilla
         datos_grafica = [
@@ -183,65 +215,105 @@ def admin():
 
         # Validar totales
         total_calculado = sum(row['cantidad'] for row in datos_grafica)
-        print("DEBUG -> Total real:", total_pruebas_real)
-        print("DEBUG -> Total gráfico:", total_calculado)
+        if total_calculado != total_pruebas_real:
+            app.logger.warning('Totales del panel desalineados: %s pruebas, %s en la gráfica',
+                               total_pruebas_real, total_calculado)
 
         # Contexto para el template
-        context = get_user_context()
-        context.update({
-            'username': nombre_completo,
-            'rol': rol,
-            'current_user': session.get('username'),
-            'datos_grafica': datos_grafica,
-            'total_pruebas_real': total_pruebas_real
-        })
-
-        return render_template('admin.html', **context)
+        return render_template('admin.html', datos_grafica=datos_grafica, total_pruebas_real=total_pruebas_real,
+                               laboratorios=laboratorios)
 
     # Si no hay sesión activa, redirigir al login
     return redirect(url_for('login'))
 
+@app.route('/admin/tendencias')
+@cache_por_version('pruebas_paciente', 'pruebas')
+def tendencias():
+    """Series de pruebas y positivos por día, semana o mes para la gráfica de tendencias (JSON)"""
+    if 'logged_in' not in session:
+        return jsonify(error='No autenticado'), 401
+    conn = get_db_connection()
+    try:
+        desde = request.args.get('desde')
+        hasta = request.args.get('hasta')
+        filtros = dict(
+            desde=datetime.strptime(desde, '%Y-%m-%d').date() if desde else None,
+            hasta=datetime.strptime(hasta, '%Y-%m-%d').date() if hasta else None,
+            granularidad=request.args.get('granularidad', 'dia'),
+            laboratorio=request.args.get('laboratorio') or None,
+        )
+        datos = versiones.resultados.obtener(conn, ('pruebas_paciente', 'pruebas'),
+                                             ('tendencias', tuple(filtros.items())),
+                                             lambda: resumen.tendencias(conn, **filtros))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(datos)
+
+@app.route('/admin/consultas_lentas')
+@require_role('admin')
+def consultas_lentas_admin():
+    """Sentencias que superaron SLOW_QUERY_MS, agrupadas, con su plan de ejecución"""
+    registro = app.extensions['consultas_lentas']
+    return render_template('consultas_lentas.html', consultas=registro.resumen(),
+                           umbral_ms=app.config['SLOW_QUERY_MS'],
+                           escanea_tabla=consultas_lentas.escanea_tabla)
+
 @app.route('/pacientes', methods=['GET', 'POST'])
 def pacientes():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
     
     conn = get_db_connection()
+    error = None
 
     if request.method == 'POST':
         # Todos los usuarios pueden agregar pacientes
         name = request.form['name']
-        identification_number = request.form['identification_number']
-        date_of_birth = request.form['date_of_birth']
+        identification_number = request.form['identification_number'].strip()
+        date_of_birth = fechas.normalizar(request.form['date_of_birth'])
         gender = request.form['gender']
         address = request.form['address']
         phone = request.form['phone']
         
-        conn.execute('''
-            INSERT INTO patients (name, identification_number, date_of_birth, gender, address, phone)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (name, identification_number, date_of_birth, gender, address, phone))
-        conn.commit()
+        if date_of_birth is None:
+            error = f"Fecha de nacimiento inválida: '{request.form['date_of_birth']}'"
+        else:
+            try:
+                conn.execute('''
+                    INSERT INTO patients (name, identification_number, date_of_birth, gender, address, phone)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (name, identification_number, date_of_birth, gender, address, phone))
+                conn.commit()
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                error = f'Ya existe un paciente con el número de identificación {identification_number}'
         
     search_name = request.args.get('search_name')
-    query = 'SELECT * FROM patients WHERE 1=1'
+    query = 'SELECT * FROM patients p WHERE 1=1'
     params = []
     if search_name:
-        query += ' AND name LIKE ?'
-        params.append(f'%{search_name}%')
-    pacientes = conn.execute(query, params).fetchall()
-    
-    # Obtener información del usuario para el menú
-    username = session.get('username', 'Usuario')
-    rol = session.get('rol', 'Sin rol')
-    nombre_completo = username
-    if 'user_id' in session:
-        user = conn.execute('SELECT nombre_completo FROM usuarios WHERE id = ?', (session['user_id'],)).fetchone()
-        if user:
-            nombre_completo = user['nombre_completo']
-        conn.close()
+        condicion, params = filtro_pacientes(texto=search_name)
+        query += ' AND ' + condicion
+    pacientes = paginar(conn, query, params, [('p.id', 'id')],
+                        despues=request.args.get('despues'), antes=request.args.get('antes'))
     
-    return render_template('pacientes.html', pacientes=pacientes, is_admin=is_admin(), username=nombre_completo, rol=rol, current_user=session.get('username'))
+    return render_template('pacientes.html', pacientes=pacientes, pagina=pacientes, error=error)
+
+
+@app.route('/importar_pacientes', methods=['GET', 'POST'])
+@require_role('admin')
+def importar_pacientes():
+    """Alta o actualización masiva de pacientes (campañas) desde un CSV o XLSX"""
+    resultado, error = procesar_importacion(importacion.importar_pacientes)
+    return render_template('importar.html',
+                         titulo='Importar Pacientes',
+                         descripcion='Los pacientes se identifican por su número de identificación: '
+                                     'si ya existe se actualizan sus datos, si no se crea.',
+                         volver='pacientes',
+                         resultado=resultado,
+                         error=error,
+                         columnas=importacion.COLUMNAS_PACIENTES,
+                         max_rechazos=importacion.MAX_RECHAZOS_REPORTE)
 
 
 @app.route('/editar_paciente/<int:id>', methods=['GET', 'POST'])
@@ -252,25 +324,27 @@ def editar_paciente(id):
     if request.method == 'POST':
         name = request.form['name']
         identification_number = request.form['identification_number']
-        date_of_birth = request.form['date_of_birth']
+        date_of_birth = fechas.normalizar(request.form['date_of_birth'])
         gender = request.form['gender']
         address = request.form['address']
         phone = request.form['phone']
-        conn.execute('''
-            UPDATE patients
-            SET name = ?, identification_number = ?, date_of_birth = ?, gender = ?, address = ?, phone = ?
-            WHERE id = ?
-        ''', (name, identification_number, date_of_birth, gender, address, phone, id))
-        conn.commit()
-        conn.close()
+        if date_of_birth is None:
+            return render_template('editar_paciente.html', paciente=paciente,
+                                   error=f"Fecha de nacimiento inválida: '{request.form['date_of_birth']}'")
+        try:
+            conn.execute('''
+                UPDATE patients
+                SET name = ?, identification_number = ?, date_of_birth = ?, gender = ?, address = ?, phone = ?
+                WHERE id = ?
+            ''', (name, identification_number.strip(), date_of_birth, gender, address, phone, id))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            return render_template('editar_paciente.html', paciente=paciente,
+                                   error=f'Ya existe otro paciente con el número de identificación {identification_number}')
+        invalidar_reportes_paciente(conn, id)
         return redirect(url_for('pacientes'))
-    context = get_user_context()
-    context.update({
-        'paciente': paciente,
-        'is_admin': is_admin()
-    })
-    conn.close()
-    return render_template('editar_paciente.html', **context)
+    return render_template('editar_paciente.html', paciente=paciente)
 
 @app.route('/eliminar_paciente/<int:id>')
 @require_role('admin')
@@ -278,35 +352,42 @@ def eliminar_paciente(id):
     conn = get_db_connection()
     conn.execute('DELETE FROM patients WHERE id = ?', (id,))
     conn.commit()
-    conn.close()
+    invalidar_reportes_paciente(conn, id)
     return redirect(url_for('pacientes'))
 
+def validar_paciente(conn, patient_id):
+    """Mensaje de error si patient_id no es un paciente existente (None si lo es)"""
+    if not patient_id or conn.execute('SELECT 1 FROM patients WHERE id = ?', (patient_id,)).fetchone() is None:
+        return 'Elige un paciente de la lista'
+    return None
+
 @app.route('/pruebas_paciente', methods=['GET', 'POST'])
 def pruebas_paciente():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
     
     conn = get_db_connection()
+    error = None
     
     # Manejar la creación de una nueva prueba
     if request.method == 'POST':
         patient_id = request.form['patient_id']
         test_id = request.form['test_id']
-        test_date = request.form['test_date']
+        test_date, result_date, error = fechas.fechas_prueba(request.form['test_date'], request.form['result_date'])
         result = request.form['result']
-        result_date = request.form['result_date']
         laboratory = request.form['laboratory']
+        if error is None:
+            error = validar_paciente(conn, patient_id)
         
-        conn.execute('''
-            INSERT INTO pruebas_paciente 
-            (patient_id, test_id, test_date, result, result_date, laboratory) 
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (patient_id, test_id, test_date, result, result_date, laboratory))
-        conn.commit()
-    
-    # Obtener la lista de pacientes para el select
-    pacientes = conn.execute('SELECT id, name FROM patients').fetchall()
+        if error is None:
+            conn.execute('''
+                INSERT INTO pruebas_paciente 
+                (patient_id, test_id, test_date, result, result_date, laboratory) 
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (patient_id, test_id, test_date, result, result_date, laboratory))
+            conn.commit()
     
+    # El paciente se elige con el buscador (_buscar_paciente.html) contra /api/v1/pacientes
     # Obtener solo las pruebas específicas (PCR, Antígeno, Anticuerpo)
     pruebas = conn.execute('''
         SELECT id, name 
@@ -332,39 +413,50 @@ def pruebas_paciente():
     '''
     params = []
     if search_name:
-        query += ' AND p.name LIKE ?'
-        params.append(f'%{search_name}%')
-    query += ' ORDER BY pp.test_date DESC, pp.id DESC'
-    
-    # Obtener las pruebas registradas
-    pruebas_paciente = conn.execute(query, params).fetchall()
-    conn.close()
-    
-    # Obtener información del usuario y rol para el menú
-    username = session.get('username', 'Usuario')
-    rol = session.get('rol', 'Sin rol')
+        condicion, params = filtro_pacientes(texto=search_name)
+        query += ' AND ' + condicion
     
-    # Obtener nombre completo si es un usuario de la BD
-    nombre_completo = username
-    if 'user_id' in session:
-        conn = get_db_connection()
-        user = conn.execute(
-            'SELECT nombre_completo FROM usuarios WHERE id = ?',
-            (session['user_id'],)
-        ).fetchone()
-        conn.close()
-        if user:
-            nombre_completo = user['nombre_completo']
+    # Obtener las pruebas registradas (ORDER BY pp.test_date DESC, pp.id DESC, por páginas)
+    pruebas_paciente = paginar(conn, query, params, [('pp.test_date', 'test_date'), ('pp.id', 'id')],
+                               descendente=True,
+                               despues=request.args.get('despues'), antes=request.args.get('antes'))
     
     # Renderizar la plantilla con todos los datos necesarios
     return render_template('pruebas_paciente.html',
-                         pacientes=pacientes,
                          pruebas=pruebas,
                          pruebas_paciente=pruebas_paciente,
-                         is_admin=is_admin(),
-                         username=nombre_completo,
-                         rol=rol,
-                         current_user=session.get('username'))
+                         pagina=pruebas_paciente,
+                         error=error)
+
+
+def procesar_importacion(importar):
+    """Pasa el archivo subido a la función de importación; devuelve (resultado, error)"""
+    if request.method != 'POST':
+        return None, None
+    archivo = request.files.get('archivo')
+    if archivo is None or not archivo.filename:
+        return None, 'Selecciona un archivo .csv o .xlsx'
+    try:
+        return importar(get_db_connection(), archivo.stream, archivo.filename,
+                        simular=bool(request.form.get('simular'))), None
+    except importacion.ErrorImportacion as e:
+        return None, str(e)
+
+
+@app.route('/importar_resultados', methods=['GET', 'POST'])
+@require_role('admin')
+def importar_resultados():
+    """Carga masiva de resultados de laboratorio desde un CSV o XLSX"""
+    resultado, error = procesar_importacion(importacion.importar_resultados)
+    return render_template('importar.html',
+                         titulo='Importar Resultados de Laboratorio',
+                         descripcion='El paciente se busca por número de identificación y la prueba por su código.',
+                         volver='pruebas_paciente',
+                         resultado=resultado,
+                         error=error,
+                         columnas=importacion.COLUMNAS_RESULTADOS,
+                         max_rechazos=importacion.MAX_RECHAZOS_REPORTE)
+
 @app.route('/editar_prueba_paciente/<int:id>', methods=['GET', 'POST'])
 @require_role('admin')
 def editar_prueba_paciente(id):
@@ -378,11 +470,12 @@ def editar_prueba_paciente(id):
     ''', (id,)).fetchone()
     
     if prueba is None:
-        conn.close()
         return "Prueba no encontrada", 404
         
-    # Obtener lista de pacientes para el select
-    pacientes = conn.execute('SELECT id, name FROM patients').fetchall()
+    # Paciente actual para el buscador (_buscar_paciente.html); no se listan todos
+    prueba_paciente = conn.execute(
+        'SELECT id, name, identification_number FROM patients WHERE id = ?', (prueba['patient_id'],)
+    ).fetchone()
     
     # Solo seleccionar PCR, Antígeno y Anticuerpo
     pruebas = conn.execute('''
@@ -394,10 +487,17 @@ def editar_prueba_paciente(id):
     if request.method == 'POST':
         patient_id = request.form['patient_id']
         test_id = request.form['test_id']
-        test_date = request.form['test_date']
+        test_date, result_date, error = fechas.fechas_prueba(request.form['test_date'], request.form['result_date'])
         result = request.form['result']
-        result_date = request.form['result_date']
         laboratory = request.form['laboratory']
+        if error is None:
+            error = validar_paciente(conn, patient_id)
+        if error is not None:
+            return render_template('editar_prueba_paciente.html',
+                                   prueba=prueba,
+                                   prueba_paciente=prueba_paciente,
+                                   pruebas=pruebas,
+                                   error=error)
         
         # Actualizar la prueba
         conn.execute('''
@@ -412,21 +512,15 @@ def editar_prueba_paciente(id):
         ''', (patient_id, test_id, test_date, result, result_date, laboratory, id))
         
         conn.commit()
-        conn.close()
+        cache_reportes.invalidar(id)
         return redirect(url_for('pruebas_paciente'))
     
-    conn.close()
     
-    # Obtener el contexto del usuario y agregar las variables adicionales
-    context = get_user_context()
-    context.update({
-        'prueba': prueba,
-        'pacientes': pacientes,
-        'pruebas': pruebas,
-        'is_admin': is_admin()
-    })
-    
-    return render_template('editar_prueba_paciente.html', **context)
+    # El contexto del usuario lo agrega get_user_context()
+    return render_template('editar_prueba_paciente.html',
+                           prueba=prueba,
+                           prueba_paciente=prueba_paciente,
+                           pruebas=pruebas)
 
 @app.route('/eliminar_prueba_paciente/<int:id>')
 @require_role('admin')
@@ -434,42 +528,141 @@ def eliminar_prueba_paciente(id):
     conn = get_db_connection()
     conn.execute('DELETE FROM pruebas_paciente WHERE id = ?', (id,))
     conn.commit()
-    conn.close()
+    cache_reportes.invalidar(id)
     return redirect(url_for('pruebas_paciente'))
 
 @app.route('/descargar_reporte/<int:prueba_id>')
 def descargar_reporte(prueba_id):
     """Ruta pública para descargar el reporte PDF de una prueba específica (sin necesidad de login)"""
-    buffer = generar_reporte_prueba_pdf(prueba_id)
+    # Una sola consulta alimenta el PDF, el nombre del archivo y la clave de la cache
+    prueba_data = obtener_datos_reporte(prueba_id)
     
-    if buffer is None:
+    if prueba_data is None:
         return "Prueba no encontrada", 404
     
-    # Obtener nombre del archivo basado en la prueba
-    conn = get_db_connection()
-    prueba_info = conn.execute('''
-        SELECT p.name, pp.test_date, t.name AS test_name
-        FROM pruebas_paciente pp
-        JOIN patients p ON pp.patient_id = p.id
-        JOIN pruebas t ON pp.test_id = t.id
-        WHERE pp.id = ?
-    ''', (prueba_id,)).fetchone()
-    conn.close()
-    
-    if prueba_info:
-        # Nombre del archivo: NombrePaciente_FechaPrueba_NombrePrueba.pdf
-        nombre_archivo = f"{prueba_info['name'].replace(' ', '_')}_{prueba_info['test_date']}_{prueba_info['test_name'].replace(' ', '_')}.pdf"
-        nombre_archivo = nombre_archivo.replace('/', '_')  # Reemplazar / en fechas
-    else:
-        nombre_archivo = f"reporte_prueba_{prueba_id}.pdf"
+    # Si el contenido no cambió desde la última descarga, se envía el archivo ya generado
+    clave = clave_reporte(prueba_id, prueba_data)
+    ruta = cache_reportes.get(clave)
+    if ruta is None:
+        # Sin sesión usa el cupo público del pool, más chico que el del personal
+        contenido = cola_trabajos.ejecutar(jobs.llamar, app.import_name, 'generar_reporte_prueba_pdf_bytes',
+                                           prueba_id, dict(prueba_data), publico='logged_in' not in session)
+        ruta = cache_reportes.put(clave, contenido)
     
     return send_file(
-        buffer,
+        ruta,
         as_attachment=True,
-        download_name=nombre_archivo,
+        download_name=nombre_archivo_reporte(prueba_data),
         mimetype='application/pdf'
     )
 
+@app.route('/descargar_reportes', methods=['GET', 'POST'])
+def descargar_reportes():
+    """Descarga en un ZIP los reportes PDF de varias pruebas.
+
+    Acepta una lista de ids (`ids`, repetido o separado por comas) o los filtros
+    `patient_id`, `fecha_desde`, `fecha_hasta` y `laboratorio`. Los reportes se generan
+    en paralelo en el pool de procesos y cada uno se agrega al ZIP en cuanto termina.
+    """
+    if 'logged_in' not in session:
+        return redirect(url_for('login'))
+    
+    ids = [int(valor) for campo in request.values.getlist('ids') for valor in campo.split(',') if valor.strip().isdigit()]
+    query = CONSULTA_REPORTE + ' WHERE 1=1'
+    params = []
+    if ids:
+        query += ' AND pp.id IN (%s)' % ', '.join('?' for _ in ids)
+        params.extend(ids)
+    if request.values.get('patient_id'):
+        query += ' AND pp.patient_id = ?'
+        params.append(request.values.get('patient_id'))
+    try:
+        condiciones, params_fechas = fechas.filtro_rango('pp.test_date_day', request.values.get('fecha_desde'),
+                                                         request.values.get('fecha_hasta'))
+    except ValueError as e:
+        return str(e), 400
+    for condicion in condiciones:
+        query += ' AND ' + condicion
+    params.extend(params_fechas)
+    if request.values.get('laboratorio'):
+        query += ' AND pp.laboratory = ?'
+        params.append(request.values.get('laboratorio'))
+    if not params:
+        return "Indica las pruebas (ids) o al menos un filtro", 400
+    
+    limite = app.config['BULK_REPORTS_MAX']
+    query += ' ORDER BY pp.id LIMIT ?'
+    params.append(limite + 1)
+    filas = get_db_connection().execute(query, params).fetchall()
+    if len(filas) > limite:
+        return f"Se pueden descargar como máximo {limite} reportes a la vez", 400
+    if not filas:
+        return "No se encontraron pruebas", 404
+    
+    def reportes():
+        pendientes = {}
+        errores = []
+        # Como mucho JOBS_MAX_WORKERS reportes del ZIP en el pool a la vez, cada uno con su
+        # cupo (ColaTrabajos.encolar): una descarga grande no acapara el pool del worker.
+        # JOBS_TIMEOUT_SECONDS es el plazo de toda la descarga
+        ventana = cola_trabajos.max_workers
+        timeout = app.config['JOBS_TIMEOUT_SECONDS']
+        limite = time.monotonic() + timeout
+
+        def recoger():
+            """Espera a que termine al menos un reporte y entrega los terminados"""
+            listos, _ = wait(pendientes, timeout=max(0, limite - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not listos:
+                raise FuturoVencido()
+            for futuro in listos:
+                nombre, clave = pendientes.pop(futuro)
+                try:
+                    contenido = futuro.result()
+                except Exception as e:
+                    errores.append(f"{nombre}: {e}")
+                    continue
+                cache_reportes.put(clave, contenido)
+                yield nombre, contenido
+
+        posicion = 0
+        try:
+            try:
+                for posicion, fila in enumerate(filas):
+                    prueba_id = fila['prueba_id']
+                    nombre = f"{prueba_id}_{nombre_archivo_reporte(fila)}"
+                    clave = clave_reporte(prueba_id, fila)
+                    ruta = cache_reportes.get(clave)
+                    if ruta is not None:
+                        with open(ruta, 'rb') as archivo:
+                            yield nombre, archivo.read()
+                        continue
+                    while len(pendientes) >= ventana:
+                        yield from recoger()
+                    futuro = cola_trabajos.encolar(jobs.llamar, app.import_name, 'generar_reporte_prueba_pdf_bytes',
+                                                   prueba_id, dict(fila), espera=max(0, limite - time.monotonic()))
+                    pendientes[futuro] = (nombre, clave)
+                posicion = len(filas)
+                while pendientes:
+                    yield from recoger()
+            except (FuturoVencido, jobs.PoolOcupado):
+                errores.extend(f"{nombre}: no terminó en {timeout} s" for nombre, _ in pendientes.values())
+                errores.extend(f"{fila['prueba_id']}_{nombre_archivo_reporte(fila)}: no terminó en {timeout} s"
+                               for fila in filas[posicion:])
+            if errores:
+                # Un reporte con error no corta la descarga de los demás
+                yield 'errores.txt', '\n'.join(errores).encode()
+        finally:
+            # Si el cliente corta la descarga, no seguir generando reportes
+            for futuro in pendientes:
+                futuro.cancel()
+    
+    nombre_zip = f"reportes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return Response(
+        stream_with_context(exports.generar_zip(reportes())),
+        mimetype='application/zip',
+        headers={"Content-Disposition": f"attachment; filename={nombre_zip}"}
+    )
+
 @app.route('/pruebas', methods=['GET', 'POST'])
 @require_role('admin')
 def pruebas():
@@ -492,14 +685,9 @@ def pruebas():
     if search_name:
         query += ' AND name LIKE ?'
         params.append(f'%{search_name}%')
-    pruebas = conn.execute(query, params).fetchall()
-    conn.close()
-    context = get_user_context()
-    context.update({
-        'pruebas': pruebas,
-        'is_admin': is_admin()
-    })
-    return render_template('pruebas.html', **context)
+    pruebas = paginar(conn, query, params, [('id', 'id')],
+                      despues=request.args.get('despues'), antes=request.args.get('antes'))
+    return render_template('pruebas.html', pruebas=pruebas, pagina=pruebas)
 
 @app.route('/editar_prueba/<int:id>', methods=['GET', 'POST'])
 @require_role('admin')
@@ -520,15 +708,8 @@ def editar_prueba(id):
             WHERE id = ?
         ''', (nombre, codigo, descripcion, categoria, metodo, duracion, estado, id))
         conn.commit()
-        conn.close()
         return redirect(url_for('pruebas'))
-    context = get_user_context()
-    context.update({
-        'prueba': prueba,
-        'is_admin': is_admin()
-    })
-    conn.close()
-    return render_template('editar_prueba.html', **context)
+    return render_template('editar_prueba.html', prueba=prueba)
 
 @app.route('/eliminar_prueba/<int:id>')
 @require_role('admin')
@@ -536,7 +717,6 @@ def eliminar_prueba(id):
     conn = get_db_connection()
     conn.execute('DELETE FROM pruebas WHERE id = ?', (id,))
     conn.commit()
-    conn.close()
     return redirect(url_for('pruebas'))
 
 @app.route('/usuarios', methods=['GET', 'POST'])
@@ -572,14 +752,9 @@ def usuarios():
     if search_name:
         query += ' AND nombre_completo LIKE ?'
         params.append(f'%{search_name}%')
-    usuarios = conn.execute(query, params).fetchall()
-    conn.close()
-    context = get_user_context()
-    context.update({
-        'usuarios': usuarios,
-        'is_admin': is_admin()
-    })
-    return render_template('usuarios.html', **context)
+    usuarios = paginar(conn, query, params, [('id', 'id')],
+                       despues=request.args.get('despues'), antes=request.args.get('antes'))
+    return render_template('usuarios.html', usuarios=usuarios, pagina=usuarios)
 
 @app.route('/editar_usuario/<int:id>', methods=['GET', 'POST'])
 @require_role('admin')
@@ -630,176 +805,130 @@ def editar_usuario(id):
                 WHERE id = ?
             ''', (nombre, correo, nombre_usuario, telefono, rol, estado, id))
         
+        # El trigger version_usuario_update hace que sus sesiones tomen el rol y el estado nuevos
         conn.commit()
-        conn.close()
         return redirect(url_for('usuarios'))
         
-    context = get_user_context()
-    context.update({
-        'user': user,
-        'is_admin': is_admin()
-    })
-    conn.close()
-    return render_template('editar_usuario.html', **context)
+    return render_template('editar_usuario.html', user=user)
 
 @app.route('/eliminar_usuario/<int:id>')
 @require_role('admin')
 def eliminar_usuario(id):
     conn = get_db_connection()
+    # Los triggers borran sus sesiones y las sacan de la memoria de los workers
     conn.execute('DELETE FROM usuarios WHERE id = ?', (id,))
     conn.commit()
-    conn.close()
     return redirect(url_for('usuarios'))
 
 @app.route('/informes', methods=['GET', 'POST'])
+@cache_por_version()
 def informes():
     conn = get_db_connection()
     
-    # Obtener datos de resumen
-    total_pacientes = conn.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
-    total_pruebas = conn.execute('SELECT COUNT(*) FROM pruebas_paciente').fetchone()[0]
-    
-    # Contar pruebas por categoría (solo Anticuerpos, Antígeno y PCR)
-    pacientes_por_estado = conn.execute('''
-        SELECT 
-            t.name AS tipo_prueba,
-            COUNT(pp.id) AS cantidad
-        FROM pruebas_paciente pp
-        JOIN pruebas t ON pp.test_id = t.id
-        WHERE t.name IN ('Anticuerpos', 'Antígeno', 'PCR')
-        GROUP BY t.name
-        ORDER BY t.name
-    ''').fetchall()
-    
-    # Obtener todos los pacientes y pruebas para las tablas
-    pacientes = conn.execute('SELECT * FROM patients').fetchall()
-    pruebas = conn.execute(''' 
-        SELECT pp.id, p.name AS patient_name, t.name AS test_name, t.code, pp.test_date, pp.result, pp.result_date, pp.laboratory
-        FROM pruebas_paciente pp
-        JOIN patients p ON pp.patient_id = p.id
-        JOIN pruebas t ON pp.test_id = t.id
-    ''').fetchall()
-    
-    # Manejar búsqueda si se envió el formulario
-    search_query = None
-    if request.method == 'POST':
-        search_query = request.form.get('search_query', '')
-        
-        if search_query:
-            # Buscar pacientes que coincidan con la consulta
-            pacientes = conn.execute(
-                'SELECT * FROM patients WHERE name LIKE ? OR identification_number LIKE ?',
-                ('%' + search_query + '%', '%' + search_query + '%')
-            ).fetchall()
-            
-            # Buscar pruebas relacionadas con pacientes que coincidan
-            pruebas = conn.execute(''' 
-                SELECT pp.id, p.name AS patient_name, t.name AS test_name, t.code, pp.test_date, pp.result, pp.result_date, pp.laboratory
-                FROM pruebas_paciente pp
-                JOIN patients p ON pp.patient_id = p.id
-                JOIN pruebas t ON pp.test_id = t.id
-                WHERE p.name LIKE ? OR p.identification_number LIKE ? OR t.name LIKE ?
-            ''', ('%' + search_query + '%', '%' + search_query + '%', '%' + search_query + '%')).fetchall()
-    
-    conn.close()
-    context = get_user_context()
-    context.update({
-        'total_pacientes': total_pacientes,
-        'total_pruebas': total_pruebas,
-        'pacientes_por_estado': pacientes_por_estado,
-        'pacientes': pacientes,
-        'pruebas': pruebas,
-        'search_query': search_query
-    })
-    return render_template('informes.html', **context)
+    # Obtener datos de resumen y contar pruebas por categoría (solo Anticuerpos, Antígeno y PCR)
+    total_pacientes, total_pruebas, pacientes_por_estado = versiones.resultados.obtener(
+        conn, ('patients', 'pruebas_paciente', 'pruebas'), 'resumen_informes',
+        lambda: (
+            resumen.total(conn, 'patients'),
+            resumen.total(conn, 'pruebas_paciente'),
+            sorted(
+                ({'tipo_prueba': row['categoria'], 'cantidad': row['cantidad']}
+                 for row in resumen.pruebas_por_tipo(conn, ['Anticuerpos', 'Antígeno', 'PCR'])),
+                key=lambda row: row['tipo_prueba']
+            ),
+        ))
+    
+    # Tablas de pacientes y pruebas: sus consultas se ejecutan cuando la plantilla las recorre
+    search_query = request.form.get('search_query', '') if request.method == 'POST' else None
+    tablas = diferido.tablas_informe(conn, search_query, limite=app.config['REPORT_MAX_ROWS'],
+                                     buscar_tipo_prueba=True)
+    
+    return render_template('informes.html',
+                           total_pacientes=total_pacientes,
+                           total_pruebas=total_pruebas,
+                           pacientes_por_estado=pacientes_por_estado,
+                           search_query=search_query,
+                           **tablas)
+
+def _filtros_tiempos():
+    """Filtros de la querystring para analitica.tiempos_respuesta"""
+    return {
+        'desde': request.args.get('desde') or None,
+        'hasta': request.args.get('hasta') or None,
+        'granularidad': request.args.get('granularidad', 'mes'),
+        'laboratorio': request.args.get('laboratorio') or None,
+    }
+
+@app.route('/informes/tiempos')
+def tiempos_respuesta():
+    """Tiempo de respuesta de los laboratorios (mediana, p90, p99)"""
+    if 'logged_in' not in session:
+        return redirect(url_for('login'))
+    conn = get_db_connection()
+    filtros = _filtros_tiempos()
+    error = None
+    try:
+        datos = analitica.tiempos_respuesta(conn, **filtros)
+    except ValueError as e:
+        error = str(e)
+        datos = None
+    return render_template('tiempos_respuesta.html', datos=datos, filtros=filtros, error=error,
+                           periodos=analitica.PERIODOS, laboratorios=resumen.laboratorios(conn))
+
+@app.route('/informes/tiempos/datos')
+def tiempos_respuesta_datos():
+    """Lo mismo que /informes/tiempos en JSON"""
+    if 'logged_in' not in session:
+        return jsonify(error='No autenticado'), 401
+    try:
+        datos = analitica.tiempos_respuesta(get_db_connection(), **_filtros_tiempos())
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(datos)
+
 @app.route('/informes/detalle', methods=['GET', 'POST'])
+@cache_por_version()
 def informes_detalle():
     conn = get_db_connection()
+    search_query = None
     if request.method == 'POST':
         search_query = request.form.get('search_query')
-        if search_query:
-            pacientes = conn.execute('''SELECT * FROM patients WHERE name LIKE ? OR identification_number LIKE ?''', 
-                                     ('%' + search_query + '%', '%' + search_query + '%')).fetchall()
-            pruebas = conn.execute(''' 
-                SELECT pp.id, p.name AS patient_name, t.name AS test_name, t.code, pp.test_date, pp.result, pp.result_date, pp.laboratory
-                FROM pruebas_paciente pp
-                JOIN patients p ON pp.patient_id = p.id
-                JOIN pruebas t ON pp.test_id = t.id
-                WHERE p.name LIKE ? OR p.identification_number LIKE ?
-            ''', ('%' + search_query + '%', '%' + search_query + '%')).fetchall()
-        else:
-            pacientes = conn.execute('SELECT * FROM patients').fetchall()
-            pruebas = conn.execute(''' 
-                SELECT pp.id, p.name AS patient_name, t.name AS test_name, t.code, pp.test_date, pp.result, pp.result_date, pp.laboratory
+        if 'export_excel' in request.form:
+            # Exportar directamente desde el cursor, sin cargar las tablas del informe
+            query = '''
+                SELECT p.name AS patient_name, t.name AS test_name, t.code, pp.test_date, pp.result, pp.result_date, pp.laboratory
                 FROM pruebas_paciente pp
                 JOIN patients p ON pp.patient_id = p.id
                 JOIN pruebas t ON pp.test_id = t.id
-            ''').fetchall()
-        if 'export_excel' in request.form:
-            df = pd.DataFrame(pruebas, columns=['id', 'patient_name', 'test_name', 'code', 'test_date', 'result', 'result_date', 'laboratory'])
-            df = df.drop(columns=['id'])
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Pruebas')
-            output.seek(0)
-            return Response(
-                output,
-                mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                headers={"Content-Disposition": "attachment;filename=pruebas.xlsx"}
-            )
-        conn.close()
-        context = get_user_context()
-        context.update({
-            'pacientes': pacientes,
-            'pruebas': pruebas
-        })
-        return render_template('informes_detalle.html', **context)
-    else:
-        pacientes = conn.execute('SELECT * FROM patients').fetchall()
-        pruebas = conn.execute(''' 
-            SELECT pp.id, p.name AS patient_name, t.name AS test_name, t.code, pp.test_date, pp.result, pp.result_date, pp.laboratory
-            FROM pruebas_paciente pp
-            JOIN patients p ON pp.patient_id = p.id
-            JOIN pruebas t ON pp.test_id = t.id
-        ''').fetchall()
-        conn.close()
-        context = get_user_context()
-        context.update({
-            'pacientes': pacientes,
-            'pruebas': pruebas
-        })
-        return render_template('informes_detalle.html', **context)
+                WHERE '''
+            condicion, params = filtro_pacientes(texto=search_query)
+            return exports.respuesta_xlsx(conn, [('Pruebas', query + condicion, params)], 'pruebas.xlsx')
+    tablas = diferido.tablas_informe(conn, search_query, limite=app.config['REPORT_MAX_ROWS'])
+    return render_template('informes_detalle.html', **tablas)
     
 @app.route('/informes/exportar', methods=['POST'])
 def exportar_datos():
     format = request.form['format']
     conn = get_db_connection()
-    df = pd.read_sql_query('''
-        SELECT pruebas_paciente.*, patients.name AS patient_name, pruebas.name AS test_name
-        FROM pruebas_paciente
-        JOIN patients ON pruebas_paciente.patient_id = patients.id
-        JOIN pruebas ON pruebas_paciente.test_id = pruebas.id
-    ''', conn)
-    conn.close()
+    # Filtros opcionales: fecha_desde, fecha_hasta, tipo_prueba, laboratorio
+    try:
+        query, params, encabezados = exports.consulta_pruebas(**exports.filtros_exportacion(request.form))
+    except ValueError as e:
+        return str(e), 400
     if format == 'csv':
-        output = StringIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
-        response = make_response(output.getvalue())
+        # Se envía por trozos mientras se lee el cursor; stream_with_context mantiene
+        # la conexión de la petición abierta hasta terminar
+        response = Response(
+            stream_with_context(exports.generar_csv(conn, query, params, encabezados)),
+            mimetype="text/csv"
+        )
         response.headers["Content-Disposition"] = "attachment; filename=informes.csv"
-        response.headers["Content-type"] = "text/csv"
         return response
     elif format == 'excel':
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False)
-        output.seek(0)
-        response = make_response(output.read())
-        response.headers["Content-Disposition"] = "attachment; filename=informes.xlsx"
-        response.headers["Content-type"] = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        return response
+        return exports.respuesta_xlsx(conn, [('Sheet1', query, params)], 'informes.xlsx')
 
 @app.route('/informacion', methods=['GET', 'POST'])
+@admision.limitar_publico
 def informacion():
     """Ruta pública para consultar información de pruebas sin necesidad de login"""
     conn = get_db_connection()
@@ -807,8 +936,11 @@ def informacion():
     pruebas_completas = []  # Para tener acceso a los IDs de pruebas_paciente
     
     if request.method == 'POST':
-        nombre = request.form.get('nombre') or ''
-        carnet = request.form.get('carnet') or ''
+        nombre = (request.form.get('nombre') or '').strip()
+        carnet = (request.form.get('carnet') or '').strip()
+        # Por defecto el carnet debe coincidir exacto (sin importar espacios ni mayúsculas);
+        # el personal con sesión puede pedir búsqueda aproximada por subcadena
+        aproximada = bool(session.get('logged_in') and request.form.get('aproximada'))
         
         # Query mejorada para obtener más información y el ID de pruebas_paciente
         query = '''
@@ -827,39 +959,46 @@ def informacion():
         FROM patients p
         JOIN pruebas_paciente pp ON p.id = pp.patient_id
         JOIN pruebas t ON pp.test_id = t.id
-        WHERE p.name LIKE ? AND p.identification_number LIKE ?
+        WHERE {condicion}
         ORDER BY pp.test_date DESC
         '''
-        params = [f'%{nombre}%', f'%{carnet}%']
+        if aproximada:
+            condicion, params = filtro_pacientes(nombre=nombre, carnet=carnet)
+        elif normalizar_carnet(carnet):
+            condicion, params = filtro_carnet_exacto(carnet)
+            if nombre:
+                # El nombre solo confirma. El índice único es sobre el carnet tal como se
+                # escribió, así que '12 34' y '1234' pueden ser dos pacientes distintos
+                condicion += ' AND p.name LIKE ?'
+                params.append(f'%{nombre}%')
+        else:
+            condicion, params = None, []
         
-        pruebas_completas = conn.execute(query, params).fetchall()
-        resultados = [dict(row) for row in pruebas_completas]
-        conn.close()
+        if condicion is not None:
+            # La clave es la consulta misma: en modo aproximado los términos van tal cual
+            # (LIKE sobre el carnet original), y LIKE solo ignora mayúsculas en ASCII
+            clave = (condicion, tuple(params), versiones.version(conn))
+            pruebas_completas = consultas_publicas.get_or_set(
+                clave, lambda: conn.execute(query.format(condicion=condicion), params).fetchall()
+            )
+            resultados = [dict(row) for row in pruebas_completas]
         
         return render_template('informacion.html', 
                              resultados=resultados,
                              pruebas_completas=pruebas_completas,
                              nombre_busqueda=nombre,
                              carnet_busqueda=carnet,
+                             aproximada=aproximada,
                              is_public=True)
     
-        conn.close()
     return render_template('informacion.html', is_public=True)
 
 def export_to_excel_func():
     conn = get_db_connection()
-    pacientes = pd.read_sql_query('SELECT * FROM patients', conn)
-    pruebas = pd.read_sql_query('SELECT * FROM pruebas_paciente', conn)
-    conn.close()
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        pacientes.to_excel(writer, sheet_name='Pacientes', index=False)
-        pruebas.to_excel(writer, sheet_name='Pruebas', index=False)
-    output.seek(0)
-    response = make_response(output.read())
-    response.headers["Content-Disposition"] = "attachment; filename=informes_detalle.xlsx"
-    response.headers["Content-type"] = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    return response
+    return exports.respuesta_xlsx(conn, [
+        ('Pacientes', 'SELECT * FROM patients', []),
+        ('Pruebas', 'SELECT id, patient_id, test_id, test_date, result, result_date, laboratory FROM pruebas_paciente', []),
+    ], 'informes_detalle.xlsx')
 
 def exportar_pdf(resultados):
     pdf = FPDF()
@@ -889,12 +1028,7 @@ def exportar_pdf(resultados):
     buffer.seek(0)
     return send_file(buffer, as_attachment=True, download_name='informe_pruebas.pdf', mimetype='application/pdf')
 
-def generar_reporte_prueba_pdf(prueba_id):
-    """Genera un PDF profesional para una prueba específica de un paciente"""
-    conn = get_db_connection()
-    
-    # Obtener información completa de la prueba
-    prueba_data = conn.execute('''
+CONSULTA_REPORTE = '''
         SELECT 
             pp.id AS prueba_id,
             pp.test_date,
@@ -917,10 +1051,27 @@ def generar_reporte_prueba_pdf(prueba_id):
         FROM pruebas_paciente pp
         JOIN patients p ON pp.patient_id = p.id
         JOIN pruebas t ON pp.test_id = t.id
-        WHERE pp.id = ?
-    ''', (prueba_id,)).fetchone()
-    
-    conn.close()
+'''
+
+def obtener_datos_reporte(prueba_id):
+    """Obtiene en una sola consulta todos los datos del reporte de una prueba (None si no existe)"""
+    conn = get_db_connection()
+    return conn.execute(CONSULTA_REPORTE + ' WHERE pp.id = ?', (prueba_id,)).fetchone()
+
+def generar_reporte_prueba_pdf_bytes(prueba_id, prueba_data):
+    """Versión para el pool de procesos: recibe los datos ya consultados y devuelve los bytes del PDF"""
+    return generar_reporte_prueba_pdf(prueba_id, prueba_data).getvalue()
+
+def nombre_archivo_reporte(prueba_data):
+    """Nombre del archivo: NombrePaciente_FechaPrueba_NombrePrueba.pdf"""
+    nombre_archivo = f"{prueba_data['patient_name'].replace(' ', '_')}_{prueba_data['test_date']}_{prueba_data['test_name'].replace(' ', '_')}.pdf"
+    return nombre_archivo.replace('/', '_')  # Reemplazar / en fechas
+
+@metricas.cronometrar('pdf_prueba')
+def generar_reporte_prueba_pdf(prueba_id, prueba_data=None):
+    """Genera un PDF profesional para una prueba específica de un paciente"""
+    if prueba_data is None:
+        prueba_data = obtener_datos_reporte(prueba_id)
     
     if not prueba_data:
         return None
@@ -1029,11 +1180,11 @@ def generar_reporte_prueba_pdf(prueba_id):
     
     return buffer
 
+@metricas.cronometrar('pdf_pacientes')
 def generar_pdf_pacientes_detallado():
     """Genera un PDF detallado con todos los pacientes en formato horizontal"""
     conn = get_db_connection()
     pacientes = conn.execute('SELECT * FROM patients ORDER BY name').fetchall()
-    conn.close()
     
     pdf = FPDF(orientation='L')  # Landscape (horizontal)
     pdf.add_page()
@@ -1138,6 +1289,7 @@ def generar_pdf_pacientes_detallado():
     buffer.seek(0)
     return buffer
 
+@metricas.cronometrar('pdf_pruebas')
 def generar_pdf_pruebas_detallado():
     """Genera un PDF detallado con todas las pruebas de pacientes en formato horizontal"""
     conn = get_db_connection()
@@ -1159,7 +1311,6 @@ def generar_pdf_pruebas_detallado():
         JOIN pruebas t ON pp.test_id = t.id
         ORDER BY pp.test_date DESC
     ''').fetchall()
-    conn.close()
     
     pdf = FPDF(orientation='L')  # Landscape (horizontal)
     pdf.add_page()
@@ -1285,15 +1436,11 @@ def exportar_pacientes_pdf():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
     
-    buffer = generar_pdf_pacientes_detallado()
+    # Se genera en el pool de procesos; la petición responde de inmediato con la página de estado
     nombre_archivo = f"reporte_pacientes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-    
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=nombre_archivo,
-        mimetype='application/pdf'
-    )
+    trabajo_id = cola_trabajos.enviar(get_db_connection(), 'pdf_pacientes', generar_pdf_pacientes_detallado,
+                                      nombre_archivo, 'application/pdf', session.get('username'))
+    return redirect(url_for('ver_trabajo', trabajo_id=trabajo_id))
 
 @app.route('/exportar_pruebas_pdf')
 def exportar_pruebas_pdf():
@@ -1301,14 +1448,55 @@ def exportar_pruebas_pdf():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
     
-    buffer = generar_pdf_pruebas_detallado()
     nombre_archivo = f"reporte_pruebas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+    trabajo_id = cola_trabajos.enviar(get_db_connection(), 'pdf_pruebas', generar_pdf_pruebas_detallado,
+                                      nombre_archivo, 'application/pdf', session.get('username'))
+    return redirect(url_for('ver_trabajo', trabajo_id=trabajo_id))
+
+@app.route('/trabajos/<trabajo_id>')
+def ver_trabajo(trabajo_id):
+    """Página de estado de un reporte en segundo plano (se recarga sola hasta que termina)"""
+    if 'logged_in' not in session:
+        return redirect(url_for('login'))
     
+    trabajo = cola_trabajos.obtener(get_db_connection(), trabajo_id)
+    if trabajo is None:
+        abort(404)
+    return render_template('trabajo.html', trabajo=trabajo)
+
+@app.route('/trabajos/<trabajo_id>/estado')
+def estado_trabajo(trabajo_id):
+    """Estado del trabajo en JSON"""
+    if 'logged_in' not in session:
+        return redirect(url_for('login'))
+    
+    trabajo = cola_trabajos.obtener(get_db_connection(), trabajo_id)
+    if trabajo is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify({
+        'id': trabajo['id'],
+        'tipo': trabajo['tipo'],
+        'estado': trabajo['estado'],
+        'creado': trabajo['creado'],
+        'terminado': trabajo['terminado'],
+        'descarga': url_for('descargar_trabajo', trabajo_id=trabajo_id) if trabajo['estado'] == jobs.TERMINADO else None
+    })
+
+@app.route('/trabajos/<trabajo_id>/descargar')
+def descargar_trabajo(trabajo_id):
+    """Descarga el archivo generado por un trabajo terminado"""
+    if 'logged_in' not in session:
+        return redirect(url_for('login'))
+    
+    trabajo = cola_trabajos.obtener(get_db_connection(), trabajo_id)
+    ruta = cola_trabajos.ruta_resultado(trabajo)
+    if ruta is None:
+        return "El reporte no está disponible", 404
     return send_file(
-        buffer,
+        ruta,
         as_attachment=True,
-        download_name=nombre_archivo,
-        mimetype='application/pdf'
+        download_name=trabajo['nombre_descarga'],
+        mimetype=trabajo['mimetype']
     )
 
 if __name__ == '__main__':
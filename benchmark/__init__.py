@@ -0,0 +1,8 @@
+"""Benchmark de las rutas de la aplicación sobre una base de datos sintética.
+
+    python -m benchmark generar --pacientes 200000 --pruebas 2000000
+    python -m benchmark medir --salida resultados.json
+    python -m benchmark comparar resultados.json
+
+Ver README.md, sección "Benchmark".
+"""
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import sys
+
+from benchmark import comparar, datos, rutas
+
+
+def _generar(args):
+    if args.reemplazar:
+        datos.borrar(args.db)
+    elif os.path.exists(args.db):
+        print(f'{args.db} ya existe; usa --reemplazar para crearla de nuevo')
+        return 2
+    print(f'Generando {args.db}: {args.pacientes} pacientes, {args.pruebas} pruebas (semilla {args.semilla})')
+    datos.generar(args.db, args.pacientes, args.pruebas, args.semilla)
+    return 0
+
+
+def _comparar(resultados, base, umbral):
+    with open(base, encoding='utf-8') as archivo:
+        linea_base = json.load(archivo)
+    try:
+        regresiones = comparar.comparar(resultados, linea_base, umbral)
+    except ValueError as e:
+        print(f'No se puede comparar con {base}: {e}')
+        return 2
+    for nombre, metrica, anterior, actual in regresiones:
+        print(f'REGRESIÓN {nombre}.{metrica}: {anterior} -> {actual}')
+    if not regresiones:
+        print(f'Sin regresiones frente a {base} (umbral {umbral:.0%})')
+    return 1 if regresiones else 0
+
+
+def _medir(args):
+    if not os.path.exists(args.db):
+        print(f'{args.db} no existe; créala con: python -m benchmark generar')
+        return 2
+    print(f'Midiendo sobre {args.db}')
+    resultados = rutas.medir(args.db, args.solo, args.iteraciones, timeout=args.timeout)
+    texto = json.dumps(resultados, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as archivo:
+            archivo.write(texto + '\n')
+        print(f'Resultados guardados en {args.salida}')
+    else:
+        print(texto)
+    if args.base:
+        return _comparar(resultados, args.base, args.umbral)
+    return 0
+
+
+def _comparar_archivo(args):
+    with open(args.resultados, encoding='utf-8') as archivo:
+        resultados = json.load(archivo)
+    return _comparar(resultados, args.base, args.umbral)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark')
+    comandos = parser.add_subparsers(dest='comando', required=True)
+
+    generar = comandos.add_parser('generar', help='crea la base de datos sintética')
+    generar.add_argument('--db', default=datos.BASE_DE_DATOS)
+    generar.add_argument('--pacientes', type=int, default=datos.PACIENTES)
+    generar.add_argument('--pruebas', type=int, default=datos.PRUEBAS)
+    generar.add_argument('--semilla', type=int, default=datos.SEMILLA)
+    generar.add_argument('--reemplazar', action='store_true', help='borra la base si ya existe')
+    generar.set_defaults(funcion=_generar)
+
+    medir = comandos.add_parser('medir', help='mide las rutas y guarda los resultados en JSON')
+    medir.add_argument('--db', default=datos.BASE_DE_DATOS)
+    medir.add_argument('--salida', help='archivo JSON de resultados (por defecto se imprimen)')
+    medir.add_argument('--solo', type=lambda valor: valor.split(','), help='escenarios separados por coma')
+    medir.add_argument('--iteraciones', type=int, help='iteraciones por escenario (cada uno tiene la suya)')
+    medir.add_argument('--timeout', type=int, default=rutas.TIMEOUT_SEGUNDOS, help='segundos por escenario')
+    medir.add_argument('--base', help='compara con esta línea base al terminar')
+    medir.add_argument('--umbral', type=float, default=comparar.UMBRAL)
+    medir.set_defaults(funcion=_medir)
+
+    comparacion = comandos.add_parser('comparar', help='compara resultados con la línea base')
+    comparacion.add_argument('resultados')
+    comparacion.add_argument('--base', default=comparar.LINEA_BASE)
+    comparacion.add_argument('--umbral', type=float, default=comparar.UMBRAL)
+    comparacion.set_defaults(funcion=_comparar_archivo)
+
+    args = parser.parse_args(argv)
+    return args.funcion(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import os
+
+LINEA_BASE = os.path.join(os.path.dirname(__file__), 'linea_base.json')
+UMBRAL = 0.25
+
+# Métricas que se comparan y la diferencia absoluta mínima para considerarla
+# regresión (evita marcar como regresión el ruido en rutas de pocos milisegundos)
+METRICAS = {
+    'p50_ms': 5,
+    'p90_ms': 10,
+    'cache_p50_ms': 5,
+    'consultas_sql': 0,
+    'rss_pico_mb': 20,
+}
+
+
+def comparar(resultados, linea_base, umbral=UMBRAL):
+    """Regresiones de `resultados` frente a `linea_base`.
+
+    Devuelve una lista de (escenario, métrica, valor base, valor actual); una métrica
+    es regresión si supera la base en más de `umbral` (proporción) y en más de su
+    diferencia mínima. Lanza ValueError si las dos mediciones no usan los mismos volúmenes.
+    """
+    if resultados['datos'] != linea_base['datos']:
+        raise ValueError(f"Volúmenes distintos: base {linea_base['datos']}, actual {resultados['datos']}")
+    regresiones = []
+    for nombre, base in linea_base['escenarios'].items():
+        actual = resultados['escenarios'].get(nombre)
+        if actual is None:
+            continue
+        if 'error' in actual and 'error' not in base:
+            regresiones.append((nombre, 'error', None, actual['error']))
+            continue
+        if 'error' in actual or 'error' in base:
+            continue
+        for metrica, minima in METRICAS.items():
+            if base.get(metrica) is None or actual.get(metrica) is None:
+                continue
+            if actual[metrica] > base[metrica] * (1 + umbral) and actual[metrica] - base[metrica] > minima:
+                regresiones.append((nombre, metrica, base[metrica], actual[metrica]))
+    return regresiones
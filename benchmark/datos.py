@@ -0,0 +1,108 @@
+import os
+import random
+from datetime import date, timedelta
+from itertools import islice
+
+from db import connect
+from insert_default_tests import insert_default_tests
+from migrations import migrate
+
+# Base de datos sintética y determinista: la misma semilla y los mismos volúmenes
+# producen exactamente las mismas filas. Las fechas se cuentan hacia atrás desde
+# FECHA_FINAL (no desde hoy) para que el resultado no dependa del día en que se genera.
+BASE_DE_DATOS = os.path.join('instance', 'benchmark.db')
+PACIENTES = 20000
+PRUEBAS = 200000
+SEMILLA = 1
+FECHA_FINAL = date(2025, 12, 31)
+DIAS_HISTORIA = 2 * 365
+TAMANO_LOTE = 50000
+
+NOMBRES = ['Juan', 'María', 'José', 'Ana', 'Luis', 'Carmen', 'Carlos', 'Rosa', 'Jorge', 'Lucía',
+           'Miguel', 'Elena', 'Pedro', 'Sofía', 'Josué', 'Gabriela', 'Diego', 'Patricia', 'Andrés', 'Daniela']
+APELLIDOS = ['Mamani', 'Quispe', 'Flores', 'Choque', 'Condori', 'Rojas', 'Gutiérrez', 'Vargas', 'López',
+             'Fernández', 'Apaza', 'Limachi', 'Ticona', 'Huanca', 'Chávez', 'Torrez', 'Vásquez', 'Cruz']
+ZONAS = ['Sopocachi', 'Miraflores', 'Chasquipampa', 'Obrajes', 'Villa Fátima', 'Achumani',
+         'San Pedro', 'Calacoto', 'Irpavi', 'El Alto']
+LABORATORIOS = ['Laboratorio Central', 'Laboratorio Norte', 'Laboratorio Sur', 'Clínica Obrajes',
+                'Hospital de Clínicas']
+POSITIVIDAD = 0.18
+
+
+def _pacientes(rng, cantidad):
+    carnets = rng.sample(range(1000000, 10000000), cantidad)
+    for carnet in carnets:
+        nacimiento = FECHA_FINAL - timedelta(days=rng.randrange(365, 90 * 365))
+        yield (
+            f'{rng.choice(NOMBRES)} {rng.choice(APELLIDOS)} {rng.choice(APELLIDOS)}',
+            str(carnet),
+            nacimiento.isoformat(),
+            rng.choice(('Masculino', 'Femenino')),
+            f'{rng.choice(ZONAS)} calle {rng.randrange(1, 80)} #{rng.randrange(1, 2000)}',
+            str(rng.randrange(60000000, 80000000)),
+        )
+
+
+def _pruebas(rng, pacientes, cantidad, test_ids):
+    for _ in range(cantidad):
+        fecha = FECHA_FINAL - timedelta(days=rng.randrange(DIAS_HISTORIA))
+        # Casi todos los resultados salen en pocos días; unos pocos tardan semanas
+        demora = min(int(rng.expovariate(0.5)), 60)
+        yield (
+            rng.randrange(1, pacientes + 1),
+            rng.choice(test_ids),
+            fecha.isoformat(),
+            'Positivo' if rng.random() < POSITIVIDAD else 'Negativo',
+            (fecha + timedelta(days=demora)).isoformat(),
+            rng.choice(LABORATORIOS),
+        )
+
+
+def _insertar(conn, sql, filas, nombre, progreso):
+    total = 0
+    while True:
+        lote = list(islice(filas, TAMANO_LOTE))
+        if not lote:
+            break
+        conn.executemany(sql, lote)
+        conn.commit()
+        total += len(lote)
+        progreso(f'  {nombre}: {total}')
+    return total
+
+
+def generar(database=BASE_DE_DATOS, pacientes=PACIENTES, pruebas=PRUEBAS, semilla=SEMILLA, progreso=print):
+    """Crea una base de datos nueva con el esquema actual y los volúmenes pedidos"""
+    if os.path.exists(database):
+        raise FileExistsError(f'{database} ya existe')
+    if os.path.dirname(database):
+        os.makedirs(os.path.dirname(database), exist_ok=True)
+
+    conn = connect(database)
+    migrate(conn)
+    conn.close()
+    insert_default_tests(database)
+
+    conn = connect(database)
+    # Es una base desechable: no hace falta esperar a que cada lote llegue al disco
+    conn.execute('PRAGMA synchronous = OFF')
+    test_ids = [fila['id'] for fila in conn.execute('SELECT id FROM pruebas ORDER BY id')]
+    rng = random.Random(semilla)
+    _insertar(conn, '''
+        INSERT INTO patients (name, identification_number, date_of_birth, gender, address, phone)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', _pacientes(rng, pacientes), 'pacientes', progreso)
+    _insertar(conn, '''
+        INSERT INTO pruebas_paciente (patient_id, test_id, test_date, result, result_date, laboratory)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', _pruebas(rng, pacientes, pruebas, test_ids), 'pruebas', progreso)
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+
+def borrar(database):
+    """Borra la base de datos y sus archivos -wal/-shm"""
+    for sufijo in ('', '-wal', '-shm'):
+        if os.path.exists(database + sufijo):
+            os.remove(database + sufijo)
@@ -0,0 +1,255 @@
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+import warnings
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Cada escenario es (nombre, método, url, datos del formulario, opciones). La url y los
+# datos pueden usar {carnet} y {prueba_id}, que se toman de una muestra de la base en
+# cada iteración para no medir siempre la misma fila ya cacheada.
+# Opciones: 'publico' (sin sesión), 'trabajo' (espera a que termine el trabajo en
+# segundo plano al que redirige), 'iteraciones' (por defecto ITERACIONES).
+#
+# Cada iteración vacía las caches de la aplicación y mide la petición en frío (p50_ms,
+# p90_ms...); luego la repite igual y mide el acierto de cache (cache_p50_ms...). Sin
+# vaciarlas, las rutas que guardan resultados por versión de los datos medirían solo
+# la cache desde la segunda iteración.
+ITERACIONES = 20
+TIMEOUT_SEGUNDOS = 600
+TAMANO_MUESTRA = 200
+ESPERA_CIERRE = 30
+
+ESCENARIOS = [
+    ('admin', 'GET', '/admin', None, {}),
+    ('pacientes', 'GET', '/pacientes', None, {}),
+    ('pruebas_paciente', 'GET', '/pruebas_paciente', None, {}),
+    ('informes', 'GET', '/informes', None, {}),
+    ('informacion', 'POST', '/informacion', {'nombre': '', 'carnet': '{carnet}'}, {'publico': True}),
+    ('informes_exportar_csv', 'POST', '/informes/exportar', {'format': 'csv'}, {'iteraciones': 5}),
+    ('informes_exportar_excel', 'POST', '/informes/exportar', {'format': 'excel'}, {'iteraciones': 3}),
+    ('descargar_reporte', 'GET', '/descargar_reporte/{prueba_id}', None, {'publico': True}),
+    ('exportar_pacientes_pdf', 'GET', '/exportar_pacientes_pdf', None, {'trabajo': True, 'iteraciones': 1}),
+    ('exportar_pruebas_pdf', 'GET', '/exportar_pruebas_pdf', None, {'trabajo': True, 'iteraciones': 1}),
+]
+
+
+def _rss_mb():
+    """Pico de memoria residente del proceso en MB (None si no se puede medir)"""
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KB y macOS en bytes
+    return round(pico / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+
+def muestra(database, semilla, tamano=TAMANO_MUESTRA):
+    """Carnets e ids de pruebas_paciente al azar (siempre los mismos para la misma base y semilla)"""
+    conn = sqlite3.connect(database)
+    try:
+        carnets = [fila[0] for fila in conn.execute('SELECT identification_number FROM patients ORDER BY id')]
+        pruebas = conn.execute('SELECT MIN(id), MAX(id) FROM pruebas_paciente').fetchone()
+    finally:
+        conn.close()
+    rng = random.Random(semilla)
+    return {
+        'carnet': rng.sample(carnets, min(tamano, len(carnets))) or [''],
+        'prueba_id': [rng.randint(pruebas[0], pruebas[1]) for _ in range(tamano)] if pruebas[0] else [0],
+    }
+
+
+def _esperar_trabajo(cliente, respuesta):
+    """Sigue la redirección a /trabajos/<id> y espera a que el trabajo termine"""
+    trabajo_id = respuesta.headers['Location'].rstrip('/').rsplit('/', 1)[-1]
+    while True:
+        estado = cliente.get(f'/trabajos/{trabajo_id}/estado').get_json()
+        if estado['estado'] in ('terminado', 'error'):
+            return estado['estado']
+        time.sleep(0.05)
+
+
+def _vaciar_caches(modulo_app):
+    """Olvida los resultados que guardan las rutas medidas (en memoria y los PDF en disco)"""
+    import versiones
+
+    versiones.resultados.clear()
+    modulo_app.consultas_publicas.clear()
+    for entrada in os.scandir(modulo_app.app.config['PDF_CACHE_DIR']):
+        if entrada.name.endswith('.pdf'):
+            os.remove(entrada.path)
+
+
+def _percentiles(tiempos, prefijo=''):
+    medidos = np.array(tiempos)
+    return {
+        f'{prefijo}p50_ms': round(float(np.percentile(medidos, 50)), 2),
+        f'{prefijo}p90_ms': round(float(np.percentile(medidos, 90)), 2),
+        f'{prefijo}p99_ms': round(float(np.percentile(medidos, 99)), 2),
+        f'{prefijo}max_ms': round(float(medidos.max()), 2),
+    }
+
+
+def _medir(database, directorio, escenario, iteraciones, valores):
+    """Corre un escenario en este proceso (un proceso nuevo por escenario)"""
+    _, metodo, url, datos, opciones = escenario
+    os.environ['FLASK_DATABASE'] = os.path.abspath(database)
+    os.environ['FLASK_JOBS_DIR'] = os.path.join(directorio, 'trabajos')
+    os.environ['FLASK_PDF_CACHE_DIR'] = os.path.join(directorio, 'cache_reportes')
+    os.environ['FLASK_METRICS_DIR'] = os.path.join(directorio, 'metricas')
+    os.environ['FLASK_SLOW_QUERY_LOG'] = os.path.join(directorio, 'consultas_lentas.log')
+    # Sin límite de consultas públicas: se mide la ruta, no el control de admisión
+    os.environ['FLASK_PUBLIC_BURST'] = '1000000000'
+    # fpdf avisa en cada página que reemplaza Arial por Helvetica (aquí y en el pool de trabajos)
+    warnings.simplefilter('ignore', UserWarning)
+    os.environ['PYTHONWARNINGS'] = 'ignore::UserWarning'
+
+    from flask import g
+
+    import app as modulo_app
+
+    app = modulo_app.app
+    consultas = []
+
+    @app.teardown_request
+    def guardar_consultas(exception=None):
+        # La conexión de la petición cuenta sus sentencias (db.Conexion)
+        consultas.append(g.db.sentencias if 'db' in g else 0)
+
+    cliente = app.test_client()
+    if not opciones.get('publico'):
+        cliente.post('/login', data={'username': 'admin', 'password': 'adminarthu'})
+    rss_base = _rss_mb()
+
+    def pedir(url_iteracion, datos_iteracion):
+        """(ms, consultas SQL, estado, bytes) de una petición"""
+        del consultas[:]
+        inicio = time.perf_counter()
+        respuesta = cliente.open(url_iteracion, method=metodo, data=datos_iteracion)
+        cuerpo = respuesta.get_data()
+        estado = str(respuesta.status_code)
+        if opciones.get('trabajo') and respuesta.status_code == 302:
+            estado = _esperar_trabajo(cliente, respuesta)
+        ms = (time.perf_counter() - inicio) * 1000
+        respuesta.close()
+        # Solo cuenta la petición medida, no el sondeo del estado del trabajo
+        return ms, consultas[0] if consultas else 0, estado, len(cuerpo)
+
+    tiempos, consultas_por_peticion = [], []
+    tiempos_cache, consultas_cache = [], []
+    estados = {}
+    bytes_respuesta = 0
+    rng = random.Random(0)
+    for _ in range(iteraciones + 1):
+        elegidos = {clave: rng.choice(lista) for clave, lista in valores.items()}
+        url_iteracion = url.format(**elegidos)
+        datos_iteracion = {k: v.format(**elegidos) for k, v in datos.items()} if datos else None
+        _vaciar_caches(modulo_app)
+        ms, sentencias, estado, bytes_respuesta = pedir(url_iteracion, datos_iteracion)
+        tiempos.append(ms)
+        consultas_por_peticion.append(sentencias)
+        estados[estado] = estados.get(estado, 0) + 1
+        # Los trabajos en segundo plano no se cachean: repetirlos solo duplicaría el tiempo
+        if not opciones.get('trabajo'):
+            ms, sentencias, _, _ = pedir(url_iteracion, datos_iteracion)
+            tiempos_cache.append(ms)
+            consultas_cache.append(sentencias)
+
+    # La primera petición paga imports y plantillas sin compilar; los percentiles son de las siguientes
+    resultado = {
+        'metodo': metodo,
+        'url': url,
+        'iteraciones': iteraciones,
+        'estados': estados,
+        'primera_ms': round(tiempos[0], 2),
+        **_percentiles(tiempos[1:]),
+        'primera_consultas_sql': consultas_por_peticion[0],
+        'consultas_sql': int(np.median(consultas_por_peticion[1:])),
+    }
+    if tiempos_cache:
+        resultado.update(_percentiles(tiempos_cache[1:], 'cache_'))
+        resultado['cache_consultas_sql'] = int(np.median(consultas_cache[1:]))
+    resultado.update({
+        'bytes': bytes_respuesta,
+        'rss_base_mb': rss_base,
+        'rss_pico_mb': _rss_mb(),
+    })
+    return resultado
+
+
+def _medir_en_proceso(conexion, database, *args):
+    try:
+        with tempfile.TemporaryDirectory(prefix='benchmark_', ignore_cleanup_errors=True) as directorio:
+            conexion.send(_medir(database, directorio, *args))
+    except Exception as e:
+        conexion.send({'error': f'{type(e).__name__}: {e}'})
+    finally:
+        conexion.close()
+
+
+def medir(database, escenarios=None, iteraciones=None, semilla=1, timeout=TIMEOUT_SEGUNDOS, progreso=print):
+    """Mide cada escenario en un proceso nuevo y devuelve el informe completo.
+
+    Un proceso por escenario hace que el pico de memoria sea el de esa ruta y que
+    una ruta que se queda sin memoria o excede el timeout no detenga a las demás.
+    """
+    contexto = multiprocessing.get_context('spawn')
+    valores = muestra(database, semilla)
+    conn = sqlite3.connect(database)
+    try:
+        volumen = {
+            'pacientes': conn.execute('SELECT COUNT(*) FROM patients').fetchone()[0],
+            'pruebas_paciente': conn.execute('SELECT COUNT(*) FROM pruebas_paciente').fetchone()[0],
+        }
+    finally:
+        conn.close()
+
+    resultados = {}
+    for escenario in ESCENARIOS:
+        nombre, opciones = escenario[0], escenario[4]
+        if escenarios and nombre not in escenarios:
+            continue
+        repeticiones = iteraciones or opciones.get('iteraciones', ITERACIONES)
+        lector, escritor = contexto.Pipe(duplex=False)
+        proceso = contexto.Process(target=_medir_en_proceso,
+                                   args=(escritor, database, escenario, repeticiones, valores))
+        proceso.start()
+        escritor.close()
+        try:
+            resultado = lector.recv() if lector.poll(timeout) else {'error': f'Excedió {timeout} s'}
+        except EOFError:
+            # El proceso murió sin responder (por ejemplo, el sistema lo mató por memoria)
+            resultado = None
+        finally:
+            # Al salir cierra el pool de procesos de la aplicación; si no termina a tiempo se le corta
+            proceso.join(ESPERA_CIERRE)
+            if proceso.is_alive():
+                proceso.terminate()
+            proceso.join()
+            lector.close()
+        if resultado is None:
+            resultado = {'error': f'El proceso terminó sin resultado (código {proceso.exitcode})'}
+        resultados[nombre] = resultado
+        if 'error' in resultado:
+            progreso(f"  {nombre}: ERROR {resultado['error']}")
+        else:
+            cache = f" (cache p50 {resultado['cache_p50_ms']} ms)" if 'cache_p50_ms' in resultado else ''
+            progreso(f"  {nombre}: p50 {resultado['p50_ms']} ms, p90 {resultado['p90_ms']} ms{cache}, "
+                     f"{resultado['consultas_sql']} consultas, {resultado['rss_pico_mb']} MB")
+
+    return {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'datos': volumen,
+        'escenarios': resultados,
+    }
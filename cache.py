@@ -0,0 +1,55 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheTTL:
+    """Cache LRU en memoria del worker, con caducidad por tiempo.
+
+    Cada worker de gunicorn tiene la suya: las invalidaciones explícitas solo
+    afectan al worker que las hace y el TTL acota cuánto pueden tardar los demás
+    en ver un cambio.
+    """
+
+    _AUSENTE = object()
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave, default=None):
+        with self._lock:
+            entrada = self._datos.get(clave, self._AUSENTE)
+            if entrada is self._AUSENTE:
+                return default
+            valor, expira = entrada
+            if expira < time.monotonic():
+                del self._datos[clave]
+                return default
+            self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (valor, time.monotonic() + self.ttl)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.maxsize:
+                self._datos.popitem(last=False)
+
+    def get_or_set(self, clave, calcular):
+        """Devuelve el valor en cache o lo calcula con `calcular()` y lo guarda"""
+        valor = self.get(clave, self._AUSENTE)
+        if valor is self._AUSENTE:
+            valor = calcular()
+            self.set(clave, valor)
+        return valor
+
+    def invalidate(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
@@ -0,0 +1,199 @@
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import has_request_context, request
+
+import metricas
+
+# Registro de consultas lentas. db.Cursor mide cada sentencia de una petición desde
+# su execute hasta que termina de leerse (fetchall, un fetch vacío, close o cuando
+# el cursor se descarta); si pasa de SLOW_QUERY_MS se anota aquí con la forma de
+# sus parámetros (tipo y largo, nunca los valores: son datos de pacientes), la
+# duración y el endpoint. La primera vez que cada proceso ve una sentencia se
+# guarda también su EXPLAIN QUERY PLAN, marcando los recorridos completos de tabla.
+# El log es JSON por línea. Cada proceso escribe en su propio archivo
+# (consultas_lentas.<pid>.log) y lo rota por tamaño: RotatingFileHandler no se puede
+# compartir entre procesos, porque uno rota el archivo mientras los demás siguen
+# escribiendo en el renombrado. El resumen lee los de todos los procesos; los que ya
+# nadie escribe se borran pasado RETENCION_SEGUNDOS.
+UMBRAL_MS = 100
+MAX_BYTES = 5 * 1024 * 1024
+RESPALDOS = 3
+RETENCION_SEGUNDOS = 7 * 24 * 60 * 60
+MAX_PLANES = 1000
+
+
+def normalizar(sql):
+    return ' '.join(sql.split())
+
+
+def _forma(valor):
+    if valor is None:
+        return 'null'
+    if isinstance(valor, bool):
+        return 'bool'
+    if isinstance(valor, int):
+        return 'int'
+    if isinstance(valor, float):
+        return 'real'
+    if isinstance(valor, str):
+        # Un LIKE que empieza con % no puede usar índices: conviene verlo en el log
+        return f"text({len(valor)}{', %…' if valor.startswith('%') else ''})"
+    if isinstance(valor, (bytes, bytearray, memoryview)):
+        return f'blob({len(valor)})'
+    return type(valor).__name__
+
+
+def formas(parametros):
+    """Tipo (y largo de textos y blobs) de cada parámetro, sin sus valores"""
+    if parametros is None:
+        return None
+    if isinstance(parametros, dict):
+        return {nombre: _forma(valor) for nombre, valor in parametros.items()}
+    return [_forma(valor) for valor in parametros]
+
+
+def escanea_tabla(detalle):
+    """True si una línea del plan recorre una tabla completa (SCAN sin índice)"""
+    return detalle.startswith('SCAN ') and 'INDEX' not in detalle and detalle != 'SCAN CONSTANT ROW'
+
+
+class ConsultasLentas:
+    """Umbral, planes ya vistos por el proceso y los logs rotativos de consultas lentas"""
+
+    def __init__(self, app):
+        self.umbral = app.config['SLOW_QUERY_MS'] / 1000
+        self.ruta = app.config['SLOW_QUERY_LOG']
+        self.max_bytes = app.config['SLOW_QUERY_LOG_BYTES']
+        self.respaldos = app.config['SLOW_QUERY_LOG_BACKUPS']
+        self.retencion = app.config['SLOW_QUERY_LOG_RETENTION_SECONDS']
+        self._planes = {}
+        self._lock = threading.Lock()
+        self._log = None
+        self._log_pid = None
+        if os.path.dirname(self.ruta):
+            os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+        self.limpiar_vencidos()
+
+    def ruta_proceso(self, pid=None):
+        """Log del proceso: consultas_lentas.log -> consultas_lentas.<pid>.log"""
+        raiz, extension = os.path.splitext(self.ruta)
+        return f'{raiz}.{os.getpid() if pid is None else pid}{extension}'
+
+    def _logger(self):
+        # Se crea en el proceso que escribe (un fork heredaría el archivo del padre)
+        if self._log_pid != os.getpid():
+            ruta = self.ruta_proceso()
+            log = logging.getLogger(f'consultas_lentas.{ruta}')
+            log.setLevel(logging.INFO)
+            log.propagate = False
+            if not log.handlers:
+                manejador = RotatingFileHandler(ruta, maxBytes=self.max_bytes, backupCount=self.respaldos,
+                                                encoding='utf-8', delay=True)
+                manejador.setFormatter(logging.Formatter('%(message)s'))
+                log.addHandler(manejador)
+            self._log, self._log_pid = log, os.getpid()
+        return self._log
+
+    def _plan(self, conn, sql, parametros):
+        """EXPLAIN QUERY PLAN la primera vez que el proceso ve la sentencia; después None"""
+        with self._lock:
+            if sql in self._planes or len(self._planes) >= MAX_PLANES:
+                return None
+            self._planes[sql] = True
+        try:
+            # El execute de sqlite3.Connection no pasa por db.Cursor: no se mide a sí mismo
+            filas = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, parametros or ()).fetchall()
+        except sqlite3.Error as e:
+            return [f'(sin plan: {e})']
+        return [fila[3] for fila in filas]
+
+    def registrar(self, conn, metodo, sql, parametros, duracion):
+        sql = normalizar(sql)
+        endpoint = (request.endpoint if has_request_context() else None) or 'desconocido'
+        # Un script tiene varias sentencias y EXPLAIN solo admite una
+        plan = None if metodo == 'executescript' else self._plan(conn, sql, parametros)
+        entrada = {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'endpoint': endpoint,
+            'metodo': metodo,
+            'duracion_ms': round(duracion * 1000, 2),
+            'sql': sql,
+            'parametros': formas(parametros),
+        }
+        if plan is not None:
+            entrada['plan'] = plan
+            entrada['escaneo_completo'] = any(escanea_tabla(detalle) for detalle in plan)
+        self._logger().info(json.dumps(entrada, ensure_ascii=False))
+        metricas.registro.sumar('sql_slow_statements_total', (('endpoint', endpoint),))
+
+    def _archivos(self):
+        """Logs y respaldos de todos los procesos (y el log único de versiones anteriores)"""
+        raiz, extension = os.path.splitext(self.ruta)
+        patrones = (glob.escape(raiz) + '.*' + glob.escape(extension) + '*', glob.escape(self.ruta) + '*')
+        return sorted({ruta for patron in patrones for ruta in glob.glob(patron)})
+
+    def limpiar_vencidos(self):
+        """Borra los logs que nadie escribe desde hace más de SLOW_QUERY_LOG_RETENTION_SECONDS
+        (los de procesos que ya terminaron: cada reinicio de un worker cambia el pid)"""
+        limite = time.time() - self.retencion
+        for ruta in self._archivos():
+            try:
+                if os.path.getmtime(ruta) < limite:
+                    os.remove(ruta)
+            except OSError:
+                pass
+
+    def resumen(self):
+        """Consultas lentas de los logs de todos los procesos (incluidos los respaldos)
+        agrupadas por sentencia, de mayor a menor tiempo total"""
+        grupos = {}
+        for ruta in self._archivos():
+            try:
+                with open(ruta, encoding='utf-8') as archivo:
+                    lineas = archivo.readlines()
+            except OSError:
+                continue
+            for linea in lineas:
+                try:
+                    entrada = json.loads(linea)
+                except ValueError:
+                    continue
+                grupo = grupos.get(entrada['sql'])
+                if grupo is None:
+                    grupo = grupos[entrada['sql']] = {
+                        'sql': entrada['sql'], 'veces': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                        'endpoints': set(), 'parametros': entrada['parametros'], 'ultima': entrada['fecha'],
+                        'plan': None, 'escaneo_completo': None,
+                    }
+                grupo['veces'] += 1
+                grupo['total_ms'] += entrada['duracion_ms']
+                grupo['max_ms'] = max(grupo['max_ms'], entrada['duracion_ms'])
+                grupo['endpoints'].add(entrada['endpoint'])
+                if entrada['fecha'] > grupo['ultima']:
+                    grupo['ultima'] = entrada['fecha']
+                    grupo['parametros'] = entrada['parametros']
+                if grupo['plan'] is None and 'plan' in entrada:
+                    grupo['plan'] = entrada['plan']
+                    grupo['escaneo_completo'] = entrada['escaneo_completo']
+        for grupo in grupos.values():
+            grupo['promedio_ms'] = round(grupo['total_ms'] / grupo['veces'], 2)
+            grupo['total_ms'] = round(grupo['total_ms'], 2)
+            grupo['endpoints'] = sorted(grupo['endpoints'])
+        return sorted(grupos.values(), key=lambda grupo: grupo['total_ms'], reverse=True)
+
+
+def init_app(app):
+    app.config.setdefault('SLOW_QUERY_MS', UMBRAL_MS)
+    app.config.setdefault('SLOW_QUERY_LOG', os.path.join(app.instance_path, 'consultas_lentas.log'))
+    app.config.setdefault('SLOW_QUERY_LOG_BYTES', MAX_BYTES)
+    app.config.setdefault('SLOW_QUERY_LOG_BACKUPS', RESPALDOS)
+    app.config.setdefault('SLOW_QUERY_LOG_RETENTION_SECONDS', RETENCION_SEGUNDOS)
+    app.extensions['consultas_lentas'] = ConsultasLentas(app)
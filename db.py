@@ -0,0 +1,206 @@
+import os
+import queue
+import sqlite3
+import time
+
+from flask import current_app, g
+
+DATABASE = 'database.db'
+POOL_SIZE = 5
+
+# Pragmas que se aplican una sola vez al abrir cada conexión física.
+# journal_mode=WAL permite lecturas concurrentes mientras otro worker escribe,
+# y busy_timeout hace que SQLite espere en vez de fallar con "database is locked".
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA cache_size = -20000',
+    'PRAGMA temp_store = MEMORY',
+)
+
+# Pools por proceso: gunicorn hace fork de los workers y una conexión
+# SQLite nunca debe compartirse entre procesos.
+_pools = {}
+_pools_pid = None
+
+
+class Cursor(sqlite3.Cursor):
+    """Cursor que, mientras se mide, cuenta las sentencias en su conexión y le suma el tiempo
+    de execute y fetch*.
+
+    Un executemany cuenta como una sentencia. Las filas leídas iterando el cursor
+    (for fila in cursor) no se cronometran. Cada sentencia termina con un fetchall, un
+    fetch vacío, el siguiente execute, close o al descartarse el cursor; si su tiempo
+    acumulado pasa el umbral, se anota en el registro de consultas lentas de la conexión.
+    """
+
+    _sentencia = None
+    _duracion = 0.0
+
+    def _medir(self, metodo, *args):
+        inicio = time.perf_counter()
+        try:
+            return metodo(self, *args)
+        finally:
+            duracion = time.perf_counter() - inicio
+            self.connection.tiempo_sql += duracion
+            self._duracion += duracion
+
+    def _ejecutar(self, metodo, sql, parametros=None):
+        conn = self.connection
+        if not conn.midiendo:
+            return metodo(self, sql) if parametros is None else metodo(self, sql, parametros)
+        self._terminar()
+        conn.sentencias += 1
+        # De un executemany solo se conserva la primera fila si es una lista (no se consume un iterador)
+        if metodo is sqlite3.Cursor.executemany:
+            muestra = parametros[0] if isinstance(parametros, (list, tuple)) and parametros else None
+        else:
+            muestra = parametros
+        self._sentencia = (metodo.__name__, sql, muestra)
+        self._duracion = 0.0
+        if parametros is None:
+            self._medir(metodo, sql)
+        else:
+            self._medir(metodo, sql, parametros)
+        if self.description is None:
+            # No devuelve filas: ya terminó
+            self._terminar()
+        return self
+
+    def _leer(self, metodo, *args):
+        if not self.connection.midiendo:
+            return metodo(self, *args)
+        filas = self._medir(metodo, *args)
+        if not filas or metodo is sqlite3.Cursor.fetchall:
+            self._terminar()
+        return filas
+
+    def _terminar(self):
+        sentencia = self._sentencia
+        if sentencia is None:
+            return
+        self._sentencia = None
+        lentas = self.connection.lentas
+        if lentas is not None and self._duracion >= lentas.umbral:
+            lentas.registrar(self.connection, *sentencia, self._duracion)
+
+    def execute(self, sql, parametros=()):
+        return self._ejecutar(sqlite3.Cursor.execute, sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self._ejecutar(sqlite3.Cursor.executemany, sql, parametros)
+
+    def executescript(self, script):
+        return self._ejecutar(sqlite3.Cursor.executescript, script)
+
+    def fetchone(self):
+        return self._leer(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self._leer(sqlite3.Cursor.fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._leer(sqlite3.Cursor.fetchall)
+
+    def close(self):
+        self._terminar()
+        super().close()
+
+    def __del__(self):
+        if self._sentencia is not None:
+            self._terminar()
+
+
+class Conexion(sqlite3.Connection):
+    """Conexión que, durante una petición, cuenta las sentencias SQL y el tiempo en SQLite (ver metricas.py)"""
+
+    midiendo = False
+    sentencias = 0
+    tiempo_sql = 0.0
+    lentas = None
+
+    def iniciar_medicion(self, lentas=None):
+        """Empieza a medir; `lentas` (consultas_lentas.ConsultasLentas) recibe las sentencias sobre su umbral"""
+        self.sentencias = 0
+        self.tiempo_sql = 0.0
+        self.lentas = lentas
+        self.midiendo = True
+
+    def detener_medicion(self):
+        self.midiendo = False
+        self.lentas = None
+
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+
+def connect(database=DATABASE):
+    """Abre una conexión nueva y configurada (para scripts y procesos fuera de Flask)"""
+    conn = sqlite3.connect(database, check_same_thread=False, factory=Conexion)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _get_pool(database, size):
+    global _pools, _pools_pid
+    if _pools_pid != os.getpid():
+        _pools = {}
+        _pools_pid = os.getpid()
+    pool = _pools.get(database)
+    if pool is None:
+        pool = _pools[database] = queue.LifoQueue(maxsize=size)
+    return pool
+
+
+def acquire(database=DATABASE, size=POOL_SIZE):
+    """Toma una conexión del pool del worker o abre una nueva si está vacío"""
+    try:
+        return _get_pool(database, size).get_nowait()
+    except queue.Empty:
+        return connect(database)
+
+
+def release(conn, database=DATABASE, size=POOL_SIZE):
+    """Devuelve la conexión al pool; si está lleno o la conexión quedó inservible, la cierra"""
+    try:
+        conn.detener_medicion()
+        if conn.in_transaction:
+            conn.rollback()
+        _get_pool(database, size).put_nowait(conn)
+    except (sqlite3.Error, queue.Full):
+        conn.close()
+
+
+def get_db_connection():
+    """Conexión de la petición actual; se reutiliza dentro de la misma petición"""
+    if 'db' not in g:
+        g.db = acquire(current_app.config['DATABASE'], current_app.config['DB_POOL_SIZE'])
+        g.db.iniciar_medicion(current_app.extensions.get('consultas_lentas'))
+    return g.db
+
+
+def close_db(exception=None):
+    """Devuelve la conexión al pool al terminar el contexto, incluso si hubo un error"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        release(conn, current_app.config['DATABASE'], current_app.config['DB_POOL_SIZE'])
+
+
+def init_app(app):
+    app.config.setdefault('DATABASE', DATABASE)
+    app.config.setdefault('DB_POOL_SIZE', POOL_SIZE)
+    app.teardown_appcontext(close_db)
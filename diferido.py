@@ -0,0 +1,119 @@
+import resumen
+import versiones
+from search import filtro_pacientes
+
+# Filas leídas de SQLite por cada fetchmany() al iterar
+TAMANO_LOTE = 500
+
+# Tablas de las que dependen las dos tablas de los informes (para versiones.resultados)
+TABLAS_PACIENTES = ('patients',)
+TABLAS_PRUEBAS = ('pruebas_paciente', 'patients', 'pruebas')
+
+COLUMNAS_PRUEBAS = '''
+    SELECT pp.id, p.name AS patient_name, t.name AS test_name, t.code, pp.test_date, pp.result, pp.result_date, pp.laboratory
+    FROM pruebas_paciente pp
+    JOIN patients p ON pp.patient_id = p.id
+    JOIN pruebas t ON pp.test_id = t.id
+'''
+
+
+class ConsultaDiferida:
+    """Resultado de un SELECT que no se ejecuta hasta que la plantilla lo usa.
+
+    Iterarla ejecuta la consulta y entrega las filas por lotes con fetchmany, hasta
+    `limite`. len() (el filtro |length) usa `total()` si se indica; si no, cuenta
+    como mucho limite + 1 filas, así que contar cuesta lo mismo que mostrar y
+    `exacta` dice si el número es el total real. Lo que la plantilla no usa no se
+    consulta. Con `tablas`, las filas y la cuenta se guardan en versiones.resultados
+    hasta que cambien los datos de esas tablas.
+    """
+
+    def __init__(self, conn, query, params=(), limite=None, total=None, tablas=None):
+        self.conn = conn
+        self.query = query
+        self.params = list(params)
+        self.limite = limite
+        self.tablas = tablas
+        self._total = total
+        self._cantidad = None
+
+    def _en_cache(self, tipo, calcular):
+        if self.tablas is None:
+            return calcular()
+        clave = (tipo, self.query, tuple(self.params), self.limite)
+        return versiones.resultados.obtener(self.conn, self.tablas, clave, calcular)
+
+    def __iter__(self):
+        if self.tablas is None:
+            yield from self._filas()
+        else:
+            yield from self._en_cache('filas', lambda: list(self._filas()))
+
+    def _filas(self):
+        query, params = self.query, self.params
+        if self.limite is not None:
+            query, params = query + ' LIMIT ?', params + [self.limite]
+        cursor = self.conn.execute(query, params)
+        try:
+            while True:
+                filas = cursor.fetchmany(TAMANO_LOTE)
+                if not filas:
+                    break
+                yield from filas
+        finally:
+            cursor.close()
+
+    def __len__(self):
+        if self._cantidad is None:
+            if self._total is not None:
+                self._cantidad = self._total()
+            else:
+                self._cantidad = self._en_cache('cantidad', self._contar)
+        return self._cantidad
+
+    def _contar(self):
+        if self.limite is not None:
+            return self.conn.execute(f'SELECT COUNT(*) FROM ({self.query} LIMIT ?)',
+                                     self.params + [self.limite + 1]).fetchone()[0]
+        return self.conn.execute(f'SELECT COUNT(*) FROM ({self.query})', self.params).fetchone()[0]
+
+    def __bool__(self):
+        if self._cantidad is not None:
+            return self._cantidad > 0
+        return self.conn.execute(f'SELECT 1 FROM ({self.query}) LIMIT 1', self.params).fetchone() is not None
+
+    @property
+    def recortada(self):
+        """True si hay más filas de las que se muestran"""
+        return self.limite is not None and len(self) > self.limite
+
+    @property
+    def exacta(self):
+        """True si len() es el total real y no solo 'más de limite'"""
+        return self._total is not None or not self.recortada
+
+
+def tablas_informe(conn, texto=None, limite=None, buscar_tipo_prueba=False):
+    """Pacientes y pruebas de los informes como ConsultaDiferida, filtrados por `texto`.
+
+    Sin filtro los totales salen de los contadores de resumen. Con
+    `buscar_tipo_prueba` también entran las pruebas cuyo tipo coincide con el texto.
+    """
+    if not texto:
+        return {
+            'pacientes': ConsultaDiferida(conn, 'SELECT * FROM patients', limite=limite,
+                                          total=lambda: resumen.total(conn, 'patients'), tablas=TABLAS_PACIENTES),
+            'pruebas': ConsultaDiferida(conn, COLUMNAS_PRUEBAS, limite=limite,
+                                        total=lambda: resumen.total(conn, 'pruebas_paciente'), tablas=TABLAS_PRUEBAS),
+        }
+    condicion, params = filtro_pacientes(texto=texto)
+    query_pruebas = COLUMNAS_PRUEBAS + ' WHERE (' + condicion + ')'
+    params_pruebas = list(params)
+    if buscar_tipo_prueba:
+        query_pruebas += ' OR t.name LIKE ?'
+        params_pruebas.append('%' + texto + '%')
+    return {
+        'pacientes': ConsultaDiferida(conn, 'SELECT * FROM patients p WHERE ' + condicion, params, limite=limite,
+                                      tablas=TABLAS_PACIENTES),
+        'pruebas': ConsultaDiferida(conn, query_pruebas, params_pruebas, limite=limite, tablas=TABLAS_PRUEBAS),
+    }
@@ -0,0 +1,73 @@
+import sys
+
+from db import DATABASE, connect
+
+# Pacientes que comparten identification_number. La migración 6 (índice único del carnet)
+# no se aplica mientras existan: dos registros con el mismo carnet pueden ser la misma
+# persona cargada dos veces o dos personas con un carnet mal escrito, y eso solo lo puede
+# decidir alguien revisando los datos. Uso:
+#
+#   python duplicados.py [database]                                   lista los carnets repetidos
+#   python duplicados.py fusionar <id_conservar> <id_duplicado> [database]
+#
+# Si no son la misma persona, corrige el carnet desde /editar_paciente/<id>.
+
+
+def carnets_duplicados(conn):
+    """Lista de (carnet, [ids de paciente]) de los carnets con más de un paciente"""
+    filas = conn.execute('''
+        SELECT identification_number, group_concat(id) AS ids
+        FROM patients
+        GROUP BY identification_number
+        HAVING COUNT(*) > 1
+        ORDER BY identification_number
+    ''').fetchall()
+    return [(fila['identification_number'], [int(i) for i in fila['ids'].split(',')]) for fila in filas]
+
+
+def fusionar(conn, conservar_id, duplicado_id):
+    """Pasa las pruebas de `duplicado_id` a `conservar_id` y borra el duplicado.
+
+    Solo fusiona pacientes con el mismo carnet; devuelve la cantidad de pruebas movidas.
+    """
+    carnets = {
+        fila['id']: fila['identification_number']
+        for fila in conn.execute('SELECT id, identification_number FROM patients WHERE id IN (?, ?)',
+                                 (conservar_id, duplicado_id))
+    }
+    if conservar_id == duplicado_id or len(carnets) != 2:
+        raise ValueError('Indica dos pacientes distintos que existan')
+    if carnets[conservar_id] != carnets[duplicado_id]:
+        raise ValueError(f'Los pacientes {conservar_id} y {duplicado_id} no tienen el mismo carnet')
+    movidas = conn.execute('UPDATE pruebas_paciente SET patient_id = ? WHERE patient_id = ?',
+                           (conservar_id, duplicado_id)).rowcount
+    conn.execute('DELETE FROM patients WHERE id = ?', (duplicado_id,))
+    return movidas
+
+
+if __name__ == '__main__':
+    argumentos = sys.argv[1:]
+    if argumentos[:1] == ['fusionar']:
+        if len(argumentos) not in (3, 4):
+            sys.exit('Uso: python duplicados.py fusionar <id_conservar> <id_duplicado> [database]')
+        conn = connect(argumentos[3] if len(argumentos) == 4 else DATABASE)
+        try:
+            movidas = fusionar(conn, int(argumentos[1]), int(argumentos[2]))
+        except ValueError as e:
+            sys.exit(str(e))
+        conn.commit()
+        print(f'Paciente {argumentos[2]} fusionado en {argumentos[1]}: {movidas} prueba(s) movida(s)')
+    else:
+        conn = connect(argumentos[0] if argumentos else DATABASE)
+        duplicados = carnets_duplicados(conn)
+        for carnet, ids in duplicados:
+            print(f'Carnet {carnet}:')
+            for fila in conn.execute(f'''
+                SELECT p.id, p.name, p.date_of_birth, COUNT(pp.id) AS pruebas
+                FROM patients p LEFT JOIN pruebas_paciente pp ON pp.patient_id = p.id
+                WHERE p.id IN ({', '.join('?' for _ in ids)})
+                GROUP BY p.id
+            ''', ids):
+                print(f"  id={fila['id']} {fila['name']} (nacimiento {fila['date_of_birth']}, {fila['pruebas']} prueba(s))")
+        print(f'{len(duplicados)} carnet(s) repetido(s)')
+    conn.close()
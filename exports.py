@@ -0,0 +1,235 @@
+import csv
+import io
+import os
+import tempfile
+import zipfile
+from io import StringIO
+
+import xlsxwriter
+from flask import current_app, send_file
+
+import fechas
+import jobs
+import metricas
+from db import connect
+
+# Filas leídas de SQLite por cada fetchmany(); también es el tamaño de cada trozo enviado
+TAMANO_LOTE = 1000
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Ancho (en caracteres) de las columnas conocidas en las hojas de Excel
+ANCHOS_COLUMNA = {
+    'id': 8,
+    'patient_id': 10,
+    'test_id': 8,
+    'name': 30,
+    'patient_name': 30,
+    'test_name': 16,
+    'identification_number': 18,
+    'address': 40,
+    'laboratory': 24,
+    'result': 12,
+}
+ANCHO_POR_DEFECTO = 14
+
+# Columnas de la exportación de pruebas (mismo orden que el antiguo pruebas_paciente.* + nombres)
+COLUMNAS_PRUEBAS = [
+    ('id', 'pp.id'),
+    ('patient_id', 'pp.patient_id'),
+    ('test_id', 'pp.test_id'),
+    ('test_date', 'pp.test_date'),
+    ('result', 'pp.result'),
+    ('result_date', 'pp.result_date'),
+    ('laboratory', 'pp.laboratory'),
+    ('patient_name', 'p.name'),
+    ('test_name', 't.name'),
+]
+
+
+def consulta_pruebas(fecha_desde=None, fecha_hasta=None, tipo_prueba=None, laboratorio=None):
+    """SELECT de pruebas_paciente con nombres de paciente y prueba, con filtros opcionales.
+
+    Devuelve (query, params, encabezados). El rango de fechas se filtra sobre el
+    índice de test_date_day; ValueError si alguna fecha no es válida.
+    """
+    columnas = ', '.join(f'{expresion} AS {nombre}' for nombre, expresion in COLUMNAS_PRUEBAS)
+    query = f'''
+        SELECT {columnas}
+        FROM pruebas_paciente pp
+        JOIN patients p ON pp.patient_id = p.id
+        JOIN pruebas t ON pp.test_id = t.id
+        WHERE 1=1
+    '''
+    condiciones, params = fechas.filtro_rango('pp.test_date_day', fecha_desde, fecha_hasta)
+    for condicion in condiciones:
+        query += ' AND ' + condicion
+    if tipo_prueba:
+        query += ' AND t.name = ?'
+        params.append(tipo_prueba)
+    if laboratorio:
+        query += ' AND pp.laboratory = ?'
+        params.append(laboratorio)
+    return query, params, [nombre for nombre, _ in COLUMNAS_PRUEBAS]
+
+
+def filtros_exportacion(form):
+    """Lee los filtros opcionales de exportación del formulario"""
+    return {
+        'fecha_desde': form.get('fecha_desde') or None,
+        'fecha_hasta': form.get('fecha_hasta') or None,
+        'tipo_prueba': form.get('tipo_prueba') or None,
+        'laboratorio': form.get('laboratorio') or None,
+    }
+
+
+def generar_csv(conn, query, params, encabezados, tamano_lote=TAMANO_LOTE):
+    """Genera el CSV por trozos directamente desde el cursor.
+
+    La memoria usada no depende del tamaño del resultado: solo se guarda un lote
+    de filas a la vez, y el encabezado se envía antes de ejecutar la consulta.
+    """
+    with metricas.cronometrar('csv'):
+        buffer = StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(encabezados)
+        yield buffer.getvalue()
+
+        cursor = conn.execute(query, params)
+        try:
+            while True:
+                filas = cursor.fetchmany(tamano_lote)
+                if not filas:
+                    break
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerows(filas)
+                yield buffer.getvalue()
+        finally:
+            cursor.close()
+
+
+@metricas.cronometrar('xlsx')
+def escribir_xlsx(conn, hojas, destino):
+    """Escribe un libro de Excel leyendo cada hoja directamente del cursor.
+
+    `hojas` es una lista de (nombre_hoja, query, params). Los encabezados salen de
+    cursor.description. Con constant_memory xlsxwriter vuelca cada fila a disco en
+    cuanto se termina, así que la memoria no crece con la cantidad de filas.
+    """
+    workbook = xlsxwriter.Workbook(destino, {'constant_memory': True})
+    negrita = workbook.add_format({'bold': True, 'border': 1})
+    try:
+        for nombre_hoja, query, params in hojas:
+            worksheet = workbook.add_worksheet(nombre_hoja)
+            cursor = conn.execute(query, params)
+            encabezados = [columna[0] for columna in cursor.description]
+            # Anchos y encabezado una sola vez, antes de las filas
+            for indice, encabezado in enumerate(encabezados):
+                worksheet.set_column(indice, indice, ANCHOS_COLUMNA.get(encabezado, ANCHO_POR_DEFECTO))
+                worksheet.write_string(0, indice, encabezado, negrita)
+            worksheet.freeze_panes(1, 0)
+
+            write_number = worksheet.write_number
+            write_string = worksheet.write_string
+            fila_excel = 1
+            while True:
+                filas = cursor.fetchmany(TAMANO_LOTE)
+                if not filas:
+                    break
+                for fila in filas:
+                    for indice, valor in enumerate(fila):
+                        if valor is None:
+                            continue
+                        if isinstance(valor, (int, float)):
+                            write_number(fila_excel, indice, valor)
+                        else:
+                            write_string(fila_excel, indice, str(valor))
+                    fila_excel += 1
+            cursor.close()
+    finally:
+        workbook.close()
+
+
+def escribir_xlsx_en_archivo(database, hojas, ruta):
+    """Versión para el pool de procesos: abre su propia conexión y escribe el libro en `ruta`"""
+    conn = connect(database)
+    try:
+        escribir_xlsx(conn, hojas, ruta)
+    finally:
+        conn.close()
+
+
+def respuesta_xlsx(conn, hojas, nombre_archivo):
+    """Genera el libro en el pool de procesos (ColaTrabajos.ejecutar) y lo envía por partes.
+
+    El archivo temporal se borra al cerrarse, cuando termina la respuesta. Puede lanzar
+    jobs.PoolOcupado o jobs.TiempoAgotado.
+    """
+    cola = current_app.extensions['trabajos']
+    descriptor, ruta = tempfile.mkstemp(suffix='.xlsx', dir=cola.directorio)
+    os.close(descriptor)
+    try:
+        if cola.en_pool:
+            cola.ejecutar(escribir_xlsx_en_archivo, current_app.config['DATABASE'], hojas, ruta)
+        else:
+            escribir_xlsx(conn, hojas, ruta)
+        archivo = _ArchivoTemporal(ruta)
+    except jobs.TiempoAgotado as e:
+        # El proceso sigue escribiendo el libro: se borra cuando termine
+        e.futuro.add_done_callback(lambda _: _borrar(ruta))
+        raise
+    except Exception:
+        _borrar(ruta)
+        raise
+    return send_file(archivo, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=nombre_archivo)
+
+
+def _borrar(ruta):
+    try:
+        os.remove(ruta)
+    except FileNotFoundError:
+        pass
+
+
+class _ArchivoTemporal(io.FileIO):
+    """Archivo que se borra del disco al cerrarse, cuando termina de enviarse la respuesta"""
+
+    def close(self):
+        super().close()
+        _borrar(self.name)
+
+
+class _SalidaZip(io.RawIOBase):
+    """Destino de escritura no posicionable: acumula lo escrito hasta que se envía"""
+
+    def __init__(self):
+        self._partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+
+def generar_zip(archivos):
+    """Genera un ZIP por trozos a partir de un iterable de (nombre, bytes).
+
+    Cada archivo se envía en cuanto llega, sin esperar a los demás ni guardar el
+    ZIP completo en memoria. Los PDF ya están comprimidos, así que se guardan sin
+    volver a comprimir (ZIP_STORED).
+    """
+    with metricas.cronometrar('zip'):
+        salida = _SalidaZip()
+        with zipfile.ZipFile(salida, mode='w', compression=zipfile.ZIP_STORED) as archivo_zip:
+            for nombre, contenido in archivos:
+                archivo_zip.writestr(nombre, contenido)
+                yield salida.vaciar()
+        yield salida.vaciar()
@@ -0,0 +1,109 @@
+import sys
+from datetime import date, datetime
+
+from db import DATABASE, connect
+
+# Las fechas se guardan como texto ISO-8601 (AAAA-MM-DD). pruebas_paciente.test_date_day
+# (migración 10) es el número de día juliano de test_date, CAST(julianday(test_date) AS INTEGER),
+# indexado para filtrar por rango de fechas.
+
+FORMATOS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d')
+
+# Diferencia entre date.toordinal() y el día juliano entero de SQLite
+_DESFASE_JULIANO = 1721424
+
+# (tabla, columnas de fecha) que se normalizan
+COLUMNAS_FECHA = [
+    ('patients', ('date_of_birth',)),
+    ('pruebas_paciente', ('test_date', 'result_date')),
+]
+
+
+def normalizar(valor):
+    """Fecha en ISO (AAAA-MM-DD), o None si no se reconoce"""
+    if isinstance(valor, datetime):
+        return valor.date().isoformat()
+    if isinstance(valor, date):
+        return valor.isoformat()
+    texto = str(valor or '').strip()
+    # Fechas con hora ('2025-03-12 10:30:00' o '2025-03-12T10:30'): solo el día
+    if len(texto) > 10 and texto[10] in ' T':
+        texto = texto[:10]
+    for formato in FORMATOS:
+        try:
+            return datetime.strptime(texto, formato).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def dia(valor):
+    """Número de día (igual a test_date_day) de una fecha; ValueError si no es válida"""
+    iso = normalizar(valor)
+    if iso is None:
+        raise ValueError(f"Fecha inválida: '{valor}'")
+    return date.fromisoformat(iso).toordinal() + _DESFASE_JULIANO
+
+
+def filtro_rango(columna_dia, desde=None, hasta=None):
+    """Condiciones SQL sobre una columna de número de día; devuelve (condiciones, params)"""
+    condiciones = []
+    params = []
+    if desde:
+        condiciones.append(f'{columna_dia} >= ?')
+        params.append(dia(desde))
+    if hasta:
+        condiciones.append(f'{columna_dia} <= ?')
+        params.append(dia(hasta))
+    return condiciones, params
+
+
+def fechas_prueba(test_date, result_date):
+    """Normaliza las fechas de una prueba del formulario; devuelve (test_date, result_date, error)"""
+    iso_prueba = normalizar(test_date)
+    iso_resultado = normalizar(result_date)
+    if iso_prueba is None:
+        return None, None, f"Fecha de prueba inválida: '{test_date}'"
+    if iso_resultado is None:
+        return None, None, f"Fecha de resultado inválida: '{result_date}'"
+    if iso_resultado < iso_prueba:
+        return None, None, 'La fecha de resultado no puede ser anterior a la fecha de la prueba'
+    return iso_prueba, iso_resultado, None
+
+
+def normalizar_existentes(conn):
+    """Pasa a ISO las fechas guardadas en otros formatos.
+
+    Devuelve (corregidas, invalidas): la cantidad de valores reescritos y la lista
+    de (tabla, id, columna, valor) que no se pudieron interpretar y quedan igual.
+    """
+    corregidas = 0
+    invalidas = []
+    for tabla, columnas in COLUMNAS_FECHA:
+        for columna in columnas:
+            # Solo se leen las que no tienen ya la forma AAAA-MM-DD válida
+            filas = conn.execute(f'''
+                SELECT id, {columna} FROM {tabla}
+                WHERE date({columna}) IS NULL OR date({columna}) != {columna}
+            ''').fetchall()
+            cambios = []
+            for fila_id, valor in filas:
+                iso = normalizar(valor)
+                if iso is None:
+                    invalidas.append((tabla, fila_id, columna, valor))
+                elif iso != valor:
+                    cambios.append((iso, fila_id))
+            conn.executemany(f'UPDATE {tabla} SET {columna} = ? WHERE id = ?', cambios)
+            corregidas += len(cambios)
+    return corregidas, invalidas
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else DATABASE
+    conn = connect(database)
+    corregidas, invalidas = normalizar_existentes(conn)
+    conn.commit()
+    print(f"Fechas normalizadas: {corregidas}")
+    for tabla, fila_id, columna, valor in invalidas:
+        print(f"  Sin corregir: {tabla}.{columna} id={fila_id} valor={valor!r}")
+    conn.close()
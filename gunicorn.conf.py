@@ -0,0 +1,30 @@
+import multiprocessing
+import os
+
+# Configuración de producción (Procfile: gunicorn -c gunicorn.conf.py app:app).
+#
+# Workers gthread: cada worker atiende varias peticiones a la vez con hilos. Los
+# reportes pesados (XLSX, PDF) corren en el pool de procesos de jobs.py; el hilo que
+# los espera no usa CPU ni retiene el GIL, así que los demás hilos del worker siguen
+# sirviendo páginas mientras tanto. No se usa preload_app: cada worker abre sus
+# conexiones SQLite y su pool de procesos después del fork.
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', max(2, multiprocessing.cpu_count())))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Con gthread el timeout vigila al worker, no a cada petición: un hilo esperando un
+# reporte no lo dispara. El límite por petición es FLASK_JOBS_TIMEOUT_SECONDS.
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Una conexión SQLite por hilo en el pool de cada worker (ver db.py)
+os.environ.setdefault('FLASK_DB_POOL_SIZE', str(threads))
+
+# Cada worker tiene su propio pool de procesos (jobs.py): se reparten las CPUs entre
+# ellos para que el servidor no tenga más procesos de reportes que CPUs
+os.environ.setdefault('FLASK_JOBS_MAX_WORKERS', str(max(1, multiprocessing.cpu_count() // workers)))
+
+# En producción la aplicación está detrás del router de la plataforma (un proxy): la IP
+# del cliente se toma de X-Forwarded-For (ver admision.py)
+os.environ.setdefault('FLASK_PROXY_HOPS', '1')
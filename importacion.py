@@ -0,0 +1,307 @@
+import csv
+import io
+import json
+from itertools import islice
+
+import fechas
+
+# Filas validadas e insertadas por transacción
+TAMANO_LOTE = 5000
+
+# Columnas que debe traer el archivo del laboratorio (en cualquier orden)
+COLUMNAS_RESULTADOS = ['identification_number', 'test_code', 'test_date', 'result', 'result_date', 'laboratory']
+
+# Otros nombres de encabezado que usan los laboratorios
+ALIAS_RESULTADOS = {
+    'carnet': 'identification_number',
+    'ci': 'identification_number',
+    'codigo': 'test_code',
+    'codigo_prueba': 'test_code',
+    'code': 'test_code',
+    'fecha_prueba': 'test_date',
+    'resultado': 'result',
+    'fecha_resultado': 'result_date',
+    'laboratorio': 'laboratory',
+}
+
+# Columnas del archivo de pacientes de una campaña (en cualquier orden)
+COLUMNAS_PACIENTES = ['name', 'identification_number', 'date_of_birth', 'gender', 'address', 'phone']
+
+ALIAS_PACIENTES = {
+    'nombre': 'name',
+    'carnet': 'identification_number',
+    'ci': 'identification_number',
+    'fecha_nacimiento': 'date_of_birth',
+    'sexo': 'gender',
+    'genero': 'gender',
+    'direccion': 'address',
+    'telefono': 'phone',
+}
+
+# Resultado normalizado a lo que guarda el formulario de pruebas_paciente
+RESULTADOS = {
+    'positivo': 'Positivo',
+    'positive': 'Positivo',
+    'negativo': 'Negativo',
+    'negative': 'Negativo',
+}
+
+# Sexo normalizado a las opciones del formulario de pacientes
+SEXOS = {
+    'masculino': 'Masculino',
+    'm': 'Masculino',
+    'femenino': 'Femenino',
+    'f': 'Femenino',
+    'otro': 'Otro',
+}
+
+# Filas rechazadas que se guardan para el reporte (el total se cuenta igual)
+MAX_RECHAZOS_REPORTE = 1000
+
+
+class ErrorImportacion(ValueError):
+    """El archivo no se puede importar (formato o encabezados)"""
+
+
+def _texto(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        # Excel guarda los carnets numéricos como 1234567.0
+        valor = int(valor)
+    return str(valor).strip()
+
+
+def _encabezados(fila, columnas, alias):
+    encabezados = []
+    for valor in fila:
+        nombre = _texto(valor).lower().replace(' ', '_')
+        encabezados.append(alias.get(nombre, nombre))
+    faltantes = [columna for columna in columnas if columna not in encabezados]
+    if faltantes:
+        raise ErrorImportacion(f"Faltan columnas: {', '.join(faltantes)}")
+    return [encabezados.index(columna) for columna in columnas]
+
+
+def leer_filas(archivo, nombre_archivo, columnas, alias):
+    """Genera (numero_fila, valores) del archivo sin cargarlo completo en memoria.
+
+    `valores` sigue el orden de `columnas`. Acepta .csv (UTF-8, con o sin BOM) y .xlsx.
+    """
+    nombre_archivo = (nombre_archivo or '').lower()
+    if nombre_archivo.endswith('.xlsx'):
+        from openpyxl import load_workbook
+        try:
+            libro = load_workbook(archivo, read_only=True, data_only=True)
+        except Exception as e:
+            raise ErrorImportacion(f"No se pudo leer el archivo Excel: {e}")
+        filas = libro.active.iter_rows(values_only=True)
+    elif nombre_archivo.endswith('.csv'):
+        libro = None
+        texto = io.TextIOWrapper(archivo, encoding='utf-8-sig', newline='')
+        muestra = texto.read(4096)
+        texto.seek(0)
+        try:
+            dialecto = csv.Sniffer().sniff(muestra, delimiters=',;\t')
+        except csv.Error:
+            dialecto = csv.excel
+        filas = csv.reader(texto, dialecto)
+    else:
+        raise ErrorImportacion("El archivo debe ser .csv o .xlsx")
+
+    try:
+        encabezado = next(filas, None)
+        if encabezado is None:
+            raise ErrorImportacion("El archivo está vacío")
+        posiciones = _encabezados(encabezado, columnas, alias)
+        for numero_fila, fila in enumerate(filas, start=2):
+            if not any(_texto(valor) for valor in fila):
+                continue
+            yield numero_fila, [fila[posicion] if posicion < len(fila) else None for posicion in posiciones]
+    finally:
+        if libro is not None:
+            libro.close()
+
+
+def mapa_pacientes(conn):
+    """identification_number -> id de paciente (una sola consulta para todo el archivo)"""
+    return {_texto(fila[0]): fila[1] for fila in conn.execute('SELECT identification_number, id FROM patients')}
+
+
+def mapa_pruebas(conn):
+    """Código de prueba (sin distinguir mayúsculas) -> id de prueba"""
+    return {_texto(fila[0]).upper(): fila[1] for fila in conn.execute('SELECT code, id FROM pruebas')}
+
+
+def validar_lote(lote, pacientes, pruebas):
+    """Valida un lote de filas; devuelve (tuplas listas para INSERT, rechazos)"""
+    validas = []
+    rechazos = []
+    for numero_fila, (carnet, codigo, fecha_prueba, resultado, fecha_resultado, laboratorio) in lote:
+        errores = []
+        patient_id = pacientes.get(_texto(carnet))
+        if patient_id is None:
+            errores.append(f"paciente '{_texto(carnet)}' no existe")
+        test_id = pruebas.get(_texto(codigo).upper())
+        if test_id is None:
+            errores.append(f"código de prueba '{_texto(codigo)}' no existe")
+        test_date = fechas.normalizar(fecha_prueba)
+        if test_date is None:
+            errores.append(f"fecha de prueba inválida '{_texto(fecha_prueba)}'")
+        result_date = fechas.normalizar(fecha_resultado)
+        if result_date is None:
+            errores.append(f"fecha de resultado inválida '{_texto(fecha_resultado)}'")
+        elif test_date is not None and result_date < test_date:
+            errores.append("la fecha de resultado es anterior a la de la prueba")
+        result = RESULTADOS.get(_texto(resultado).lower())
+        if result is None:
+            errores.append(f"resultado inválido '{_texto(resultado)}'")
+        laboratory = _texto(laboratorio)
+        if not laboratory:
+            errores.append("falta el laboratorio")
+
+        if errores:
+            rechazos.append((numero_fila, '; '.join(errores)))
+        else:
+            validas.append((patient_id, test_id, test_date, result, result_date, laboratory))
+    return validas, rechazos
+
+
+def _acumular(resumen, lote, rechazos):
+    resumen['leidas'] += len(lote)
+    resumen['rechazadas'] += len(rechazos)
+    espacio = MAX_RECHAZOS_REPORTE - len(resumen['rechazos'])
+    resumen['rechazos'].extend(rechazos[:max(espacio, 0)])
+
+
+def importar_resultados(conn, archivo, nombre_archivo, simular=False, tamano_lote=TAMANO_LOTE):
+    """Importa resultados de laboratorio a pruebas_paciente desde un CSV o XLSX.
+
+    Lee y valida el archivo por lotes; cada lote válido se inserta con un solo
+    executemany en su propia transacción. Con `simular=True` solo valida (no
+    escribe nada) para revisar el reporte de filas rechazadas antes de cargar.
+    Devuelve un diccionario con leidas, insertadas, rechazadas y el detalle de rechazos.
+    """
+    pacientes = mapa_pacientes(conn)
+    pruebas = mapa_pruebas(conn)
+    resumen = {'leidas': 0, 'insertadas': 0, 'rechazadas': 0, 'rechazos': [], 'simulacion': simular}
+
+    filas = leer_filas(archivo, nombre_archivo, COLUMNAS_RESULTADOS, ALIAS_RESULTADOS)
+    while True:
+        lote = list(islice(filas, tamano_lote))
+        if not lote:
+            break
+        validas, rechazos = validar_lote(lote, pacientes, pruebas)
+        _acumular(resumen, lote, rechazos)
+        if simular or not validas:
+            continue
+        conn.commit()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('''
+                INSERT INTO pruebas_paciente
+                (patient_id, test_id, test_date, result, result_date, laboratory)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', validas)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        resumen['insertadas'] += len(validas)
+    return resumen
+
+
+def validar_pacientes(lote, vistos):
+    """Valida un lote de pacientes; devuelve ({carnet: fila lista para guardar}, rechazos).
+
+    `vistos` (carnet -> número de fila) se comparte entre lotes para detectar
+    carnets repetidos dentro del mismo archivo: se queda la primera aparición.
+    """
+    validos = {}
+    rechazos = []
+    for numero_fila, (nombre, carnet, fecha_nacimiento, sexo, direccion, telefono) in lote:
+        errores = []
+        identification_number = _texto(carnet)
+        name = ' '.join(_texto(nombre).split())
+        if not identification_number:
+            errores.append("falta el número de identificación")
+        elif identification_number in vistos:
+            errores.append(f"carnet '{identification_number}' repetido (fila {vistos[identification_number]})")
+        if not name:
+            errores.append("falta el nombre")
+        date_of_birth = fechas.normalizar(fecha_nacimiento)
+        if date_of_birth is None:
+            errores.append(f"fecha de nacimiento inválida '{_texto(fecha_nacimiento)}'")
+        gender = SEXOS.get(_texto(sexo).lower())
+        if gender is None:
+            errores.append(f"sexo inválido '{_texto(sexo)}'")
+
+        if errores:
+            rechazos.append((numero_fila, '; '.join(errores)))
+            continue
+        vistos[identification_number] = numero_fila
+        validos[identification_number] = (name, identification_number, date_of_birth, gender,
+                                          _texto(direccion), _texto(telefono))
+    return validos, rechazos
+
+
+def importar_pacientes(conn, archivo, nombre_archivo, simular=False, tamano_lote=TAMANO_LOTE):
+    """Alta o actualización masiva de pacientes desde un CSV o XLSX, por carnet.
+
+    Por cada lote se consultan de una vez los pacientes que ya existen con esos
+    carnets; solo se escriben los nuevos y los que cambiaron, con un único
+    INSERT ... ON CONFLICT DO UPDATE (executemany) por transacción. Devuelve un
+    diccionario con leidas, insertadas, actualizadas, sin_cambios, rechazadas y el
+    detalle de rechazos. Con `simular=True` no escribe nada.
+    """
+    resumen = {'leidas': 0, 'insertadas': 0, 'actualizadas': 0, 'sin_cambios': 0,
+               'rechazadas': 0, 'rechazos': [], 'simulacion': simular}
+    vistos = {}
+
+    filas = leer_filas(archivo, nombre_archivo, COLUMNAS_PACIENTES, ALIAS_PACIENTES)
+    while True:
+        lote = list(islice(filas, tamano_lote))
+        if not lote:
+            break
+        validos, rechazos = validar_pacientes(lote, vistos)
+        _acumular(resumen, lote, rechazos)
+
+        existentes = {
+            fila[1]: tuple(fila) for fila in conn.execute('''
+                SELECT name, identification_number, date_of_birth, gender, address, phone
+                FROM patients
+                WHERE identification_number IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(list(validos)),))
+        }
+        cambios = []
+        for carnet, fila in validos.items():
+            actual = existentes.get(carnet)
+            if actual is None:
+                resumen['insertadas'] += 1
+            elif actual == fila:
+                resumen['sin_cambios'] += 1
+                continue
+            else:
+                resumen['actualizadas'] += 1
+            cambios.append(fila)
+        if simular or not cambios:
+            continue
+
+        conn.commit()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('''
+                INSERT INTO patients (name, identification_number, date_of_birth, gender, address, phone)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (identification_number) DO UPDATE SET
+                    name = excluded.name,
+                    date_of_birth = excluded.date_of_birth,
+                    gender = excluded.gender,
+                    address = excluded.address,
+                    phone = excluded.phone
+            ''', cambios)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return resumen
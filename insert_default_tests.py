@@ -1,7 +1,7 @@
 import sqlite3
 
-def insert_default_tests():
-    conn = sqlite3.connect('database.db')
+def insert_default_tests(database='database.db'):
+    conn = sqlite3.connect(database)
     cursor = conn.cursor()
 
     # Lista de pruebas por defecto
@@ -0,0 +1,317 @@
+import functools
+import importlib
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FuturoVencido
+from concurrent.futures.process import BrokenProcessPool
+
+from db import connect
+
+# Procesos del pool de cada worker; en producción gunicorn.conf.py lo ajusta para que
+# entre todos los workers no haya más procesos que CPUs
+MAX_WORKERS = 2
+RETENCION_SEGUNDOS = 24 * 60 * 60
+# Trabajo que una petición puede esperar del pool (ejecutar) y cuántos puede haber a la vez
+# por worker; de esos, cuántos pueden venir de peticiones públicas (sin sesión)
+TIMEOUT_SEGUNDOS = 300
+MAX_PENDIENTES = 8
+MAX_PENDIENTES_PUBLICO = 2
+# Un trabajo en segundo plano que lleva más que esto en cola o en proceso se da por perdido
+# (proceso muerto, worker reiniciado) y se marca como error
+ABANDONO_SEGUNDOS = 60 * 60
+
+PENDIENTE = 'pendiente'
+EN_PROCESO = 'en_proceso'
+TERMINADO = 'terminado'
+ERROR = 'error'
+
+# Pool de procesos por worker de gunicorn (se crea al primer uso, nunca se hereda en un fork).
+# Sus procesos se inician con spawn: hacer fork de un worker gthread con otros hilos
+# atendiendo peticiones puede heredar locks tomados (logging, pool de conexiones, caches).
+_pool = None
+_pool_pid = None
+
+
+class PoolOcupado(Exception):
+    """No queda cupo en el pool de este worker (JOBS_MAX_PENDING, o JOBS_MAX_PENDING_PUBLIC)"""
+
+
+class TiempoAgotado(Exception):
+    """El trabajo no terminó dentro del timeout de la petición; `futuro` sigue corriendo en el pool"""
+
+    def __init__(self, mensaje, futuro):
+        super().__init__(mensaje)
+        self.futuro = futuro
+
+
+def _vigilar_padre(pid_padre):
+    # Si el worker muere sin cerrar el pool (SIGKILL, timeout de gunicorn) sus procesos
+    # no lo notan: la cola de trabajos mantiene abiertos los dos extremos de la tubería
+    while os.getppid() == pid_padre:
+        time.sleep(1)
+    os._exit(0)
+
+
+def _iniciar_proceso(modulo_app, pid_padre):
+    threading.Thread(target=_vigilar_padre, args=(pid_padre,), daemon=True).start()
+    # Cada proceso importa la aplicación una sola vez (configuración, métricas, generadores)
+    if modulo_app:
+        importlib.import_module(modulo_app)
+
+
+def obtener_pool(max_workers=MAX_WORKERS, modulo_app=None):
+    """Pool de procesos del worker actual para trabajo pesado de CPU"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_iniciar_proceso, initargs=(modulo_app, os.getpid()))
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def descartar_pool(pool):
+    """Olvida un pool roto (murió uno de sus procesos) para que obtener_pool cree otro"""
+    global _pool
+    if _pool is pool:
+        _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def llamar(modulo_app, funcion, *args):
+    """Llama a una función de la aplicación dentro de un proceso del pool (se referencia por nombre)"""
+    return getattr(importlib.import_module(modulo_app), funcion)(*args)
+
+
+def _actualizar(database, trabajo_id, **campos):
+    conn = connect(database)
+    try:
+        asignaciones = ', '.join(f'{campo} = ?' for campo in campos)
+        conn.execute(f'UPDATE trabajos SET {asignaciones} WHERE id = ?', (*campos.values(), trabajo_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _marcar_error(database, trabajo_id, error):
+    """Marca el trabajo como error si todavía no terminó (no pisa un estado final)"""
+    conn = connect(database)
+    try:
+        conn.execute('''
+            UPDATE trabajos SET estado = ?, terminado = ?, error = ?
+            WHERE id = ? AND estado IN (?, ?)
+        ''', (ERROR, time.time(), error, trabajo_id, PENDIENTE, EN_PROCESO))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _al_terminar(database, trabajo_id, futuro):
+    # Corre en el worker: cubre lo que _ejecutar no puede anotar, como un proceso del
+    # pool que muere (BrokenProcessPool) o un trabajo cancelado antes de empezar
+    if futuro.cancelled():
+        _marcar_error(database, trabajo_id, 'Trabajo cancelado')
+    elif futuro.exception() is not None:
+        _marcar_error(database, trabajo_id, ''.join(traceback.format_exception(futuro.exception(), limit=5)))
+
+
+def _liberar(cupos, futuro):
+    for cupo in cupos:
+        cupo.release()
+
+
+def _ejecutar(modulo_app, funcion, database, trabajo_id, ruta):
+    """Corre en el proceso hijo: genera el archivo y deja el resultado en la tabla trabajos"""
+    _actualizar(database, trabajo_id, estado=EN_PROCESO, iniciado=time.time())
+    try:
+        modulo = importlib.import_module(modulo_app)
+        # Los generadores usan get_db_connection(), que necesita un contexto de aplicación
+        with modulo.app.app_context():
+            buffer = getattr(modulo, funcion)()
+        temporal = ruta + '.tmp'
+        with open(temporal, 'wb') as archivo:
+            archivo.write(buffer.getvalue())
+        os.replace(temporal, ruta)
+    except Exception:
+        _actualizar(database, trabajo_id, estado=ERROR, terminado=time.time(), error=traceback.format_exc(limit=5))
+        raise
+    _actualizar(database, trabajo_id, estado=TERMINADO, terminado=time.time())
+
+
+class ColaTrabajos:
+    """Trabajos en segundo plano (reportes PDF completos) con su estado guardado en SQLite,
+    y trabajo pesado que una petición espera en el mismo pool (ejecutar).
+
+    La tabla trabajos la comparten todos los workers, así que cualquiera puede
+    responder el estado o la descarga de un trabajo lanzado por otro.
+    """
+
+    def __init__(self, app):
+        self.modulo_app = app.import_name
+        self.database = app.config['DATABASE']
+        self.directorio = app.config['JOBS_DIR']
+        self.max_workers = app.config['JOBS_MAX_WORKERS']
+        self.retencion = app.config['JOBS_RETENTION_SECONDS']
+        self.abandono = app.config['JOBS_STALE_SECONDS']
+        self.timeout = app.config['JOBS_TIMEOUT_SECONDS']
+        self.en_pool = app.config['JOBS_OFFLOAD']
+        self.max_pendientes = app.config['JOBS_MAX_PENDING']
+        self.max_pendientes_publico = app.config['JOBS_MAX_PENDING_PUBLIC']
+        self._cupos = None
+        self._cupos_pid = None
+        os.makedirs(self.directorio, exist_ok=True)
+
+    def pool(self):
+        return obtener_pool(self.max_workers, self.modulo_app)
+
+    def _cupos_de(self, publico):
+        if self._cupos_pid != os.getpid():
+            self._cupos = (threading.BoundedSemaphore(self.max_pendientes),
+                           threading.BoundedSemaphore(self.max_pendientes_publico))
+            self._cupos_pid = os.getpid()
+        general, del_publico = self._cupos
+        return (del_publico, general) if publico else (general,)
+
+    def encolar(self, funcion, *args, publico=False, espera=None):
+        """Manda `funcion(*args)` al pool y devuelve su Future; toda entrada al pool pasa por aquí.
+
+        Cada trabajo ocupa hasta terminar uno de los JOBS_MAX_PENDING cupos del worker,
+        y si es de una petición pública (`publico`) también uno de JOBS_MAX_PENDING_PUBLIC,
+        así el público nunca llena el pool del personal. Sin cupo lanza PoolOcupado, o
+        espera hasta `espera` segundos. Con JOBS_OFFLOAD desactivado corre aquí y
+        devuelve el Future ya resuelto.
+        """
+        if not self.en_pool:
+            futuro = Future()
+            try:
+                futuro.set_result(funcion(*args))
+            except Exception as e:
+                futuro.set_exception(e)
+            return futuro
+        tomados = []
+        for cupo in self._cupos_de(publico):
+            if not (cupo.acquire(timeout=espera) if espera else cupo.acquire(blocking=False)):
+                _liberar(tomados, None)
+                raise PoolOcupado()
+            tomados.append(cupo)
+        try:
+            pool = self.pool()
+            try:
+                futuro = pool.submit(funcion, *args)
+            except BrokenProcessPool:
+                # Un proceso del pool murió (memoria, kill): el pool ya no acepta trabajos
+                descartar_pool(pool)
+                futuro = self.pool().submit(funcion, *args)
+        except Exception:
+            _liberar(tomados, None)
+            raise
+        futuro.add_done_callback(functools.partial(_liberar, tomados))
+        return futuro
+
+    def ejecutar(self, funcion, *args, publico=False):
+        """Corre `funcion(*args)` en el pool y espera su resultado hasta JOBS_TIMEOUT_SECONDS.
+
+        Para trabajo pesado que la petición necesita para responder (XLSX, PDF de una
+        prueba): el hilo de la petición solo espera, así que con workers gthread los
+        demás hilos siguen atendiendo. `funcion` debe poder enviarse a otro proceso
+        (una función de módulo; las de la aplicación, con llamar). Lanza PoolOcupado
+        si no hay cupo (ver encolar) y TiempoAgotado si no termina a tiempo; un
+        trabajo que ya empezó no se puede interrumpir, pero sigue ocupando su cupo
+        hasta terminar.
+        """
+        futuro = self.encolar(funcion, *args, publico=publico)
+        try:
+            return futuro.result(timeout=self.timeout)
+        except FuturoVencido:
+            futuro.cancel()
+            raise TiempoAgotado(f'{getattr(funcion, "__name__", funcion)} superó {self.timeout} s', futuro) from None
+
+    def _ruta(self, trabajo_id):
+        return os.path.join(self.directorio, f'{trabajo_id}.bin')
+
+    def enviar(self, conn, tipo, funcion, nombre_descarga, mimetype, usuario=None):
+        """Registra el trabajo y lo manda al pool; devuelve su id sin esperar a que termine.
+
+        Ocupa un cupo del worker mientras corre; sin cupo lanza PoolOcupado y no queda registrado.
+        """
+        self.limpiar_vencidos(conn)
+        self.marcar_abandonados(conn)
+        trabajo_id = uuid.uuid4().hex
+        conn.execute('''
+            INSERT INTO trabajos (id, tipo, estado, usuario, nombre_descarga, mimetype, creado)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (trabajo_id, tipo, PENDIENTE, usuario, nombre_descarga, mimetype, time.time()))
+        conn.commit()
+        try:
+            futuro = self.encolar(
+                _ejecutar, self.modulo_app, funcion.__name__, self.database, trabajo_id, self._ruta(trabajo_id)
+            )
+        except PoolOcupado:
+            conn.execute('DELETE FROM trabajos WHERE id = ?', (trabajo_id,))
+            conn.commit()
+            raise
+        except Exception:
+            _marcar_error(self.database, trabajo_id, traceback.format_exc(limit=5))
+            raise
+        futuro.add_done_callback(functools.partial(_al_terminar, self.database, trabajo_id))
+        return trabajo_id
+
+    def obtener(self, conn, trabajo_id):
+        self.marcar_abandonados(conn, trabajo_id)
+        return conn.execute('SELECT * FROM trabajos WHERE id = ?', (trabajo_id,)).fetchone()
+
+    def marcar_abandonados(self, conn, trabajo_id=None):
+        """Marca como error los trabajos en cola o en proceso desde hace más de JOBS_STALE_SECONDS.
+
+        Un worker que se reinicia pierde su pool y los callbacks de sus trabajos; sin
+        esto quedarían pendientes para siempre y su página de estado no dejaría de
+        recargarse.
+        """
+        ahora = time.time()
+        query = '''
+            UPDATE trabajos SET estado = ?, terminado = ?, error = ?
+            WHERE estado IN (?, ?) AND COALESCE(iniciado, creado) < ?
+        '''
+        params = [ERROR, ahora, f'Sin respuesta después de {self.abandono} s (proceso o worker reiniciado)',
+                  PENDIENTE, EN_PROCESO, ahora - self.abandono]
+        if trabajo_id is not None:
+            query += ' AND id = ?'
+            params.append(trabajo_id)
+        if conn.execute(query, params).rowcount:
+            conn.commit()
+
+    def ruta_resultado(self, trabajo):
+        """Ruta del archivo generado, o None si el trabajo no terminó o ya se borró"""
+        if trabajo is None or trabajo['estado'] != TERMINADO:
+            return None
+        ruta = self._ruta(trabajo['id'])
+        return ruta if os.path.exists(ruta) else None
+
+    def limpiar_vencidos(self, conn):
+        """Borra los trabajos (y sus archivos) más antiguos que el periodo de retención"""
+        limite = time.time() - self.retencion
+        vencidos = conn.execute('SELECT id FROM trabajos WHERE creado < ?', (limite,)).fetchall()
+        for trabajo in vencidos:
+            for ruta in (self._ruta(trabajo['id']), self._ruta(trabajo['id']) + '.tmp'):
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+        if vencidos:
+            conn.execute('DELETE FROM trabajos WHERE creado < ?', (limite,))
+            conn.commit()
+
+
+def init_app(app):
+    app.config.setdefault('JOBS_DIR', os.path.join(app.instance_path, 'trabajos'))
+    app.config.setdefault('JOBS_MAX_WORKERS', MAX_WORKERS)
+    app.config.setdefault('JOBS_RETENTION_SECONDS', RETENCION_SEGUNDOS)
+    app.config.setdefault('JOBS_STALE_SECONDS', ABANDONO_SEGUNDOS)
+    app.config.setdefault('JOBS_TIMEOUT_SECONDS', TIMEOUT_SEGUNDOS)
+    app.config.setdefault('JOBS_MAX_PENDING', MAX_PENDIENTES)
+    app.config.setdefault('JOBS_MAX_PENDING_PUBLIC', MAX_PENDIENTES_PUBLICO)
+    app.config.setdefault('JOBS_OFFLOAD', True)
+    cola = app.extensions['trabajos'] = ColaTrabajos(app)
+    return cola
@@ -0,0 +1,312 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin gunicorn, un solo proceso
+    fcntl = None
+
+from flask import Response, abort, current_app, g, has_request_context, request, session
+
+# Métricas en formato de texto de Prometheus. Cada proceso (worker de gunicorn o
+# proceso del pool de trabajos) acumula en memoria y vuelca su estado a
+# METRICS_DIR/<pid>.json; /metrics suma los archivos de todos los procesos, así
+# que no importa qué worker atienda la consulta de Prometheus. Para que los
+# contadores no bajen cuando un proceso termina, /metrics suma los archivos de los
+# procesos que ya no existen a FINALIZADOS y los borra: el directorio tiene un
+# archivo por proceso vivo más ese.
+INTERVALO_VOLCADO = 5
+FINALIZADOS = 'finalizados.json'
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BUCKETS_BYTES = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2)
+BUCKETS_REPORTES = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+AYUDA = {
+    'http_requests_total': ('counter', 'Peticiones atendidas por endpoint, método y código de estado'),
+    'http_request_duration_seconds': ('histogram', 'Duración de las peticiones por endpoint'),
+    'http_response_size_bytes': ('histogram', 'Tamaño de las respuestas por endpoint'),
+    'sql_statements_total': ('counter', 'Sentencias SQL ejecutadas por endpoint'),
+    'sql_duration_seconds_total': ('counter', 'Tiempo en SQLite (execute y fetch) por endpoint'),
+    'sql_slow_statements_total': ('counter', 'Sentencias sobre SLOW_QUERY_MS por endpoint (ver consultas_lentas.py)'),
+    'report_generation_seconds': ('histogram', 'Tiempo de generación de reportes PDF/XLSX/CSV/ZIP por tipo'),
+}
+
+
+class Registro:
+    """Contadores e histogramas del proceso, con su volcado a un archivo por pid"""
+
+    def __init__(self):
+        self.directorio = None
+        self._lock = threading.Lock()
+        self._reiniciar()
+
+    def _reiniciar(self):
+        self._pid = os.getpid()
+        self._contadores = {}
+        self._histogramas = {}
+        self._ultimo_volcado = 0
+
+    def _propio(self):
+        # Tras un fork el hijo hereda lo acumulado por el padre: empieza de cero
+        if self._pid != os.getpid():
+            self._reiniciar()
+
+    def sumar(self, nombre, etiquetas, valor=1):
+        with self._lock:
+            self._propio()
+            clave = (nombre, tuple(etiquetas))
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def observar(self, nombre, etiquetas, valor, buckets=BUCKETS_SEGUNDOS):
+        with self._lock:
+            self._propio()
+            clave = (nombre, tuple(etiquetas))
+            histograma = self._histogramas.get(clave)
+            if histograma is None:
+                histograma = self._histogramas[clave] = [list(buckets), [0] * len(buckets), 0, 0]
+            for indice, limite in enumerate(histograma[0]):
+                if valor <= limite:
+                    histograma[1][indice] += 1
+                    break
+            histograma[2] += valor
+            histograma[3] += 1
+
+    def volcar(self, forzar=False):
+        """Escribe el estado del proceso en su archivo (como mucho cada INTERVALO_VOLCADO segundos)"""
+        if self.directorio is None:
+            return
+        with self._lock:
+            self._propio()
+            ahora = time.monotonic()
+            if not forzar and ahora - self._ultimo_volcado < INTERVALO_VOLCADO:
+                return
+            self._ultimo_volcado = ahora
+            estado = _estado(self._contadores, self._histogramas)
+            ruta = os.path.join(self.directorio, f'{self._pid}.json')
+            with open(ruta + '.tmp', 'w', encoding='utf-8') as archivo:
+                json.dump(estado, archivo)
+            os.replace(ruta + '.tmp', ruta)
+
+    @contextmanager
+    def _exclusivo(self):
+        # Dos workers atendiendo /metrics a la vez no deben fusionar el mismo archivo
+        # dos veces, ni leerlo justo mientras otro lo pasa a FINALIZADOS
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directorio, 'metricas.lock'), 'a') as cerrojo:
+            fcntl.flock(cerrojo, fcntl.LOCK_EX)
+            yield
+
+    def _fusionar_finalizados(self):
+        """Suma a FINALIZADOS los archivos de procesos que ya terminaron y los borra"""
+        if fcntl is None:
+            return
+        terminados = []
+        for ruta in glob.glob(os.path.join(self.directorio, '*.json*')):
+            pid = os.path.basename(ruta).split('.', 1)[0]
+            if pid.isdigit() and not _vivo(int(pid)):
+                terminados.append(ruta)
+        if not terminados:
+            return
+        final = os.path.join(self.directorio, FINALIZADOS)
+        contadores, histogramas = {}, {}
+        for ruta in [final] + [ruta for ruta in terminados if ruta.endswith('.json')]:
+            _sumar(_leer(ruta), contadores, histogramas)
+        with open(final + '.tmp', 'w', encoding='utf-8') as archivo:
+            json.dump(_estado(contadores, histogramas), archivo)
+        os.replace(final + '.tmp', final)
+        for ruta in terminados:
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+
+    def texto(self):
+        """Suma los archivos de todos los procesos y los devuelve en formato de texto de Prometheus"""
+        self.volcar(forzar=True)
+        contadores = {}
+        histogramas = {}
+        with self._exclusivo():
+            self._fusionar_finalizados()
+            for ruta in glob.glob(os.path.join(self.directorio, '*.json')):
+                _sumar(_leer(ruta), contadores, histogramas)
+
+        lineas = []
+        for nombre, (tipo, ayuda) in AYUDA.items():
+            lineas.append(f'# HELP {nombre} {ayuda}')
+            lineas.append(f'# TYPE {nombre} {tipo}')
+            for (metrica, etiquetas), valor in sorted(contadores.items()):
+                if metrica == nombre:
+                    lineas.append(f'{nombre}{_etiquetas(etiquetas)} {_numero(valor)}')
+            for (metrica, etiquetas), (buckets, conteos, suma, cuenta) in sorted(histogramas.items()):
+                if metrica != nombre:
+                    continue
+                acumulado = 0
+                for limite, conteo in zip(buckets, conteos):
+                    acumulado += conteo
+                    lineas.append(f'{nombre}_bucket{_etiquetas(etiquetas + (("le", _numero(limite)),))} {acumulado}')
+                lineas.append(f'{nombre}_bucket{_etiquetas(etiquetas + (("le", "+Inf"),))} {cuenta}')
+                lineas.append(f'{nombre}_sum{_etiquetas(etiquetas)} {_numero(suma)}')
+                lineas.append(f'{nombre}_count{_etiquetas(etiquetas)} {cuenta}')
+        return '\n'.join(lineas) + '\n'
+
+
+def _estado(contadores, histogramas):
+    """Contadores e histogramas en el formato de los archivos de METRICS_DIR"""
+    return {
+        'contadores': [[nombre, list(map(list, etiquetas)), valor]
+                       for (nombre, etiquetas), valor in contadores.items()],
+        'histogramas': [[nombre, list(map(list, etiquetas)), *histograma]
+                        for (nombre, etiquetas), histograma in histogramas.items()],
+    }
+
+
+def _leer(ruta):
+    try:
+        with open(ruta, encoding='utf-8') as archivo:
+            return json.load(archivo)
+    except (OSError, ValueError):
+        return None
+
+
+def _sumar(estado, contadores, histogramas):
+    """Agrega el estado de un archivo a los totales"""
+    if estado is None:
+        return
+    for nombre, etiquetas, valor in estado['contadores']:
+        clave = (nombre, tuple(map(tuple, etiquetas)))
+        contadores[clave] = contadores.get(clave, 0) + valor
+    for nombre, etiquetas, buckets, conteos, suma, cuenta in estado['histogramas']:
+        clave = (nombre, tuple(map(tuple, etiquetas)))
+        actual = histogramas.setdefault(clave, [buckets, [0] * len(buckets), 0, 0])
+        actual[1] = [a + b for a, b in zip(actual[1], conteos)]
+        actual[2] += suma
+        actual[3] += cuenta
+
+
+def _vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _numero(valor):
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+def _etiquetas(etiquetas):
+    if not etiquetas:
+        return ''
+    pares = ','.join(
+        '{}="{}"'.format(clave, str(valor).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for clave, valor in etiquetas
+    )
+    return '{' + pares + '}'
+
+
+registro = Registro()
+
+
+@contextmanager
+def cronometrar(tipo):
+    """Mide la generación de un reporte (sirve como `with` o como decorador)"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registro.observar('report_generation_seconds', (('tipo', tipo),),
+                          time.perf_counter() - inicio, BUCKETS_REPORTES)
+        # En el pool de trabajos no hay peticiones que vuelquen después
+        registro.volcar(forzar=not has_request_context())
+
+
+class _ContadorBytes:
+    """Envuelve el cuerpo de una respuesta sin largo conocido y registra su tamaño al cerrarla"""
+
+    def __init__(self, cuerpo, endpoint):
+        self.cuerpo = cuerpo
+        self.endpoint = endpoint
+        self.tamano = 0
+
+    def __iter__(self):
+        for parte in self.cuerpo:
+            self.tamano += len(parte)
+            yield parte
+
+    def close(self):
+        if hasattr(self.cuerpo, 'close'):
+            self.cuerpo.close()
+        registro.observar('http_response_size_bytes', (('endpoint', self.endpoint),), self.tamano, BUCKETS_BYTES)
+
+
+def _inicio_peticion():
+    g.metricas_inicio = time.perf_counter()
+
+
+def _respuesta(response):
+    endpoint = request.endpoint or 'desconocido'
+    g.metricas_estado = response.status_code
+    tamano = response.content_length
+    if tamano is None and not response.is_streamed:
+        tamano = response.calculate_content_length()
+    if tamano is None and response.direct_passthrough:
+        # send_file de un archivo abierto (por ejemplo el XLSX temporal): lo que queda por leer
+        archivo = getattr(response.response, 'file', None)
+        try:
+            tamano = os.fstat(archivo.fileno()).st_size - archivo.tell()
+        except (AttributeError, OSError, ValueError):
+            pass
+    if tamano is not None:
+        registro.observar('http_response_size_bytes', (('endpoint', endpoint),), tamano, BUCKETS_BYTES)
+    elif not response.direct_passthrough:
+        response.response = _ContadorBytes(response.response, endpoint)
+    return response
+
+
+def _fin_peticion(exception=None):
+    """Registra la petición; con stream_with_context corre cuando termina de enviarse el cuerpo"""
+    inicio = g.pop('metricas_inicio', None)
+    if inicio is None:
+        return
+    endpoint = request.endpoint or 'desconocido'
+    estado = g.pop('metricas_estado', 500)
+    registro.sumar('http_requests_total', (('endpoint', endpoint), ('method', request.method), ('status', estado)))
+    registro.observar('http_request_duration_seconds', (('endpoint', endpoint),), time.perf_counter() - inicio)
+    conn = g.get('db')
+    if conn is not None:
+        registro.sumar('sql_statements_total', (('endpoint', endpoint),), conn.sentencias)
+        registro.sumar('sql_duration_seconds_total', (('endpoint', endpoint),), conn.tiempo_sql)
+    registro.volcar()
+
+
+def metricas():
+    """Métricas de todos los workers; con METRICS_TOKEN pide 'Authorization: Bearer <token>',
+    si no, solo responde a localhost o a un administrador con sesión"""
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+    elif request.remote_addr not in ('127.0.0.1', '::1') and session.get('rol') != 'admin':
+        abort(403)
+    return Response(registro.texto(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.config.setdefault('METRICS_DIR', os.path.join(app.instance_path, 'metricas'))
+    app.config.setdefault('METRICS_TOKEN', None)
+    os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+    registro.directorio = app.config['METRICS_DIR']
+    app.before_request(_inicio_peticion)
+    app.after_request(_respuesta)
+    app.teardown_request(_fin_peticion)
+    app.add_url_rule('/metrics', 'metricas', metricas)
@@ -0,0 +1,448 @@
+import sys
+
+import duplicados
+import fechas
+import resumen
+from db import DATABASE, connect
+
+
+class MigracionBloqueada(Exception):
+    """Los datos no permiten aplicar la migración sin una decisión manual"""
+
+
+def _esquema_base(conn):
+    """Tablas originales creadas por init_db.py"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            identification_number TEXT NOT NULL,
+            date_of_birth TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            address TEXT NOT NULL,
+            phone TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pruebas_paciente (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+	        patient_id	INTEGER NOT NULL,
+	        test_id	INTEGER NOT NULL,
+	        test_date	TEXT NOT NULL,
+	        result	TEXT NOT NULL,
+	        result_date	TEXT NOT NULL,
+	        laboratory	TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+	        rol	TEXT NOT NULL,
+	        nombre_completo	TEXT NOT NULL,
+	        correo_electronico	TEXT NOT NULL,
+	        nombre_usuario	TEXT NOT NULL,
+	        contraseña	TEXT NOT NULL,
+	        numero_telefono	TEXT NOT NULL,
+	        estado  TEXT NOT NULL,
+	        fecha_creacion	DATE NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS pruebas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+	        name	TEXT NOT NULL,
+	        code	TEXT NOT NULL,
+	        description	TEXT NOT NULL,
+	        category	TEXT NOT NULL,
+	        method	TEXT NOT NULL,
+	        duration	TEXT NOT NULL,
+	        status	TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS informes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+	    informe	TEXT NOT NULL,
+	    fecha	TEXT NOT NULL
+        )
+    ''')
+
+
+def _indices_consultas(conn):
+    """Índices para los JOIN, filtros y ordenamientos que usa app.py"""
+    # JOIN patients/pruebas y listado ordenado por fecha (el rowid va implícito en el índice,
+    # así que también sirve para ORDER BY test_date DESC, id DESC)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pruebas_paciente_patient_id ON pruebas_paciente (patient_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pruebas_paciente_test_id ON pruebas_paciente (test_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pruebas_paciente_test_date ON pruebas_paciente (test_date)')
+    # Búsqueda por carnet y reporte de pacientes ordenado por nombre
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_patients_identification_number ON patients (identification_number)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_patients_name ON patients (name)')
+    # Login
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_nombre_usuario ON usuarios (nombre_usuario)')
+    # Filtros WHERE name IN ('PCR', ...) y agrupación por tipo de prueba
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pruebas_name ON pruebas (name)')
+
+
+def _busqueda_pacientes_fts(conn):
+    """Índice FTS5 (trigramas) sobre nombre y carnet, sincronizado con triggers"""
+    # Tabla de contenido externo: el índice guarda solo los trigramas y lee
+    # los valores de patients, así que no duplica los datos.
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+            name,
+            identification_number,
+            content='patients',
+            content_rowid='id',
+            tokenize='trigram'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON patients BEGIN
+            INSERT INTO patients_fts (rowid, name, identification_number)
+            VALUES (new.id, new.name, new.identification_number);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, name, identification_number)
+            VALUES ('delete', old.id, old.name, old.identification_number);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_update AFTER UPDATE OF name, identification_number ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, name, identification_number)
+            VALUES ('delete', old.id, old.name, old.identification_number);
+            INSERT INTO patients_fts (rowid, name, identification_number)
+            VALUES (new.id, new.name, new.identification_number);
+        END
+    ''')
+    # Indexar los pacientes que ya existían
+    conn.execute("INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')")
+
+
+def _resumen_contadores(conn):
+    """Contadores de pacientes y de pruebas por tipo, mantenidos por triggers"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS resumen_totales (
+            tabla TEXT PRIMARY KEY,
+            cantidad INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS resumen_pruebas (
+            test_id INTEGER PRIMARY KEY,
+            cantidad INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS resumen_patients_insert AFTER INSERT ON patients BEGIN
+            UPDATE resumen_totales SET cantidad = cantidad + 1 WHERE tabla = 'patients';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS resumen_patients_delete AFTER DELETE ON patients BEGIN
+            UPDATE resumen_totales SET cantidad = cantidad - 1 WHERE tabla = 'patients';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS resumen_pruebas_paciente_insert AFTER INSERT ON pruebas_paciente BEGIN
+            UPDATE resumen_totales SET cantidad = cantidad + 1 WHERE tabla = 'pruebas_paciente';
+            INSERT INTO resumen_pruebas (test_id, cantidad) VALUES (new.test_id, 1)
+                ON CONFLICT (test_id) DO UPDATE SET cantidad = cantidad + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS resumen_pruebas_paciente_delete AFTER DELETE ON pruebas_paciente BEGIN
+            UPDATE resumen_totales SET cantidad = cantidad - 1 WHERE tabla = 'pruebas_paciente';
+            UPDATE resumen_pruebas SET cantidad = cantidad - 1 WHERE test_id = old.test_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS resumen_pruebas_paciente_update AFTER UPDATE OF test_id ON pruebas_paciente
+        WHEN old.test_id IS NOT new.test_id BEGIN
+            UPDATE resumen_pruebas SET cantidad = cantidad - 1 WHERE test_id = old.test_id;
+            INSERT INTO resumen_pruebas (test_id, cantidad) VALUES (new.test_id, 1)
+                ON CONFLICT (test_id) DO UPDATE SET cantidad = cantidad + 1;
+        END
+    ''')
+    resumen.reconstruir(conn)
+
+
+def _trabajos(conn):
+    """Tabla de trabajos en segundo plano (reportes PDF completos)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS trabajos (
+            id TEXT PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            estado TEXT NOT NULL,
+            usuario TEXT,
+            nombre_descarga TEXT NOT NULL,
+            mimetype TEXT NOT NULL,
+            error TEXT,
+            creado REAL NOT NULL,
+            iniciado REAL,
+            terminado REAL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trabajos_creado ON trabajos (creado)')
+
+
+def _carnet_unico(conn):
+    """Índice único en patients.identification_number (un paciente por carnet)"""
+    # Nunca se fusionan pacientes aquí: si hay carnets repetidos la migración se detiene
+    # hasta que alguien los revise con duplicados.py
+    repetidos = duplicados.carnets_duplicados(conn)
+    if repetidos:
+        detalle = '; '.join(f"carnet {carnet}: pacientes {', '.join(map(str, ids))}" for carnet, ids in repetidos)
+        raise MigracionBloqueada(
+            f'Hay {len(repetidos)} carnet(s) con más de un paciente ({detalle}). '
+            'Revísalos con python duplicados.py y vuelve a iniciar la aplicación.'
+        )
+    conn.execute('DROP INDEX IF EXISTS idx_patients_identification_number')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_patients_identification_number_unico
+        ON patients (identification_number)
+    ''')
+
+
+def _versiones_datos(conn):
+    """Contador de cambios por tabla, para ETag y caches que dependen de los datos"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS versiones_datos (
+            tabla TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for tabla in ('patients', 'pruebas', 'pruebas_paciente', 'usuarios'):
+        conn.execute('INSERT OR IGNORE INTO versiones_datos (tabla) VALUES (?)', (tabla,))
+        for operacion in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS version_{tabla}_{operacion.lower()} AFTER {operacion} ON {tabla} BEGIN
+                    UPDATE versiones_datos SET version = version + 1 WHERE tabla = '{tabla}';
+                END
+            ''')
+
+
+def _carnet_normalizado(conn):
+    """Índice de expresión para buscar el carnet sin importar espacios ni mayúsculas"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_patients_carnet_normalizado
+        ON patients (upper(replace(identification_number, ' ', '')))
+    ''')
+
+
+def _resumen_diario(conn):
+    """Pruebas y positivos por día, tipo de prueba y laboratorio, mantenidos por triggers"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS resumen_diario (
+            dia TEXT NOT NULL,
+            test_id INTEGER NOT NULL,
+            laboratory TEXT NOT NULL,
+            cantidad INTEGER NOT NULL DEFAULT 0,
+            positivos INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, test_id, laboratory)
+        ) WITHOUT ROWID
+    ''')
+    sumar = '''
+            INSERT INTO resumen_diario (dia, test_id, laboratory, cantidad, positivos)
+            VALUES (substr(new.test_date, 1, 10), new.test_id, new.laboratory, 1,
+                    lower(new.result) IN ('positivo', 'positive'))
+                ON CONFLICT (dia, test_id, laboratory) DO UPDATE SET
+                    cantidad = cantidad + 1,
+                    positivos = positivos + excluded.positivos;
+    '''
+    restar = '''
+            UPDATE resumen_diario SET
+                cantidad = cantidad - 1,
+                positivos = positivos - (lower(old.result) IN ('positivo', 'positive'))
+            WHERE dia = substr(old.test_date, 1, 10) AND test_id = old.test_id AND laboratory = old.laboratory;
+            DELETE FROM resumen_diario
+            WHERE dia = substr(old.test_date, 1, 10) AND test_id = old.test_id AND laboratory = old.laboratory
+                AND cantidad <= 0;
+    '''
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS resumen_diario_insert AFTER INSERT ON pruebas_paciente BEGIN
+            {sumar}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS resumen_diario_delete AFTER DELETE ON pruebas_paciente BEGIN
+            {restar}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS resumen_diario_update
+        AFTER UPDATE OF test_date, test_id, laboratory, result ON pruebas_paciente BEGIN
+            {restar}
+            {sumar}
+        END
+    ''')
+    resumen.reconstruir_diario(conn)
+
+
+def _fechas_iso(conn):
+    """Fechas en ISO y número de día indexado para filtrar pruebas por rango de fechas"""
+    fechas.normalizar_existentes(conn)
+    conn.execute('''
+        ALTER TABLE pruebas_paciente
+        ADD COLUMN test_date_day INTEGER GENERATED ALWAYS AS (CAST(julianday(test_date) AS INTEGER)) VIRTUAL
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pruebas_paciente_test_date_day
+        ON pruebas_paciente (test_date_day)
+    ''')
+
+
+def _tiempos_respuesta(conn):
+    """Histograma diario de días entre prueba y resultado, mantenido por triggers"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tiempos_respuesta_diario (
+            dia TEXT NOT NULL,
+            test_id INTEGER NOT NULL,
+            laboratory TEXT NOT NULL,
+            dias INTEGER NOT NULL,
+            cantidad INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, test_id, laboratory, dias)
+        ) WITHOUT ROWID
+    ''')
+    sumar = f'''
+            INSERT INTO tiempos_respuesta_diario (dia, test_id, laboratory, dias, cantidad)
+            SELECT substr(new.test_date, 1, 10), new.test_id, new.laboratory, {resumen.DIAS_RESPUESTA.format(fila='new')}, 1
+            WHERE new.result_date IS NOT NULL
+                ON CONFLICT (dia, test_id, laboratory, dias) DO UPDATE SET cantidad = cantidad + 1;
+    '''
+    clave_old = f'''dia = substr(old.test_date, 1, 10) AND test_id = old.test_id AND laboratory = old.laboratory
+                AND dias = {resumen.DIAS_RESPUESTA.format(fila='old')}'''
+    restar = f'''
+            UPDATE tiempos_respuesta_diario SET cantidad = cantidad - 1
+            WHERE {clave_old};
+            DELETE FROM tiempos_respuesta_diario
+            WHERE {clave_old} AND cantidad <= 0;
+    '''
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS tiempos_respuesta_insert AFTER INSERT ON pruebas_paciente BEGIN
+            {sumar}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS tiempos_respuesta_delete AFTER DELETE ON pruebas_paciente BEGIN
+            {restar}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS tiempos_respuesta_update
+        AFTER UPDATE OF test_date, result_date, test_id, laboratory ON pruebas_paciente BEGIN
+            {restar}
+            {sumar}
+        END
+    ''')
+    resumen.reconstruir_tiempos(conn)
+
+
+def _sesiones(conn):
+    """Sesiones en el servidor y versión por usuario que invalida su estado en cache"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sesiones (
+            id TEXT PRIMARY KEY,
+            usuario_id INTEGER,
+            datos TEXT NOT NULL,
+            expira INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sesiones_usuario_id ON sesiones (usuario_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sesiones_expira ON sesiones (expira)')
+    # usuario_id 0 es el admin fijo de login(), que no está en usuarios
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS versiones_usuario (
+            usuario_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for operacion in ('UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS version_usuario_{operacion.lower()} AFTER {operacion} ON usuarios BEGIN
+                INSERT INTO versiones_usuario (usuario_id, version) VALUES (old.id, 1)
+                    ON CONFLICT (usuario_id) DO UPDATE SET version = version + 1;
+            END
+        ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS sesiones_usuario_delete AFTER DELETE ON usuarios BEGIN
+            DELETE FROM sesiones WHERE usuario_id = old.id;
+        END
+    ''')
+
+
+# Lista ordenada de migraciones: (versión, descripción, función).
+# La versión aplicada se guarda en PRAGMA user_version; nunca se renumeran.
+MIGRATIONS = [
+    (1, 'esquema base', _esquema_base),
+    (2, 'índices para joins, búsquedas y login', _indices_consultas),
+    (3, 'índice FTS5 para la búsqueda de pacientes', _busqueda_pacientes_fts),
+    (4, 'contadores de resumen para el panel e informes', _resumen_contadores),
+    (5, 'tabla de trabajos en segundo plano', _trabajos),
+    (6, 'carnet de paciente único', _carnet_unico),
+    (7, 'versión de los datos por tabla', _versiones_datos),
+    (8, 'índice del carnet normalizado (consulta pública)', _carnet_normalizado),
+    (9, 'resumen diario por tipo de prueba y laboratorio', _resumen_diario),
+    (10, 'fechas ISO y test_date_day indexado', _fechas_iso),
+    (11, 'histograma diario de tiempos de respuesta', _tiempos_respuesta),
+    (12, 'sesiones en el servidor y versión por usuario', _sesiones),
+]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Aplica las migraciones pendientes, cada una en su propia transacción.
+
+    Devuelve la lista de versiones aplicadas. Es seguro llamarla desde varios
+    workers a la vez: BEGIN IMMEDIATE serializa a los escritores y la versión se
+    vuelve a comprobar dentro de la transacción.
+    """
+    aplicadas = []
+    for version, descripcion, funcion in MIGRATIONS:
+        if version <= current_version(conn):
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if version <= current_version(conn):
+                conn.rollback()
+                continue
+            funcion(conn)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        aplicadas.append(version)
+    if aplicadas:
+        # Actualizar las estadísticas del planificador con los índices nuevos
+        conn.execute('ANALYZE')
+        conn.commit()
+    return aplicadas
+
+
+def migrate_database(database=DATABASE):
+    conn = connect(database)
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else DATABASE
+    conn = connect(database)
+    antes = current_version(conn)
+    try:
+        aplicadas = migrate(conn)
+    except MigracionBloqueada as e:
+        sys.exit(str(e))
+    for version, descripcion, _ in MIGRATIONS:
+        if version in aplicadas:
+            print(f'Migración {version} aplicada: {descripcion}')
+    print(f'Versión del esquema: {antes} -> {current_version(conn)}')
+    conn.close()
@@ -0,0 +1,122 @@
+import base64
+import json
+
+from flask import current_app, request, url_for
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Tipos que puede traer un cursor (los que json.loads da y SQLite acepta como parámetro)
+ESCALARES = (str, int, float, type(None))
+
+
+class Pagina:
+    """Una página de resultados con los cursores para moverse a la siguiente/anterior"""
+
+    def __init__(self, filas, siguiente=None, anterior=None, tamano=PAGE_SIZE):
+        self.filas = filas
+        self.siguiente = siguiente
+        self.anterior = anterior
+        self.tamano = tamano
+
+    def __iter__(self):
+        return iter(self.filas)
+
+    def __len__(self):
+        return len(self.filas)
+
+
+def codificar_cursor(valores):
+    texto = json.dumps(valores, separators=(',', ':'))
+    return base64.urlsafe_b64encode(texto.encode()).decode().rstrip('=')
+
+
+def decodificar_cursor(cursor):
+    """Devuelve la lista de valores del cursor, o None si no es válido.
+
+    El cursor viene del cliente: solo se aceptan valores que SQLite pueda recibir como
+    parámetros (texto, números o null).
+    """
+    if not cursor:
+        return None
+    try:
+        texto = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        valores = json.loads(texto)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(valores, list) or not all(isinstance(valor, ESCALARES) for valor in valores):
+        return None
+    return valores
+
+
+def tamano_pagina():
+    """Tamaño de página pedido en ?por_pagina=, acotado a MAX_PAGE_SIZE"""
+    por_defecto = current_app.config['PAGE_SIZE']
+    tamano = request.args.get('por_pagina', por_defecto, type=int)
+    return max(1, min(tamano, current_app.config['MAX_PAGE_SIZE']))
+
+
+def paginar(conn, query, params, claves, descendente=False, tamano=None, despues=None, antes=None):
+    """Ejecuta `query` (un SELECT ... WHERE ..., sin ORDER BY ni LIMIT) con paginación por cursor (keyset).
+
+    `claves` es una lista de (expresión SQL, columna en la fila) que forma un orden
+    estable y único, p. ej. [('pp.test_date', 'test_date'), ('pp.id', 'id')]. En vez de
+    OFFSET se filtra con `(claves) < (cursor)`, así que cada página cuesta lo mismo
+    sin importar lo lejos que esté y aprovecha los índices sobre esas columnas.
+    Los cursores `despues`/`antes` son los que devuelve la página anterior.
+    """
+    if tamano is None:
+        tamano = tamano_pagina()
+    despues = decodificar_cursor(despues)
+    antes = decodificar_cursor(antes) if despues is None else None
+
+    expresiones = ', '.join(expresion for expresion, _ in claves)
+    marcadores = ', '.join('?' for _ in claves)
+    hacia_atras = antes is not None
+    cursor = antes if hacia_atras else despues
+    # Hacia atrás se recorre en el sentido contrario y luego se invierten las filas
+    invertir = descendente != hacia_atras
+
+    params = list(params)
+    if cursor is not None and len(cursor) == len(claves):
+        query += f' AND ({expresiones}) {"<" if invertir else ">"} ({marcadores})'
+        params.extend(cursor)
+    else:
+        cursor = None
+        hacia_atras = False
+        invertir = descendente
+    sentido = 'DESC' if invertir else 'ASC'
+    query += ' ORDER BY ' + ', '.join(f'{expresion} {sentido}' for expresion, _ in claves)
+    query += ' LIMIT ?'
+    params.append(tamano + 1)
+
+    filas = conn.execute(query, params).fetchall()
+    hay_mas = len(filas) > tamano
+    filas = filas[:tamano]
+    if hacia_atras:
+        filas.reverse()
+
+    def clave(fila):
+        return codificar_cursor([fila[columna] for _, columna in claves])
+
+    siguiente = anterior = None
+    if filas:
+        if hacia_atras:
+            siguiente = clave(filas[-1])
+            anterior = clave(filas[0]) if hay_mas else None
+        else:
+            siguiente = clave(filas[-1]) if hay_mas else None
+            anterior = clave(filas[0]) if cursor is not None else None
+    return Pagina(filas, siguiente, anterior, tamano)
+
+
+def url_pagina(**cambios):
+    """URL de la vista actual conservando los filtros y reemplazando los cursores"""
+    args = {k: v for k, v in request.args.items() if k not in ('despues', 'antes')}
+    args.update({k: v for k, v in cambios.items() if v is not None})
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+
+def init_app(app):
+    app.config.setdefault('PAGE_SIZE', PAGE_SIZE)
+    app.config.setdefault('MAX_PAGE_SIZE', MAX_PAGE_SIZE)
+    app.jinja_env.globals['url_pagina'] = url_pagina
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+# Cambiar este número cuando cambie el diseño del PDF para no servir reportes viejos
+VERSION_PLANTILLA = 1
+MAX_BYTES = 200 * 1024 * 1024
+# Al pasar del límite se borra hasta quedar en esta fracción, así el directorio no se
+# recorre en cada put sino cada tanto
+FRACCION_OBJETIVO = 0.9
+# Los demás workers también escriben: pasado este tiempo (segundos) se vuelve a medir
+# el directorio en el siguiente put aunque el total de este worker no llegue al límite
+INTERVALO_REVISION = 300
+
+
+def clave_reporte(prueba_id, fila):
+    """Clave del reporte: id de la prueba + hash del contenido con el que se genera.
+
+    Si cambia cualquier dato que aparece en el PDF (prueba, paciente o catálogo)
+    cambia la clave, así que nunca se sirve un reporte desactualizado.
+    """
+    contenido = repr((VERSION_PLANTILLA, tuple(fila))).encode()
+    return f'{prueba_id}-{hashlib.sha256(contenido).hexdigest()[:20]}'
+
+
+class CachePDF:
+    """Cache de reportes PDF en disco, compartida por todos los workers.
+
+    Los archivos se llaman <prueba_id>-<hash>.pdf. Cada worker lleva en memoria el
+    tamaño total (medido en el primer put y sumando lo que guarda); cuando pasa de
+    max_bytes, o cada INTERVALO_REVISION, recorre el directorio y borra los menos
+    usados recientemente (por mtime) hasta FRACCION_OBJETIVO de max_bytes.
+    """
+
+    def __init__(self, directorio, max_bytes=MAX_BYTES):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        os.makedirs(directorio, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total = None
+        self._revisado = 0
+        self._revisando = False
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, f'{clave}.pdf')
+
+    def get(self, clave):
+        """Ruta del PDF en cache o None; marca el archivo como usado recientemente"""
+        ruta = self._ruta(clave)
+        try:
+            os.utime(ruta)
+        except FileNotFoundError:
+            return None
+        return ruta
+
+    def put(self, clave, contenido):
+        """Guarda el PDF de forma atómica (nunca se lee un archivo a medio escribir)"""
+        fd, temporal = tempfile.mkstemp(dir=self.directorio, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as archivo:
+                archivo.write(contenido)
+            os.replace(temporal, self._ruta(clave))
+        except BaseException:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+            raise
+        with self._lock:
+            if self._total is not None:
+                self._total += len(contenido)
+            revisar = not self._revisando and (
+                self._total is None
+                or self._total > self.max_bytes
+                or time.monotonic() - self._revisado > INTERVALO_REVISION
+            )
+            self._revisando = self._revisando or revisar
+        if revisar:
+            try:
+                self._desalojar()
+            finally:
+                self._revisando = False
+        return self._ruta(clave)
+
+    def invalidar(self, *prueba_ids):
+        """Borra todas las versiones en cache de los reportes de esas pruebas"""
+        prefijos = tuple(f'{prueba_id}-' for prueba_id in prueba_ids)
+        if not prefijos:
+            return
+        for entrada in os.scandir(self.directorio):
+            if entrada.name.endswith('.pdf') and entrada.name.startswith(prefijos):
+                self._borrar(entrada.path)
+
+    def _desalojar(self):
+        """Mide el directorio y, si pasa de max_bytes, borra los más viejos"""
+        archivos = []
+        total = 0
+        for entrada in os.scandir(self.directorio):
+            if not entrada.name.endswith('.pdf'):
+                continue
+            try:
+                estado = entrada.stat()
+            except FileNotFoundError:
+                continue
+            archivos.append((estado.st_mtime, estado.st_size, entrada.path))
+            total += estado.st_size
+        if total > self.max_bytes:
+            objetivo = self.max_bytes * FRACCION_OBJETIVO
+            archivos.sort()
+            for _, tamano, ruta in archivos:
+                self._borrar(ruta)
+                total -= tamano
+                if total <= objetivo:
+                    break
+        with self._lock:
+            self._total = total
+            self._revisado = time.monotonic()
+
+    @staticmethod
+    def _borrar(ruta):
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,185 @@
+import sys
+from datetime import date, timedelta
+
+from db import DATABASE, connect
+
+# Contadores mantenidos por los triggers de la migración 4 (ver migrations.py):
+#   resumen_totales  -> filas de patients y pruebas_paciente
+#   resumen_pruebas  -> pruebas realizadas por test_id
+#   resumen_diario   -> pruebas y positivos por día, test_id y laboratorio (migración 9)
+# Así el panel y los informes leen O(tipos de prueba) filas en vez de contar toda la tabla.
+
+
+def total(conn, tabla):
+    """Cantidad de filas de `tabla` ('patients' o 'pruebas_paciente')"""
+    fila = conn.execute('SELECT cantidad FROM resumen_totales WHERE tabla = ?', (tabla,)).fetchone()
+    return fila[0] if fila else 0
+
+
+def pruebas_por_tipo(conn, nombres=None):
+    """Pruebas realizadas agrupadas por nombre de prueba, de mayor a menor.
+
+    Si se pasa `nombres`, solo se incluyen esos tipos de prueba.
+    """
+    query = '''
+        SELECT
+            t.name AS categoria,
+            SUM(r.cantidad) AS cantidad
+        FROM resumen_pruebas r
+        JOIN (
+            SELECT DISTINCT id, name FROM pruebas
+        ) t ON r.test_id = t.id
+        WHERE r.cantidad > 0
+    '''
+    params = []
+    if nombres:
+        query += ' AND t.name IN (%s)' % ', '.join('?' for _ in nombres)
+        params.extend(nombres)
+    query += ' GROUP BY t.name ORDER BY cantidad DESC'
+    return conn.execute(query, params).fetchall()
+
+
+def reconstruir(conn):
+    """Recalcula los contadores desde cero (reparación o después de cargas manuales)"""
+    conn.execute('DELETE FROM resumen_pruebas')
+    conn.execute('''
+        INSERT INTO resumen_pruebas (test_id, cantidad)
+        SELECT test_id, COUNT(*) FROM pruebas_paciente GROUP BY test_id
+    ''')
+    conn.execute('DELETE FROM resumen_totales')
+    conn.execute('''
+        INSERT INTO resumen_totales (tabla, cantidad)
+        SELECT 'patients', COUNT(*) FROM patients
+        UNION ALL
+        SELECT 'pruebas_paciente', COUNT(*) FROM pruebas_paciente
+    ''')
+
+
+def reconstruir_diario(conn):
+    """Recalcula resumen_diario desde pruebas_paciente"""
+    conn.execute('DELETE FROM resumen_diario')
+    conn.execute('''
+        INSERT INTO resumen_diario (dia, test_id, laboratory, cantidad, positivos)
+        SELECT substr(test_date, 1, 10), test_id, laboratory, COUNT(*),
+               SUM(lower(result) IN ('positivo', 'positive'))
+        FROM pruebas_paciente
+        GROUP BY substr(test_date, 1, 10), test_id, laboratory
+    ''')
+
+
+# Días entre la prueba y el resultado de una fila de pruebas_paciente; -1 si alguna
+# fecha no es válida o el resultado es anterior a la prueba
+DIAS_RESPUESTA = (
+    'max(coalesce(CAST(julianday({fila}.result_date) AS INTEGER)'
+    ' - CAST(julianday({fila}.test_date) AS INTEGER), -1), -1)'
+)
+
+
+def reconstruir_tiempos(conn):
+    """Recalcula tiempos_respuesta_diario desde pruebas_paciente"""
+    conn.execute('DELETE FROM tiempos_respuesta_diario')
+    conn.execute(f'''
+        INSERT INTO tiempos_respuesta_diario (dia, test_id, laboratory, dias, cantidad)
+        SELECT substr(pp.test_date, 1, 10), pp.test_id, pp.laboratory,
+               {DIAS_RESPUESTA.format(fila='pp')} AS dias, COUNT(*)
+        FROM pruebas_paciente pp
+        WHERE pp.result_date IS NOT NULL
+        GROUP BY substr(pp.test_date, 1, 10), pp.test_id, pp.laboratory, dias
+    ''')
+
+
+# Expresión del periodo al que pertenece cada día (las semanas empiezan el lunes)
+PERIODOS = {
+    'dia': 'r.dia',
+    'semana': "date(r.dia, 'weekday 0', '-6 days')",
+    'mes': 'substr(r.dia, 1, 7)',
+}
+DIAS_POR_DEFECTO = 90
+MAX_DIAS = 5 * 366
+
+
+def _eje_periodos(desde, hasta, granularidad):
+    """Todos los periodos entre dos fechas, para que los días sin pruebas salgan en cero"""
+    if granularidad == 'mes':
+        periodos = []
+        anio, mes = desde.year, desde.month
+        while (anio, mes) <= (hasta.year, hasta.month):
+            periodos.append(f'{anio:04d}-{mes:02d}')
+            anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+        return periodos
+    paso = 1
+    if granularidad == 'semana':
+        desde -= timedelta(days=desde.weekday())
+        paso = 7
+    return [(desde + timedelta(days=dias)).isoformat() for dias in range(0, (hasta - desde).days + 1, paso)]
+
+
+def tendencias(conn, desde=None, hasta=None, granularidad='dia', laboratorio=None):
+    """Series de pruebas y positivos por periodo y tipo de prueba, leídas de resumen_diario.
+
+    Sin fechas se toman los últimos DIAS_POR_DEFECTO días con datos. Devuelve un
+    diccionario listo para Chart.js: periodos (eje X) y una serie por prueba.
+    """
+    if granularidad not in PERIODOS:
+        raise ValueError(f'Granularidad inválida: {granularidad}')
+    if hasta is None:
+        ultimo = conn.execute('SELECT MAX(dia) FROM resumen_diario').fetchone()[0]
+        hasta = date.fromisoformat(ultimo) if ultimo else date.today()
+    if desde is None:
+        desde = hasta - timedelta(days=DIAS_POR_DEFECTO - 1)
+    if desde > hasta:
+        raise ValueError('La fecha inicial es posterior a la final')
+    if (hasta - desde).days > MAX_DIAS:
+        raise ValueError(f'El rango no puede superar {MAX_DIAS} días')
+
+    periodo = PERIODOS[granularidad]
+    query = f'''
+        SELECT {periodo} AS periodo, t.name AS prueba,
+               SUM(r.cantidad) AS cantidad, SUM(r.positivos) AS positivos
+        FROM resumen_diario r
+        JOIN pruebas t ON r.test_id = t.id
+        WHERE r.dia BETWEEN ? AND ?
+    '''
+    params = [desde.isoformat(), hasta.isoformat()]
+    if laboratorio:
+        query += ' AND r.laboratory = ?'
+        params.append(laboratorio)
+    query += ' GROUP BY periodo, t.name'
+
+    periodos = _eje_periodos(desde, hasta, granularidad)
+    posicion = {valor: indice for indice, valor in enumerate(periodos)}
+    series = {}
+    for fila in conn.execute(query, params):
+        indice = posicion.get(fila['periodo'])
+        if indice is None:
+            continue
+        serie = series.setdefault(fila['prueba'], {
+            'prueba': fila['prueba'],
+            'cantidades': [0] * len(periodos),
+            'positivos': [0] * len(periodos),
+        })
+        serie['cantidades'][indice] = fila['cantidad']
+        serie['positivos'][indice] = fila['positivos']
+    return {
+        'desde': desde.isoformat(),
+        'hasta': hasta.isoformat(),
+        'granularidad': granularidad,
+        'periodos': periodos,
+        'series': sorted(series.values(), key=lambda serie: serie['prueba']),
+    }
+
+
+def laboratorios(conn):
+    """Laboratorios con pruebas registradas (para el filtro de las tendencias)"""
+    return [fila[0] for fila in conn.execute('SELECT DISTINCT laboratory FROM resumen_diario ORDER BY laboratory')]
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else DATABASE
+    conn = connect(database)
+    reconstruir(conn)
+    reconstruir_diario(conn)
+    reconstruir_tiempos(conn)
+    conn.commit()
+    print(f"Resumen reconstruido: {total(conn, 'patients')} pacientes, {total(conn, 'pruebas_paciente')} pruebas")
+    conn.close()
@@ -0,0 +1,54 @@
+# Los trigramas necesitan al menos 3 caracteres; con menos se busca con LIKE.
+MIN_LONGITUD_FTS = 3
+
+# Debe ser la misma expresión del índice idx_patients_carnet_normalizado (migración 8)
+CARNET_NORMALIZADO = "upper(replace({alias}.identification_number, ' ', ''))"
+
+
+def _frase(valor):
+    """Escapa el texto como una frase FTS5 (subcadena exacta, sin operadores)"""
+    return '"' + valor.replace('"', '""') + '"'
+
+
+def filtro_pacientes(texto='', nombre='', carnet='', alias='p'):
+    """Condición SQL para buscar pacientes por subcadena usando el índice patients_fts.
+
+    - texto: busca en nombre o carnet (cajas de búsqueda generales)
+    - nombre / carnet: busca solo en esa columna (consulta pública)
+
+    Devuelve (condicion, parametros) para añadir a un WHERE sobre patients con el alias dado.
+    Los criterios vacíos se ignoran; si no hay ninguno la condición es '1=1'.
+    """
+    terminos = []
+    condiciones = []
+    params = []
+    for columna, valor in ((None, texto), ('name', nombre), ('identification_number', carnet)):
+        valor = (valor or '').strip()
+        if not valor:
+            continue
+        if len(valor) >= MIN_LONGITUD_FTS:
+            terminos.append(f'{columna} : {_frase(valor)}' if columna else _frase(valor))
+        elif columna:
+            condiciones.append(f'{alias}.{columna} LIKE ?')
+            params.append(f'%{valor}%')
+        else:
+            condiciones.append(f'({alias}.name LIKE ? OR {alias}.identification_number LIKE ?)')
+            params.extend([f'%{valor}%', f'%{valor}%'])
+
+    if terminos:
+        condiciones.insert(0, f'{alias}.id IN (SELECT rowid FROM patients_fts WHERE patients_fts MATCH ?)')
+        params.insert(0, ' AND '.join(terminos))
+
+    if not condiciones:
+        return '1=1', []
+    return ' AND '.join(condiciones), params
+
+
+def normalizar_carnet(carnet):
+    """Carnet sin espacios y en mayúsculas, como en el índice normalizado"""
+    return ''.join((carnet or '').split()).upper()
+
+
+def filtro_carnet_exacto(carnet, alias='p'):
+    """Condición por carnet exacto (normalizado) que usa idx_patients_carnet_normalizado"""
+    return f'{CARNET_NORMALIZADO.format(alias=alias)} = ?', [normalizar_carnet(carnet)]
@@ -0,0 +1,168 @@
+import json
+import secrets
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from cache import CacheTTL
+from db import get_db_connection
+
+# Sesiones guardadas en SQLite (tabla sesiones, migración 12): la cookie solo lleva un
+# id aleatorio. Cada worker guarda en memoria las sesiones que ya leyó junto con la
+# versión del usuario (versiones_usuario) con la que las validó, así que cada petición
+# solo consulta esa versión por clave primaria. Editar o borrar el usuario sube su
+# versión (triggers) y cerrar sesión también: en la petición siguiente cualquier worker
+# vuelve a leer la sesión con el rol, el estado y el nombre actuales del usuario, y un
+# usuario inactivo o borrado pierde la sesión.
+#
+# El id nunca lo elige el cliente: una cookie con un id desconocido o vencido recibe
+# una sesión nueva con otro id, e iniciar o cerrar sesión (regenerar) también cambia
+# el id y borra la fila anterior. Así nadie puede fijar de antemano la cookie de otra
+# persona y usarla cuando esa persona inicie sesión.
+ADMIN_FIJO = 0  # usuario_id del admin de login() que no está en la tabla usuarios
+TAMANO_ID = 32
+
+# sid -> (usuario_id, versión validada, datos, expira)
+_sesiones = CacheTTL(maxsize=4096, ttl=600)
+
+
+class Sesion(CallbackDict, SessionMixin):
+    """Datos de la sesión; `sid` es None hasta que se guarda por primera vez.
+
+    `anterior` es el (sid, usuario_id) que save_session debe borrar porque la
+    sesión cambió de id o porque la cookie traía uno que ya no vale.
+    """
+
+    def __init__(self, datos=None, sid=None, usuario_id=None):
+        def al_modificar(sesion):
+            sesion.modified = True
+        super().__init__(datos, al_modificar)
+        self.sid = sid
+        self.usuario_id = usuario_id
+        self.anterior = None
+        self.modified = False
+
+    def regenerar(self):
+        """Cambia el id de la sesión al guardarla (al iniciar o cerrar sesión) y borra el anterior"""
+        if self.sid is not None and self.anterior is None:
+            self.anterior = (self.sid, self.usuario_id)
+        self.sid = None
+        self.usuario_id = None
+        self.modified = True
+
+
+def _usuario_de(datos):
+    if not datos.get('logged_in'):
+        return None
+    return datos.get('user_id', ADMIN_FIJO)
+
+
+def _version(conn, usuario_id):
+    fila = conn.execute('SELECT version FROM versiones_usuario WHERE usuario_id = ?', (usuario_id,)).fetchone()
+    return fila[0] if fila else 0
+
+
+def _cargar(conn, sid):
+    """Lee la sesión con el estado actual de su usuario; None si no existe, venció o fue revocada"""
+    fila = conn.execute('''
+        SELECT s.usuario_id, s.datos, s.expira, COALESCE(v.version, 0) AS version,
+               u.id AS existe, u.rol, u.estado, u.nombre_completo
+        FROM sesiones s
+        LEFT JOIN versiones_usuario v ON v.usuario_id = s.usuario_id
+        LEFT JOIN usuarios u ON u.id = s.usuario_id
+        WHERE s.id = ?
+    ''', (sid,)).fetchone()
+    if fila is None or fila['expira'] < time.time():
+        return None
+    datos = json.loads(fila['datos'])
+    if fila['usuario_id'] not in (None, ADMIN_FIJO):
+        if fila['existe'] is None or fila['estado'] != 'Activo':
+            return None
+        datos['rol'] = fila['rol']
+        datos['nombre_completo'] = fila['nombre_completo']
+    return fila['usuario_id'], fila['version'], datos, fila['expira']
+
+
+def subir_version(conn, usuario_id):
+    """Invalida en todos los workers las sesiones del usuario que tengan en memoria"""
+    conn.execute('''
+        INSERT INTO versiones_usuario (usuario_id, version) VALUES (?, 1)
+            ON CONFLICT (usuario_id) DO UPDATE SET version = version + 1
+    ''', (usuario_id,))
+
+
+class InterfazSesiones(SessionInterface):
+    """Sesiones de Flask en la tabla sesiones en lugar de una cookie firmada con los datos"""
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return Sesion()
+        conn = get_db_connection()
+        entrada = _sesiones.get(sid)
+        if entrada is not None:
+            usuario_id, version, _, expira = entrada
+            if expira < time.time() or (usuario_id is not None and _version(conn, usuario_id) != version):
+                entrada = None
+        if entrada is None:
+            entrada = _cargar(conn, sid)
+            if entrada is None:
+                # Vencida, revocada o desconocida: sesión nueva (nunca con el id que mandó
+                # el cliente); save_session borra la fila vieja y reemplaza o borra la cookie
+                _sesiones.invalidate(sid)
+                sesion = Sesion()
+                sesion.anterior = (sid, None)
+                sesion.modified = True
+                return sesion
+            _sesiones.set(sid, entrada)
+        return Sesion(dict(entrada[2]), sid=sid, usuario_id=entrada[0])
+
+    def save_session(self, app, session, response):
+        nombre = self.get_cookie_name(app)
+        dominio = self.get_cookie_domain(app)
+        ruta = self.get_cookie_path(app)
+        response.vary.add('Cookie')
+        borrar = [session.anterior] if session.anterior is not None else []
+        if not session and session.sid is not None and session.modified:
+            borrar.append((session.sid, session.usuario_id))
+        if borrar:
+            conn = get_db_connection()
+            for sid, usuario_id in borrar:
+                conn.execute('DELETE FROM sesiones WHERE id = ?', (sid,))
+                if usuario_id is not None:
+                    subir_version(conn, usuario_id)
+                _sesiones.invalidate(sid)
+            conn.commit()
+        if not session:
+            if borrar:
+                response.delete_cookie(nombre, domain=dominio, path=ruta, secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+        if not session.modified:
+            return
+
+        conn = get_db_connection()
+        ahora = time.time()
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(TAMANO_ID)
+            conn.execute('DELETE FROM sesiones WHERE expira < ?', (int(ahora),))
+        datos = dict(session)
+        usuario_id = _usuario_de(datos)
+        expira = int(ahora + app.permanent_session_lifetime.total_seconds())
+        conn.execute('''
+            INSERT INTO sesiones (id, usuario_id, datos, expira) VALUES (?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    usuario_id = excluded.usuario_id, datos = excluded.datos, expira = excluded.expira
+        ''', (session.sid, usuario_id, json.dumps(datos), expira))
+        conn.commit()
+        _sesiones.set(session.sid, (usuario_id, _version(conn, usuario_id) if usuario_id is not None else 0,
+                                    datos, expira))
+        response.set_cookie(nombre, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=dominio, path=ruta,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+def init_app(app):
+    app.session_interface = InterfazSesiones()
@@ -192,3 +192,101 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     });
 });
+
+// Gráfica de tendencias: se pide al servidor la serie ya agregada (resumen diario)
+document.addEventListener('DOMContentLoaded', function () {
+    const canvas = document.getElementById('graficaTendencias');
+    const filtros = document.getElementById('filtrosTendencias');
+    if (!canvas || !filtros) {
+        return;
+    }
+
+    const colores = [
+        'rgba(59, 130, 246, 1)',
+        'rgba(16, 185, 129, 1)',
+        'rgba(139, 92, 246, 1)',
+        'rgba(251, 146, 60, 1)',
+        'rgba(236, 72, 153, 1)',
+        'rgba(34, 197, 94, 1)'
+    ];
+    let graficaTendencias = null;
+
+    function cargarTendencias() {
+        const parametros = new URLSearchParams();
+        new FormData(filtros).forEach((valor, clave) => {
+            if (valor) {
+                parametros.append(clave, valor);
+            }
+        });
+
+        fetch(canvas.dataset.url + '?' + parametros.toString())
+            .then(respuesta => respuesta.json().then(datos => ({ ok: respuesta.ok, datos })))
+            .then(({ ok, datos }) => {
+                if (!ok) {
+                    alert(datos.error || 'No se pudieron cargar las tendencias');
+                    return;
+                }
+                // Mostrar en los filtros el rango que usó el servidor
+                document.getElementById('tendenciaDesde').value = datos.desde;
+                document.getElementById('tendenciaHasta').value = datos.hasta;
+
+                const datasets = datos.series.map((serie, index) => ({
+                    label: serie.prueba,
+                    data: serie.cantidades,
+                    borderColor: colores[index % colores.length],
+                    backgroundColor: colores[index % colores.length],
+                    borderWidth: 2,
+                    pointRadius: 2,
+                    tension: 0.3
+                }));
+                const positivos = datos.periodos.map((_, i) =>
+                    datos.series.reduce((total, serie) => total + serie.positivos[i], 0));
+                datasets.push({
+                    label: 'Positivos (total)',
+                    data: positivos,
+                    borderColor: 'rgba(239, 68, 68, 1)',
+                    backgroundColor: 'rgba(239, 68, 68, 0.15)',
+                    borderDash: [6, 4],
+                    borderWidth: 2,
+                    pointRadius: 2,
+                    fill: true,
+                    tension: 0.3
+                });
+
+                if (graficaTendencias) {
+                    graficaTendencias.data.labels = datos.periodos;
+                    graficaTendencias.data.datasets = datasets;
+                    graficaTendencias.update();
+                    return;
+                }
+                graficaTendencias = new Chart(canvas, {
+                    type: 'line',
+                    data: {
+                        labels: datos.periodos,
+                        datasets: datasets
+                    },
+                    options: {
+                        responsive: true,
+                        maintainAspectRatio: true,
+                        aspectRatio: 2.5,
+                        interaction: {
+                            mode: 'index',
+                            intersect: false
+                        },
+                        scales: {
+                            y: {
+                                beginAtZero: true,
+                                ticks: {
+                                    precision: 0
+                                }
+                            }
+                        }
+                    }
+                });
+            })
+            .catch(() => alert('No se pudieron cargar las tendencias'));
+    }
+
+    filtros.addEventListener('change', cargarTendencias);
+    cargarTendencias();
+});
@@ -0,0 +1,147 @@
+import functools
+import hashlib
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+from flask import Response, make_response, request, session
+
+from db import get_db_connection
+
+# Contadores de la tabla versiones_datos (migración 7): los triggers suman 1 en cada
+# INSERT, UPDATE o DELETE de la tabla, así que si el número no cambió los datos tampoco.
+
+# Resultados de consultas guardados por worker (ver CacheResultados), en bytes aproximados
+MAX_BYTES_RESULTADOS = 32 * 1024 * 1024
+
+
+def version(conn, *tablas):
+    """Versión combinada de las tablas indicadas, o de todas si no se indica ninguna"""
+    query = 'SELECT COALESCE(SUM(version), 0) FROM versiones_datos'
+    if tablas:
+        query += ' WHERE tabla IN (%s)' % ', '.join('?' for _ in tablas)
+    return conn.execute(query, tablas).fetchone()[0]
+
+
+def etag(*partes):
+    """ETag a partir de la versión de los datos y de lo que define la respuesta (URL, usuario...)"""
+    return hashlib.sha1(repr(partes).encode()).hexdigest()[:20]
+
+
+def no_modificado(valor):
+    """True si el cliente ya tiene esta versión (If-None-Match coincide)"""
+    return request.if_none_match.contains_weak(valor)
+
+
+def tamano_aproximado(valor):
+    """Bytes que ocupa en memoria un resultado (filas, listas, diccionarios y escalares)"""
+    if isinstance(valor, (list, tuple, sqlite3.Row)):
+        return sys.getsizeof(valor) + sum(tamano_aproximado(v) for v in valor)
+    if isinstance(valor, dict):
+        return sys.getsizeof(valor) + sum(tamano_aproximado(k) + tamano_aproximado(v) for k, v in valor.items())
+    return sys.getsizeof(valor)
+
+
+class CacheResultados:
+    """Resultados de consultas del worker, compartidos por todos los usuarios.
+
+    Cada entrada guarda la versión de las tablas de las que depende. Cuando esa versión
+    avanza se descartan todas las entradas de esas tablas, no solo la consultada, así que
+    no quedan resultados viejos ocupando memoria. El total se acota a `max_bytes`
+    desalojando las menos usadas.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES_RESULTADOS):
+        self.max_bytes = max_bytes
+        self._datos = OrderedDict()  # (tablas, clave) -> (versión, valor, bytes)
+        self._versiones = {}         # tablas -> última versión vista
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def obtener(self, conn, tablas, clave, calcular):
+        """Valor de `clave` para la versión actual de `tablas`; si no está lo calcula con `calcular()`"""
+        tablas = tuple(sorted(tablas))
+        actual = version(conn, *tablas)
+        entrada_id = (tablas, clave)
+        with self._lock:
+            self._avanzar(tablas, actual)
+            entrada = self._datos.get(entrada_id)
+            if entrada is not None:
+                self._datos.move_to_end(entrada_id)
+                return entrada[1]
+        valor = calcular()
+        tamano = tamano_aproximado(valor)
+        with self._lock:
+            # Si otra petición ya vio una versión más nueva, este resultado nació viejo
+            if tamano <= self.max_bytes and self._versiones.get(tablas) == actual:
+                self._quitar(entrada_id)
+                self._datos[entrada_id] = (actual, valor, tamano)
+                self._bytes += tamano
+                while self._bytes > self.max_bytes:
+                    self._quitar(next(iter(self._datos)))
+        return valor
+
+    def _avanzar(self, tablas, actual):
+        if self._versiones.get(tablas, actual) < actual:
+            for entrada_id in [e for e in self._datos if e[0] == tablas]:
+                self._quitar(entrada_id)
+        self._versiones[tablas] = max(actual, self._versiones.get(tablas, actual))
+
+    def _quitar(self, entrada_id):
+        entrada = self._datos.pop(entrada_id, None)
+        if entrada is not None:
+            self._bytes -= entrada[2]
+
+    def __len__(self):
+        return len(self._datos)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+            self._versiones.clear()
+            self._bytes = 0
+
+
+resultados = CacheResultados()
+
+
+def cache_por_version(*tablas):
+    """Decorador para vistas GET que solo dependen de los datos de `tablas` y del usuario.
+
+    Mientras la versión de los datos no cambie responde 304 al navegador que ya tiene
+    la página (ETag), sin llamar a la vista. El HTML no se guarda en el servidor: lo
+    que se reutiliza entre peticiones son los resultados de las consultas (resultados).
+    Las demás peticiones (POST) pasan directo a la vista.
+    """
+    def decorador(vista):
+        @functools.wraps(vista)
+        def envoltura(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return vista(*args, **kwargs)
+
+            usuario = (session.get('logged_in'), session.get('user_id'), session.get('username'), session.get('rol'))
+            valor = etag(request.endpoint, request.full_path, usuario, version(get_db_connection(), *tablas))
+            if no_modificado(valor):
+                respuesta = Response(status=304)
+                respuesta.set_etag(valor)
+                return respuesta
+
+            respuesta = make_response(vista(*args, **kwargs))
+            # Redirecciones, errores o respuestas por partes no llevan ETag
+            if respuesta.status_code != 200 or respuesta.is_streamed:
+                return respuesta
+            respuesta.set_etag(valor)
+            respuesta.headers['Cache-Control'] = 'private, no-cache'
+            return respuesta.make_conditional(request)
+        return envoltura
+    return decorador
+
+
+def init_app(app):
+    app.config.setdefault('RESULTS_CACHE_MAX_BYTES', MAX_BYTES_RESULTADOS)
+    resultados.max_bytes = app.config['RESULTS_CACHE_MAX_BYTES']